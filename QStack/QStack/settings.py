@@ -43,6 +43,9 @@ INSTALLED_APPS = [
 AUTH_USER_MODEL = 'stack.User'
 
 MIDDLEWARE = [
+    'stack.metrics.MetricsMiddleware',
+    'stack.querycheck.QueryCheckMiddleware',
+    'stack.routers.ReplicaMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -82,8 +85,85 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+        # file based test database lets concurrency tests open several connections
+        'TEST': {'NAME': os.path.join(BASE_DIR, 'test_db.sqlite3')},
+    },
+    # local read replica, a copy of the primary refreshed by `manage.py sync_replicas`
+    'replica': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.path.join(BASE_DIR, 'db_replica.sqlite3'),
+        'TEST': {'NAME': os.path.join(BASE_DIR, 'test_db_replica.sqlite3')},
+    },
+}
+
+# Production SQLite profile: pragmas run on every new connection (WAL lets readers work during writes,
+# busy_timeout in ms makes writers wait for the lock), write transactions of votes and answers are retried
+# with backoff SQLITE_WRITE_RETRIES times while the database is locked, SQLITE_WRITE_QUEUE runs them
+# one at a time in a single writer thread of the process
+SQLITE_PRAGMAS = {
+    'journal_mode': 'wal',
+    'synchronous': 'normal',
+    'busy_timeout': 5000,
+    'mmap_size': 256 * 1024 * 1024,
+    'cache_size': -20000,
+}
+SQLITE_WRITE_RETRIES = 5
+SQLITE_WRITE_QUEUE = False
+
+# GET requests of read-only views are served from one of DATABASE_REPLICAS (e.g. ['replica']),
+# clients read from the primary for REPLICA_PIN_SECONDS after their last write
+DATABASE_ROUTERS = ['stack.routers.ReplicaRouter']
+DATABASE_REPLICAS = []
+REPLICA_PIN_SECONDS = 10
+
+
+# Cache
+# https://docs.djangoproject.com/en/2.0/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'qstack',
+        'OPTIONS': {'MAX_ENTRIES': 10000},
     }
 }
+# LocMemCache is local to each process: deployments with several workers need a shared backend (memcached, redis),
+# `manage.py check --deploy` fails otherwise
+# Pages of anonymous users and answer lists of logged in ones are cached (in seconds),
+# entries are invalidated on changes, timeouts only bound staleness of the trending sidebar
+PAGE_CACHE_TIMEOUT = 60
+FRAGMENT_CACHE_TIMEOUT = 300
+
+# Only logged in users have sessions (list order is carried in the URL), they are read from the cache
+# and written to the database on change only
+SESSION_ENGINE = 'django.contrib.sessions.backends.cached_db'
+
+
+# Trending questions of the sidebar: size of the top, cache lifetime in seconds
+# and optional window in days ("trending this week"), all-time votes are used when it is None
+TRENDING_SIZE = 10
+TRENDING_TIMEOUT = 300
+TRENDING_WINDOW_DAYS = None
+
+# Lifetime in seconds of cached sorted lists of question ids of every tag used by tag:/-tag: queries,
+# lists are dropped whenever questions of the tag change
+TAG_POSTINGS_TIMEOUT = 3600
+
+# Lifetime in seconds of the cached total number of questions shown above the list
+QUESTION_COUNT_TIMEOUT = 60
+
+# Users by reputation (/users/): users per page and lifetime in seconds of cached pages, reputation changes
+# with every vote so pages are not invalidated on it, they are only dropped by reconcile_reputation
+LEADERBOARD_PAGE_SIZE = 50
+LEADERBOARD_TIMEOUT = 60
+# cached question lists and pages show reputation of authors at most this many seconds older than the last change
+REPUTATION_REFRESH = 60
+
+# Related questions of question pages computed by rebuild_related (needs numpy and scipy): neighbours stored
+# per question and most similarities computed at once (about 20 bytes each, on top of the TF-IDF matrix of all
+# questions the job keeps in memory, up to 800 bytes per question, see stack/related.py)
+RELATED_SIZE = 5
+RELATED_BLOCK_ENTRIES = 5000000
 
 
 # Password validation
@@ -124,6 +204,12 @@ USE_TZ = True
 SITE_NAME = 'QStack'
 MEDIA_URL = '/photos/'
 MEDIA_ROOT = os.path.join(BASE_DIR, '')
+# Avatars are validated on upload (size in bytes, width and height) and stored under hash of their content
+# with square PNG thumbnails of given sizes, they never change and are served with far-future cache headers
+AVATAR_MAX_BYTES = 120 * 1024
+AVATAR_MAX_DIMENSION = 1000
+AVATAR_SIZES = (32, 150)
+AVATAR_CACHE_MAX_AGE = 365 * 24 * 3600
 STATIC_URL = '/static/'
 STATIC_ROOT = os.path.join(BASE_DIR, '/stack')
 STATICFILES_DIRS = (os.path.join(BASE_DIR, "stack/static/stack"),)
@@ -133,3 +219,32 @@ LOGOUT_REDIRECT_URL = '/stack/'
 DEFAULT_FROM_EMAIL="noreply@mail.com"
 EMAIL_BACKEND = "django.core.mail.backends.filebased.EmailBackend"
 EMAIL_FILE_PATH = os.path.join(BASE_DIR, "sent_emails")
+# Outbox drained by "manage.py send_queued_mail": attempts per message, delay in seconds
+# before the first retry (doubled on every next one) and lease of a claimed batch
+MAIL_MAX_ATTEMPTS = 5
+MAIL_RETRY_DELAY = 60
+MAIL_LEASE = 300
+
+# Per-view latency, query and template metrics served in Prometheus format at /metrics,
+# they are aggregated per process; addresses allowed to scrape them (the local host only when None)
+METRICS_ALLOWED_IPS = ['127.0.0.1', '::1']
+
+# In DEBUG mode requests running a normalised query more than QUERY_REPEAT_THRESHOLD times
+# or more queries than the budget of their URL name are logged (tests enforce the same budgets)
+QUERY_REPEAT_THRESHOLD = 3
+QUERY_BUDGETS = {
+    'stack:index': 10,
+    'stack:detail': 12,
+    'stack:vote': 12,
+    'stack:give_answer': 15,
+    'stack:ask_question': 25,
+    'stack:tags': 6,
+    'stack:users': 6,
+    'api:questions': 8,
+    'api:question': 8,
+    'api:vote': 12,
+}
+
+# JSON API (/api/v1/): items per page of questions and answers, most ids of one batch request
+API_PAGE_SIZE = 20
+API_BATCH_SIZE = 100
@@ -27,8 +27,11 @@ app_name = StackConfig.name
 urlpatterns = [
     path('', TemplateView.as_view(template_name='index.html'), name='index'),
     url(r'^' + app_name + '/', include(app_name + '.urls')),
+    path('api/v1/', include(app_name + '.api_urls')),
     path(r'' + app_name + '/', include('django.contrib.auth.urls')),
     path('signup/', views.SignUp.as_view(), name='signup'),
+    path('metrics', views.metrics, name='metrics'),
+    path(settings.MEDIA_URL.lstrip('/') + 'avatars/<path:path>', views.avatar, name='avatar'),
     path('profile/', views.Profile.as_view(), name='profile'),
     path('password_reset/', TemplateView.as_view(template_name='password_reset_form.html'), name='password_reset_form'),
     url(r'^admin/', admin.site.urls),
@@ -1,7 +1,7 @@
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin
 
-from .models import Question, Answer, Tag, VoteAnswer, VoteQuestion
+from .models import Question, Answer, Tag, VoteAnswer, VoteQuestion, OutgoingEmail
 from .forms import CustomUserCreationForm, CustomUserChangeForm
 from django.contrib.auth import get_user_model
 from django.utils.safestring import mark_safe
@@ -27,8 +27,8 @@ class CustomUserAdmin(UserAdmin):
         }),)
 
     def image_tag(self, obj):
-        if obj.id:
-            return mark_safe('<img src="/photos/%s" width="150" height="150" />' % obj.image)
+        if obj.image:
+            return mark_safe('<img src="%s" width="150" height="150" />' % obj.get_large_avatar_url())
         return ''
 
     image_tag.short_description = 'Image'
@@ -40,4 +40,5 @@ admin.site.register(VoteAnswer)
 admin.site.register(Question)
 admin.site.register(Answer)
 admin.site.register(Tag)
+admin.site.register(OutgoingEmail)
 admin.site.register(get_user_model(), CustomUserAdmin)
@@ -0,0 +1,126 @@
+from django.conf import settings
+from django.http import JsonResponse, StreamingHttpResponse
+from django.views.decorators.http import require_GET, require_POST
+
+from .models import Question, Answer, VoteQuestion, VoteAnswer
+from .pagination import CursorPaginator, ANSWER_KEYS
+from .routers import replica_reads
+from .transfer import export_lines
+from .utils import find_questions, get_list_order, load_questions, vote
+
+
+def json_response(data, status=200):
+    return JsonResponse(data, status=status, json_dumps_params={'separators': (',', ':')})
+
+
+def error(status, message):
+    return json_response({'error': message}, status=status)
+
+
+def author(message):
+    return message.user.username if message.user_id else None
+
+
+def question_data(question, vote_state=None):
+    """Returns compact representation of the question as shown in lists"""
+    return {'id': question.id, 'header': question.header, 'author': author(question),
+            'pub_date': question.pub_date, 'last_activity_at': question.last_activity_at,
+            'votes': question.votes, 'answers': question.answer_count,
+            'accepted_answer': question.accepted_answer_id, 'tags': [tag.tag for tag in question.tag.all()],
+            'vote': vote_state}
+
+
+def answer_data(answer, vote_state=None):
+    return {'id': answer.id, 'content': answer.content, 'author': author(answer), 'pub_date': answer.pub_date,
+            'votes': answer.votes, 'accepted': answer.correctness, 'vote': vote_state}
+
+
+def question_list_data(request, question_list):
+    votes = VoteQuestion.objects.state_map(request.user, question_list)
+    return [question_data(question, votes.get(question.id)) for question in question_list]
+
+
+def parse_ids(value):
+    """Returns list of distinct ids of comma separated string keeping their order, raises ValueError on bad input"""
+    ids = []
+    for part in value.split(','):
+        question_id = int(part)
+        if question_id not in ids:
+            ids.append(question_id)
+    if len(ids) > settings.API_BATCH_SIZE:
+        raise ValueError('At most %d ids can be requested at once' % settings.API_BATCH_SIZE)
+    return ids
+
+
+@replica_reads
+@require_GET
+def questions(request):
+    """Lists questions like the index page (order, search, tag, cursor), ?ids=1,2,3 returns given questions instead"""
+    if 'ids' in request.GET:
+        try:
+            ids = parse_ids(request.GET['ids'])
+        except ValueError as e:
+            return error(400, str(e))
+        found = {question.id: question for question in load_questions().filter(pk__in=ids)}
+        return json_response({'questions': question_list_data(request, [found[question_id] for question_id in ids
+                                                                         if question_id in found])})
+
+    question_list, keys, _ = find_questions(request.GET, get_list_order(request))
+    page = CursorPaginator(question_list, keys, per_page=settings.API_PAGE_SIZE).page(request.GET.get('cursor'))
+    return json_response({'questions': question_list_data(request, page), 'next': page.next_cursor,
+                          'previous': page.previous_cursor})
+
+
+@replica_reads
+@require_GET
+def question(request, question_id):
+    """Returns the question with one page of its answers (cursor) and votes of the user"""
+    question = load_questions().filter(pk=question_id).first()
+    if question is None:
+        return error(404, 'Question not found')
+    answer_list = question.answer_set.select_related('user')
+    page = CursorPaginator(answer_list, ANSWER_KEYS, per_page=settings.API_PAGE_SIZE).page(request.GET.get('cursor'))
+    answer_votes = VoteAnswer.objects.state_map(request.user, page)
+
+    data = question_data(question, VoteQuestion.objects.state_map(request.user, [question]).get(question.id))
+    data['content'] = question.content
+    data['answer_list'] = [answer_data(answer, answer_votes.get(answer.id)) for answer in page]
+    data['next'], data['previous'] = page.next_cursor, page.previous_cursor
+    return json_response(data)
+
+
+def vote_response(request, message):
+    """Votes like the HTML forms ('upvote' or 'downvote' parameter) and returns new count and state of the vote"""
+    if not request.user.is_authenticated:
+        return error(403, 'Authentication required')
+    result = vote(request, message)
+    if result is None:
+        return error(400, "Either 'upvote' or 'downvote' parameter is required")
+    votes, state = result
+    return json_response({'id': message.id, 'votes': votes, 'vote': state})
+
+
+@require_POST
+def vote_question(request, question_id):
+    question = Question.objects.filter(pk=question_id).first()
+    if question is None:
+        return error(404, 'Question not found')
+    return vote_response(request, question)
+
+
+@require_POST
+def vote_answer(request, question_id, answer_id):
+    answer = Answer.objects.filter(pk=answer_id, question_id=question_id).first()
+    if answer is None:
+        return error(404, 'Answer not found')
+    return vote_response(request, answer)
+
+
+@require_GET
+def export(request):
+    """Streams all data in qstack_import format, the dump contains password hashes so it is given to staff only"""
+    if not request.user.is_staff:
+        return error(403, 'Export is available to staff only')
+    response = StreamingHttpResponse(export_lines(), content_type='application/x-ndjson')
+    response['Content-Disposition'] = 'attachment; filename="qstack.ndjson"'
+    return response
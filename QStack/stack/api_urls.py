@@ -0,0 +1,12 @@
+from django.urls import path
+
+from . import api
+
+app_name = 'api'
+urlpatterns = [
+    path('questions', api.questions, name='questions'),
+    path('questions/<int:question_id>', api.question, name='question'),
+    path('questions/<int:question_id>/vote', api.vote_question, name='vote'),
+    path('questions/<int:question_id>/answers/<int:answer_id>/vote', api.vote_answer, name='vote'),
+    path('export', api.export, name='export'),
+]
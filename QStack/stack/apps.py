@@ -3,3 +3,6 @@ from django.apps import AppConfig
 
 class StackConfig(AppConfig):
     name = 'stack'
+
+    def ready(self):
+        from . import checks, signals
@@ -0,0 +1,79 @@
+import hashlib
+import os
+from io import BytesIO
+
+from PIL import Image, ImageFile, ImageOps
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+
+AVATAR_DIR = 'avatars'
+ORIGINAL = 'original'
+FORMATS = {'JPEG': '.jpg', 'PNG': '.png', 'GIF': '.gif'}
+
+
+def validate_avatar(upload):
+    """Checks size, format and dimensions of uploaded image reading only as much of it as its header needs"""
+    if upload.size > settings.AVATAR_MAX_BYTES:
+        raise ValidationError('Avatar file size may not exceed %dk.' % (settings.AVATAR_MAX_BYTES // 1024))
+
+    parser = ImageFile.Parser()
+    upload.seek(0)
+    try:
+        while parser.image is None:
+            chunk = upload.read(1024)
+            if not chunk:
+                break
+            parser.feed(chunk)
+    except (IOError, SyntaxError, ValueError):
+        pass
+    finally:
+        upload.seek(0)
+
+    if parser.image is None or parser.image.format not in FORMATS:
+        raise ValidationError('Please use a JPEG, GIF or PNG image.')
+    width, height = parser.image.size
+    if width > settings.AVATAR_MAX_DIMENSION or height > settings.AVATAR_MAX_DIMENSION:
+        raise ValidationError('Please use an image that is %s x %s pixels or smaller.' % (
+            settings.AVATAR_MAX_DIMENSION, settings.AVATAR_MAX_DIMENSION))
+
+
+def content_name(file, filename):
+    """Returns storage name of the original image derived from hash of its content"""
+    digest = hashlib.sha256()
+    for chunk in file.chunks():
+        digest.update(chunk)
+    digest = digest.hexdigest()
+    return '/'.join((AVATAR_DIR, digest[:2], digest, ORIGINAL + os.path.splitext(filename)[1].lower()))
+
+
+def is_content_named(name):
+    return bool(name) and name.startswith(AVATAR_DIR + '/') and os.path.basename(name).startswith(ORIGINAL)
+
+
+def thumbnail_name(name, size):
+    return '%s/%d.png' % (os.path.dirname(name), size)
+
+
+def avatar_url(image, size):
+    """Returns URL of the square thumbnail of given size, original image of files stored before thumbnails"""
+    if is_content_named(image.name):
+        return default_storage.url(thumbnail_name(image.name, size))
+    return image.url
+
+
+def make_thumbnails(name):
+    """Writes thumbnails of all AVATAR_SIZES next to the original, existing ones are kept as paths are content based"""
+    missing = [size for size in settings.AVATAR_SIZES if not default_storage.exists(thumbnail_name(name, size))]
+    if not missing:
+        return
+    with default_storage.open(name) as original:
+        image = Image.open(original)
+        image.load()
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA')
+    for size in missing:
+        buffer = BytesIO()
+        ImageOps.fit(image, (size, size), Image.LANCZOS).save(buffer, 'PNG', optimize=True)
+        default_storage.save(thumbnail_name(name, size), ContentFile(buffer.getvalue()))
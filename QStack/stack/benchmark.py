@@ -0,0 +1,277 @@
+import platform
+import random
+import sqlite3
+import threading
+import time
+from collections import Counter
+
+import django
+from django.conf import settings
+from django.db import connection, connections
+from django.db.models import Count
+from django.test import Client
+from django.test.utils import (CaptureQueriesContext, override_settings, setup_test_environment,
+                               teardown_test_environment)
+from django.urls import reverse
+
+from .models import User, Question, Answer, Tag
+from .pagination import CursorPaginator, ORDER_KEYS
+from .seeding import ZipfSampler, dataset, seed, vocabulary
+from .sqlite import run_write
+from .tagindex import filter_questions, join_questions, parse_query
+from .utils import load_questions
+
+BENCHMARK_USER = 'benchmark'
+# number of most popular questions/answers/tags requests are spread over
+TARGETS = 1000
+SEARCH_WORDS = 200
+
+
+def percentile(values, fraction):
+    """Returns nearest-rank percentile of the values"""
+    values = sorted(values)
+    return values[max(int(round(fraction * len(values) + 0.5)) - 1, 0)] if values else None
+
+
+def summarize(timings, queries, statuses):
+    return {'requests': len(timings),
+            'p50_ms': round(percentile(timings, 0.5) * 1000, 2),
+            'p95_ms': round(percentile(timings, 0.95) * 1000, 2),
+            'queries_p50': percentile(queries, 0.5),
+            'queries_max': max(queries),
+            'errors': sum(1 for status in statuses if status >= 400)}
+
+
+class Traffic(object):
+    """Zipfian choice of pages requested by the benchmark, popular questions are hit most"""
+
+    def __init__(self, rng):
+        self.rng = rng
+        self.questions = ZipfSampler(Question.objects.order_by('-answer_count', '-votes', '-id')
+                                     .values_list('id', flat=True)[:TARGETS], rng=rng)
+        self.answers = ZipfSampler(Answer.objects.filter(question__isnull=False).order_by('-votes', '-id')
+                                   .values_list('question_id', 'id')[:TARGETS], rng=rng)
+        self.tags = ZipfSampler(Tag.objects.annotate(used=Count('question')).order_by('-used', 'id')
+                                .values_list('tag', flat=True)[:TARGETS], rng=rng)
+        self.words = ZipfSampler(vocabulary(SEARCH_WORDS), rng=rng)
+
+    def tag_query(self):
+        """Returns 'tag:a tag:b -tag:c' query of popular tags"""
+        first, second, excluded = self.tags.sample(3)
+        return 'tag:%s tag:%s -tag:%s' % (first, second, excluded)
+
+
+def scenarios(traffic):
+    """Returns {name: function(client) -> response} of measured requests"""
+
+    def vote(url):
+        return lambda client: client.post(url(), {traffic.rng.choice(('upvote', 'downvote')): ''},
+                                          HTTP_REFERER='/')
+
+    return {
+        'index': lambda client: client.get(reverse('stack:index')),
+        'index_by_votes': lambda client: client.get(reverse('stack:index'), {'order': 'vote'}),
+        'index_hot': lambda client: client.get(reverse('stack:index'), {'order': 'hot'}),
+        'detail': lambda client: client.get(reverse('stack:detail', args=(traffic.questions.one(),))),
+        'search': lambda client: client.get(reverse('stack:index'),
+                                            {'search': ' '.join(traffic.words.sample(2))}),
+        'tag': lambda client: client.get(reverse('stack:index'), {'tag': traffic.tags.one()}),
+        'multi_tag': lambda client: client.get(reverse('stack:index'), {'search': traffic.tag_query()}),
+        'vote_question': vote(lambda: reverse('stack:vote', args=(traffic.questions.one(),))),
+        'vote_answer': vote(lambda: reverse('stack:vote', args=traffic.answers.one())),
+        'ask_question': lambda client: client.post(reverse('stack:ask_question'), {
+            'q_header': ' '.join(traffic.words.sample(6)), 'q_content': ' '.join(traffic.words.sample(30)),
+            'q_tags': ' '.join(traffic.tags.sample(2))}),
+    }
+
+
+def compare_tag_queries(repeat=50, random_seed=0):
+    """Measures first page of multi-tag queries served from tag posting lists and by joins, returns summaries"""
+    traffic = Traffic(random.Random(random_seed))
+    queries = [parse_query(traffic.tag_query()) for _ in range(repeat)]
+    keys = ORDER_KEYS['-pub_date']
+
+    def first_page(restrict):
+        def request(query):
+            questions = restrict(Question.objects.all(), query.tags, query.excluded)
+            return list(CursorPaginator(load_questions(questions), keys).page())
+        return request
+
+    report = {}
+    for name, restrict in (('tag_index', filter_questions), ('tag_join', join_questions)):
+        request = first_page(restrict)
+        for query in queries:
+            request(query)
+        timings, counts = [], []
+        for query in queries:
+            with CaptureQueriesContext(connection) as captured:
+                start = time.perf_counter()
+                request(query)
+                timings.append(time.perf_counter() - start)
+            counts.append(len(captured))
+        report[name] = summarize(timings, counts, [])
+    return report
+
+
+def measure(request, client, repeat):
+    """Returns latency and query count summary of repeated request, the first (warm-up) one is not counted"""
+    request(client)
+    timings, queries, statuses = [], [], []
+    for _ in range(repeat):
+        with CaptureQueriesContext(connection) as captured:
+            start = time.perf_counter()
+            response = request(client)
+            timings.append(time.perf_counter() - start)
+        queries.append(len(captured))
+        statuses.append(response.status_code)
+    return summarize(timings, queries, statuses)
+
+
+def run_scenarios(repeat=50, random_seed=0, names=None):
+    """Measures every scenario as a logged in user against the current database, returns {name: summary}"""
+    user = User.objects.filter(username=BENCHMARK_USER).first()
+    if user is None:
+        user = User.objects.create_user(BENCHMARK_USER, 'benchmark@example.com', 'password')
+    client = Client()
+    client.force_login(user)
+    traffic = Traffic(random.Random(random_seed))
+    return {name: measure(request, client, repeat)
+            for name, request in sorted(scenarios(traffic).items()) if names is None or name in names}
+
+
+def write_profiles():
+    """Returns {name: settings} of compared SQLite setups, baseline is the one used before the production profile"""
+    production = dict(settings.SQLITE_PRAGMAS or {}, journal_mode='wal')
+    return {
+        'baseline': {'SQLITE_PRAGMAS': {'journal_mode': 'delete', 'synchronous': 'full'},
+                     'SQLITE_WRITE_RETRIES': 1, 'SQLITE_WRITE_QUEUE': False},
+        'production': {'SQLITE_PRAGMAS': production, 'SQLITE_WRITE_RETRIES': settings.SQLITE_WRITE_RETRIES,
+                       'SQLITE_WRITE_QUEUE': False},
+        'production_queue': {'SQLITE_PRAGMAS': production, 'SQLITE_WRITE_RETRIES': settings.SQLITE_WRITE_RETRIES,
+                             'SQLITE_WRITE_QUEUE': True},
+    }
+
+
+def write_plans(threads, writes, random_seed):
+    """Returns list of (operation, target) of every writer, targets are popular questions and answers"""
+    traffic = Traffic(random.Random(random_seed))
+    plans = []
+    for _ in range(threads):
+        plan = []
+        for _ in range(writes):
+            operation = traffic.rng.choice(('vote_question', 'vote_answer', 'answer'))
+            target = traffic.answers.one()[1] if operation == 'vote_answer' else traffic.questions.one()
+            plan.append((operation, target))
+        plans.append(plan)
+    return plans
+
+
+def write(operation, target, user):
+    if operation == 'vote_question':
+        Question.objects.get(pk=target).upvote(user)
+    elif operation == 'vote_answer':
+        Answer.objects.get(pk=target).upvote(user)
+    else:
+        run_write(lambda: Answer.objects.create(content='Benchmark answer', question_id=target, user=user), Answer)
+
+
+def write_load(threads=8, writes=50, readers=2, random_seed=0):
+    """Runs writers voting and answering concurrently with readers of the question list, returns throughput summary
+
+    Requires a database file shared by connections of all threads
+    """
+    users = list(User.objects.order_by('id')[:threads])
+    plans = write_plans(len(users), writes, random_seed)
+    errors = Counter()
+    read_timings = []
+    barrier = threading.Barrier(len(users) + readers + 1)
+    done = threading.Event()
+
+    def writer(user, plan):
+        try:
+            barrier.wait()
+            for operation, target in plan:
+                try:
+                    write(operation, target, user)
+                except Exception as e:
+                    errors['%s: %s' % (type(e).__name__, e)] += 1
+        finally:
+            connections.close_all()
+
+    def reader():
+        try:
+            barrier.wait()
+            while not done.is_set():
+                start = time.perf_counter()
+                try:
+                    list(CursorPaginator(load_questions(), ORDER_KEYS['-votes']).page())
+                except Exception as e:
+                    errors['read %s: %s' % (type(e).__name__, e)] += 1
+                read_timings.append(time.perf_counter() - start)
+        finally:
+            connections.close_all()
+
+    writers = [threading.Thread(target=writer, args=(user, plan)) for user, plan in zip(users, plans)]
+    others = [threading.Thread(target=reader) for _ in range(readers)]
+    for thread in writers + others:
+        thread.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for thread in writers:
+        thread.join()
+    seconds = time.perf_counter() - start
+    done.set()
+    for thread in others:
+        thread.join()
+
+    total = sum(len(plan) for plan in plans)
+    failed = sum(count for error, count in errors.items() if not error.startswith('read '))
+    return {'writes': total, 'failed': failed, 'seconds': round(seconds, 3),
+            'writes_per_second': round((total - failed) / seconds, 1), 'errors': dict(errors),
+            'reads': len(read_timings),
+            'read_p95_ms': round(percentile(read_timings, 0.95) * 1000, 2) if read_timings else None}
+
+
+def compare_write_profiles(threads=8, writes=50, random_seed=0):
+    """Runs write_load under every write profile against the current database file, returns {profile: summary}"""
+    report = {}
+    for name, profile in sorted(write_profiles().items()):
+        with override_settings(**profile):
+            # connections opened from now on get pragmas of the profile
+            connections.close_all()
+            report[name] = write_load(threads, writes, random_seed=random_seed)
+        connections.close_all()
+    return report
+
+
+def environment():
+    return {'python': platform.python_version(), 'django': django.get_version(), 'database': connection.vendor,
+            'sqlite': sqlite3.sqlite_version if connection.vendor == 'sqlite' else None}
+
+
+def run_benchmark(sizes, repeat=50, random_seed=0, names=None, log=None, write_threads=0, writes=50):
+    """Seeds a fresh test database of every size and measures scenarios on it, returns JSON report
+
+    With write_threads concurrent writes are measured under every SQLite write profile too
+    """
+    report = {'environment': environment(), 'repeat': repeat, 'seed': random_seed, 'runs': []}
+    setup_test_environment()
+    try:
+        for size in sizes:
+            old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+            try:
+                start = time.perf_counter()
+                counts = seed(random_seed=random_seed, **dataset(size))
+                seeded = time.perf_counter() - start
+                if log:
+                    log('Seeded %d questions in %.1fs' % (size, seeded))
+                report['runs'].append({'size': size, 'dataset': counts, 'seed_seconds': round(seeded, 2),
+                                       'scenarios': run_scenarios(repeat, random_seed, names),
+                                       'tag_queries': compare_tag_queries(repeat, random_seed)})
+                if write_threads:
+                    report['runs'][-1]['write_load'] = compare_write_profiles(write_threads, writes, random_seed)
+            finally:
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+    finally:
+        teardown_test_environment()
+    return report
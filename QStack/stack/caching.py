@@ -0,0 +1,288 @@
+import datetime
+import hashlib
+import time
+from collections import Counter
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.http import HttpResponse
+from django.middleware.csrf import get_token
+from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.http import http_date, quote_etag
+from django.utils.safestring import mark_safe
+
+from . import routers
+from .models import Question
+
+TRENDING_KEY = 'stack:trending'
+QUESTION_COUNT_KEY = 'stack:question_count'
+LISTING_VERSION_KEY = 'stack:version:listing'
+QUESTION_VERSION_KEY = 'stack:version:question:%s'
+TAGS_VERSION_KEY = 'stack:version:tags'
+TRENDING_VERSION_KEY = 'stack:version:trending'
+LEADERBOARD_VERSION_KEY = 'stack:version:leaderboard'
+RELATED_VERSION_KEY = 'stack:version:related'
+REPLICA_VERSION_KEY = 'stack:version:replica:%s'
+REPUTATION_VERSION_KEY = 'stack:version:reputation'
+REPUTATION_CHANGED_KEY = 'stack:reputation:changed'
+
+# hits and misses of page and fragment caches in this process
+stats = Counter()
+
+
+def compute_trending():
+    """Returns top questions by votes (within TRENDING_WINDOW_DAYS if it is set) as list of dicts"""
+    question_list = Question.objects.order_by('-votes', '-pub_date')
+    if settings.TRENDING_WINDOW_DAYS:
+        since = timezone.now() - datetime.timedelta(days=settings.TRENDING_WINDOW_DAYS)
+        question_list = question_list.filter(pub_date__gte=since)
+    return list(question_list.values('id', 'header', 'votes')[:settings.TRENDING_SIZE])
+
+
+def get_trending():
+    """Returns cached trending questions, they are recomputed once in TRENDING_TIMEOUT seconds or on invalidation"""
+    trending = cache.get(TRENDING_KEY)
+    if trending is None:
+        trending = compute_trending()
+        cache.set(TRENDING_KEY, trending, settings.TRENDING_TIMEOUT)
+        bump_version(TRENDING_VERSION_KEY)
+    return trending
+
+
+def after_commit(func, *args):
+    """Runs func(*args) once the current transaction commits, at once outside of transactions
+
+    Invalidations wait for the commit, a reader seeing the new version earlier would cache the old rows under it
+    """
+    transaction.on_commit(lambda: func(*args))
+
+
+def invalidate_trending():
+    after_commit(cache.delete, TRENDING_KEY)
+
+
+def update_trending(question_id, votes):
+    """Invalidates trending questions if new votes count moves the question into, out of or within the top"""
+    trending = cache.get(TRENDING_KEY)
+    if trending is None:
+        return
+    if (any(question['id'] == question_id for question in trending) or
+            len(trending) < settings.TRENDING_SIZE or votes >= trending[-1]['votes']):
+        invalidate_trending()
+
+
+def get_question_count():
+    """Returns total number of questions, it may be up to QUESTION_COUNT_TIMEOUT seconds old"""
+    count = cache.get(QUESTION_COUNT_KEY)
+    if count is None:
+        count = Question.objects.count()
+        cache.set(QUESTION_COUNT_KEY, count, settings.QUESTION_COUNT_TIMEOUT)
+    return count
+
+
+def get_version(key):
+    """Returns version stamp of cached content, versions are millisecond timestamps of the last change"""
+    version = cache.get(key)
+    if version is None:
+        version = bump_version(key)
+    return version
+
+
+def bump_version(key):
+    """Marks content as changed, every cache entry built for previous version becomes unreachable"""
+    version = max(int(time.time() * 1000), (cache.get(key) or 0) + 1)
+    cache.set(key, version, None)
+    return version
+
+
+def listing_version():
+    return get_version(LISTING_VERSION_KEY)
+
+
+def question_version(question_id):
+    return get_version(QUESTION_VERSION_KEY % question_id)
+
+
+def tags_version():
+    return get_version(TAGS_VERSION_KEY)
+
+
+def trending_version():
+    """Returns version stamp of trending questions shown on every page, it changes whenever they are recomputed"""
+    get_trending()
+    return get_version(TRENDING_VERSION_KEY)
+
+
+def leaderboard_version():
+    return get_version(LEADERBOARD_VERSION_KEY)
+
+
+def invalidate_leaderboard():
+    after_commit(bump_version, LEADERBOARD_VERSION_KEY)
+
+
+def reputation_version():
+    """Returns version stamp of reputation shown in signatures of authors
+
+    Votes and marks only flag reputation as changed, the stamp follows at most once in REPUTATION_REFRESH seconds,
+    so that a vote does not drop every cached page showing one of the authors
+    """
+    version = get_version(REPUTATION_VERSION_KEY)
+    if cache.get(REPUTATION_CHANGED_KEY) and time.time() * 1000 - version >= settings.REPUTATION_REFRESH * 1000:
+        cache.delete(REPUTATION_CHANGED_KEY)
+        version = bump_version(REPUTATION_VERSION_KEY)
+    return version
+
+
+def reputation_changed():
+    after_commit(cache.set, REPUTATION_CHANGED_KEY, True, None)
+
+
+def invalidate_reputation():
+    after_commit(bump_version, REPUTATION_VERSION_KEY)
+
+
+def related_version():
+    """Returns version stamp of related questions of all question pages, it changes with every rebuild_related run"""
+    return get_version(RELATED_VERSION_KEY)
+
+
+def invalidate_related():
+    after_commit(bump_version, RELATED_VERSION_KEY)
+
+
+def replica_version():
+    """Returns version stamp of the replica read by the current request (0 on the primary), it changes on every sync
+
+    Pages and fragments rendered from a replica are keyed by it, so content it lags behind is not kept under newer
+    versions of the primary after the replica catches up
+    """
+    replica = getattr(routers.state, 'replica', None)
+    return get_version(REPLICA_VERSION_KEY % replica) if replica else 0
+
+
+def invalidate_replica(alias):
+    after_commit(bump_version, REPLICA_VERSION_KEY % alias)
+
+
+def invalidate_tags():
+    after_commit(bump_version, TAGS_VERSION_KEY)
+
+
+def invalidate_listing():
+    after_commit(bump_version, LISTING_VERSION_KEY)
+
+
+def invalidate_question(question_id):
+    after_commit(bump_version, QUESTION_VERSION_KEY % question_id)
+
+
+def make_key(kind, parts):
+    return 'stack:%s:%s' % (kind, hashlib.md5(repr(parts).encode()).hexdigest())
+
+
+def record(kind, hit):
+    stats[kind + (':hit' if hit else ':miss')] += 1
+
+
+def cache_stats():
+    """Returns {kind: (hits, misses)} of page and fragment caches"""
+    kinds = {key.rsplit(':', 1)[0] for key in stats}
+    return {kind: (stats[kind + ':hit'], stats[kind + ':miss']) for kind in kinds}
+
+
+def cache_anonymous_page(key_parts):
+    """Caches rendered page of the view for anonymous users
+
+    key_parts(request, *args, **kwargs) returns everything the page depends on including versions of its content
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if request.method != 'GET' or request.user.is_authenticated:
+                return view(request, *args, **kwargs)
+
+            key = make_key('page', (view.__name__, key_parts(request, *args, **kwargs), replica_version()))
+            content = cache.get(key)
+            record('page', content is not None)
+            if content is not None:
+                response = HttpResponse(content)
+                response['X-Page-Cache'] = 'hit'
+                return response
+
+            response = view(request, *args, **kwargs)
+            if response.status_code == 200 and not response.streaming:
+                cache.set(key, response.content, settings.PAGE_CACHE_TIMEOUT)
+            response['X-Page-Cache'] = 'miss'
+            return response
+        return wrapper
+    return decorator
+
+
+def csrf_secret(request):
+    """Returns CSRF secret of the client, on its first request the one made for the response cookie"""
+    get_token(request)
+    return request.META['CSRF_COOKIE']
+
+
+def viewer(request):
+    """Returns what makes the page of the same content differ between users: account, avatar and csrf token"""
+    user = request.user
+    if user.is_authenticated:
+        return user.pk, user.username, user.image.name, request.META.get('CSRF_COOKIE')
+    return None, request.META.get('CSRF_COOKIE')
+
+
+def conditional_page(validators):
+    """Answers conditional GET of the view with 304 Not Modified before the view runs
+
+    validators(request, *args, **kwargs) returns (versions, key_parts): version stamps of the shown content and
+    everything else the page depends on. ETag is built of them, the viewer and the replica read, Last-Modified of
+    the latest version.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if request.method not in ('GET', 'HEAD'):
+                return view(request, *args, **kwargs)
+
+            versions, key_parts = validators(request, *args, **kwargs)
+            versions = tuple(versions) + (replica_version(),)
+            etag = quote_etag(hashlib.md5(repr((view.__name__, versions, key_parts, viewer(request))).encode())
+                              .hexdigest())
+            last_modified = max(versions) // 1000
+            response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+            record('conditional', response is not None)
+            if response is None:
+                response = view(request, *args, **kwargs)
+                if response.status_code != 200:
+                    return response
+                response['ETag'] = etag
+                response['Last-Modified'] = http_date(last_modified)
+            patch_vary_headers(response, ('Cookie',))
+            if request.user.is_authenticated:
+                patch_cache_control(response, no_cache=True, private=True)
+            else:
+                patch_cache_control(response, no_cache=True)
+            return response
+        return wrapper
+    return decorator
+
+
+def cached_fragment(key_parts, render, timeout=None):
+    """Returns HTML fragment from cache, render() builds it on miss (it may return several fragments in a tuple)
+
+    Fragments live FRAGMENT_CACHE_TIMEOUT seconds unless timeout is given
+    """
+    key = make_key('fragment', (key_parts, replica_version()))
+    fragment = cache.get(key)
+    record('fragment', fragment is not None)
+    if fragment is None:
+        fragment = render()
+        cache.set(key, fragment, timeout or settings.FRAGMENT_CACHE_TIMEOUT)
+    if isinstance(fragment, tuple):
+        return tuple(mark_safe(part) for part in fragment)
+    return mark_safe(fragment)
@@ -0,0 +1,18 @@
+from django.conf import settings
+from django.core.checks import Error, Tags, register
+
+# backends keeping entries in memory of each process
+PROCESS_LOCAL_CACHES = ('django.core.cache.backends.locmem.LocMemCache',)
+
+
+@register(Tags.caches, deploy=True)
+def check_shared_cache(app_configs, **kwargs):
+    """Version stamps behind cached pages, fragments and ETags are kept in the default cache, so every process
+    has to see the bumps of the others"""
+    if settings.CACHES['default']['BACKEND'] in PROCESS_LOCAL_CACHES:
+        return [Error("The default cache is local to each process, cached pages and ETags of one worker are not "
+                      "invalidated by writes handled by the others",
+                      hint="Use a shared backend (memcached, redis, database) or silence stack.E001 when the site "
+                           "runs in a single process",
+                      id='stack.E001')]
+    return []
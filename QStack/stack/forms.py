@@ -1,12 +1,13 @@
 from django import forms
 from django.contrib.auth.forms import UserCreationForm, UserChangeForm
 from django.contrib.auth import get_user_model
-from django.core.files.images import get_image_dimensions
-from django.core.mail import EmailMessage
 from django.template.loader import render_to_string
 from django.conf import settings
+from django.db.models.fields.files import FieldFile
 from django.utils.http import urlsafe_base64_encode, force_bytes
 
+from .avatars import validate_avatar
+from .mail import enqueue_mail
 from .tokens import account_activation_token
 
 
@@ -51,49 +52,16 @@ class CustomUserCreationForm(UserCreationForm):
                                      'user_id': urlsafe_base64_encode(force_bytes(user.pk)).decode(),
                                      'token': account_activation_token.make_token(user)})
 
-            msg = EmailMessage(subject, mail, '%(site)s <%(email)s>' % {
+            enqueue_mail(subject, mail, [user.email], '%(site)s <%(email)s>' % {
                 'site': settings.SITE_NAME, 'email': settings.DEFAULT_FROM_EMAIL
-            }, [user.email])
-
-            msg.content_subtype = "html"
-            msg.send()
+            }, html=True)
 
         return user
 
     def clean_image(self):
         image = self.cleaned_data['image']
-
-        if not image:
-            return
-
-        try:
-            w, h = get_image_dimensions(image)
-
-            # validate dimensions
-            max_width = max_height = 1000
-            if w > max_width or h > max_height:
-                raise forms.ValidationError(
-                    u'Please use an image that is '
-                    '%s x %s pixels or smaller.' % (max_width, max_height))
-
-            # validate content type
-            main, sub = image.content_type.split('/')
-            if not (main == 'image' and sub in ['jpeg', 'pjpeg', 'gif', 'png']):
-                raise forms.ValidationError(u'Please use a JPEG, '
-                                            'GIF or PNG image.')
-
-            # validate file size
-            if len(image) > (120 * 1024):
-                raise forms.ValidationError(
-                    u'Avatar file size may not exceed 20k.')
-
-        except AttributeError:
-            """
-            Handles case when we are updating the user profile
-            and do not supply a new avatar
-            """
-            pass
-
+        if image:
+            validate_avatar(image)
         return image
 
 
@@ -113,3 +81,9 @@ class CustomUserChangeForm(UserChangeForm):
 
     def clean_password(self):
         return ""
+
+    def clean_image(self):
+        image = self.cleaned_data['image']
+        if image and not isinstance(image, FieldFile):
+            validate_avatar(image)
+        return image
@@ -0,0 +1,83 @@
+import datetime
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.db import transaction
+from django.utils import timezone
+
+from .models import OutgoingEmail
+
+
+def enqueue_mail(subject, body, recipients, from_email=None, html=False):
+    """Puts message into the outbox, it is sent later by send_queued_mail command"""
+    return OutgoingEmail.objects.create(subject=subject, body=body, recipients='\n'.join(recipients),
+                                        from_email=from_email or settings.DEFAULT_FROM_EMAIL, html=html)
+
+
+def due_messages(now, batch_size):
+    return list(OutgoingEmail.objects.filter(sent_at__isnull=True, attempts__lt=settings.MAIL_MAX_ATTEMPTS,
+                                             next_attempt_at__lte=now).order_by('next_attempt_at')[:batch_size])
+
+
+def claim_batch(batch_size):
+    """Returns due messages leasing them for MAIL_LEASE seconds so other workers skip them
+
+    A message is leased only if it still has the next_attempt_at it was read with, so messages another worker
+    claimed after the read are left to it
+    """
+    now = timezone.now()
+    lease = now + datetime.timedelta(seconds=settings.MAIL_LEASE)
+    with transaction.atomic():
+        return [message for message in due_messages(now, batch_size)
+                if OutgoingEmail.objects.filter(pk=message.pk, next_attempt_at=message.next_attempt_at)
+                .update(next_attempt_at=lease)]
+
+
+def retry_delay(attempts):
+    """Exponential backoff after given number of failed attempts"""
+    return datetime.timedelta(seconds=settings.MAIL_RETRY_DELAY * 2 ** (attempts - 1))
+
+
+def postpone(batch, error):
+    """Gives claimed messages back when the mail server cannot be reached, the outage does not use up their attempts"""
+    for message in batch:
+        message.last_error = repr(error)
+        message.next_attempt_at = timezone.now() + retry_delay(message.attempts + 1)
+        message.save(update_fields=['last_error', 'next_attempt_at'])
+
+
+def send_queued_mail(batch_size=100):
+    """Sends one batch of due messages over a single connection, returns numbers of sent and failed messages"""
+    batch = claim_batch(batch_size)
+    if not batch:
+        return 0, 0
+
+    sent = failed = 0
+    connection = get_connection()
+    try:
+        connection.open()
+    except Exception as e:
+        postpone(batch, e)
+        return 0, len(batch)
+    try:
+        for message in batch:
+            email = EmailMessage(message.subject, message.body, message.from_email, message.get_recipients(),
+                                 connection=connection)
+            if message.html:
+                email.content_subtype = "html"
+            try:
+                email.send()
+            except Exception as e:
+                message.attempts += 1
+                message.last_error = repr(e)
+                message.next_attempt_at = timezone.now() + retry_delay(message.attempts)
+                message.save(update_fields=['attempts', 'last_error', 'next_attempt_at'])
+                failed += 1
+            else:
+                message.attempts += 1
+                message.sent_at = timezone.now()
+                message.save(update_fields=['attempts', 'sent_at'])
+                sent += 1
+    finally:
+        connection.close()
+    return sent, failed
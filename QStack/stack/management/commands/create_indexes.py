@@ -0,0 +1,75 @@
+from django.apps import apps
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from stack.recompute import recompute_hot_scores, recompute_question_stats, recompute_reputation, recompute_tag_counts
+
+# stored statistics recomputed when any of their columns has just been added ('model.field'), in this order;
+# related_stale is added set, so the next rebuild_related run picks up all questions
+BACKFILLS = (
+    (('question.answer_count', 'question.accepted_answer', 'question.last_activity_at'), recompute_question_stats),
+    (('question.answer_count', 'question.hot_score'), recompute_hot_scores),
+    (('user.reputation',), recompute_reputation),
+    (('tag.question_count',), recompute_tag_counts),
+)
+
+
+def add_column(editor, model, field):
+    """Adds column of the field filled with its default value by ALTER TABLE, returns number of its created indexes
+
+    SQLite schema editor of Django rebuilds the whole table instead and its rename breaks references of other tables
+    """
+    definition, _ = editor.column_sql(model, field)
+    default = editor.effective_default(field)
+    if default is not None:
+        definition += ' DEFAULT %s' % editor.quote_value(default)
+    if field.remote_field:
+        definition += ' ' + editor.sql_create_inline_fk % {
+            'to_table': editor.quote_name(field.target_field.model._meta.db_table),
+            'to_column': editor.quote_name(field.target_field.column),
+        }
+    editor.execute('ALTER TABLE %s ADD COLUMN %s %s' % (editor.quote_name(model._meta.db_table),
+                                                         editor.quote_name(field.column), definition))
+    indexes = editor._field_indexes_sql(model, field)
+    for sql in indexes:
+        editor.execute(sql)
+    return len(indexes)
+
+
+class Command(BaseCommand):
+    help = ('Adds columns and creates indexes declared by models of the app missing in an existing database and '
+            'backfills stored statistics of added columns (the app has no migrations)')
+
+    def handle(self, *args, **options):
+        added, created = [], 0
+        with connection.schema_editor() as editor:
+            for model in apps.get_app_config('stack').get_models():
+                with connection.cursor() as cursor:
+                    existing = {column.name for column in
+                               connection.introspection.get_table_description(cursor, model._meta.db_table)}
+                for field in model._meta.local_concrete_fields:
+                    if field.column not in existing:
+                        if connection.vendor == 'sqlite':
+                            created += add_column(editor, model, field)
+                        else:
+                            editor.add_field(model, field)
+                        added.append('%s.%s' % (model._meta.model_name, field.name))
+
+                with connection.cursor() as cursor:
+                    constraints = connection.introspection.get_constraints(cursor, model._meta.db_table)
+                indexed = {tuple(constraint['columns']) for constraint in constraints.values() if constraint['index']}
+                for fields in model._meta.index_together:
+                    columns = tuple(model._meta.get_field(field).column for field in fields)
+                    if columns not in indexed:
+                        editor.alter_index_together(model, [], [fields])
+                        created += 1
+                for index in model._meta.indexes:
+                    if index.name not in constraints:
+                        editor.add_index(model, index)
+                        created += 1
+
+        for fields, recompute in BACKFILLS:
+            if set(fields) & set(added):
+                recompute()
+        self.stdout.write(self.style.SUCCESS('Added %d columns: %s' % (len(added), ', '.join(added) or '-')))
+        self.stdout.write(self.style.SUCCESS('Created %d indexes' % created))
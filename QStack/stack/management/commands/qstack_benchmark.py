@@ -0,0 +1,47 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from stack.benchmark import run_benchmark
+
+
+class Command(BaseCommand):
+    help = 'Measures latency and query counts of the main pages on seeded test databases of several sizes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='1000,10000',
+                            help='Comma separated numbers of questions of measured datasets')
+        parser.add_argument('--repeat', type=int, default=50, help='Number of measured requests per scenario')
+        parser.add_argument('--seed', type=int, default=0, help='Random seed of datasets and traffic')
+        parser.add_argument('--scenario', action='append', dest='scenarios',
+                            help='Measure only given scenario (can be repeated)')
+        parser.add_argument('--write-threads', type=int, default=0,
+                            help='Number of concurrent writers of the SQLite write load test, 0 skips it')
+        parser.add_argument('--writes', type=int, default=50, help='Number of writes of every writer')
+        parser.add_argument('--output', help='File the JSON report is written to, stdout if omitted')
+
+    def handle(self, *args, **options):
+        sizes = [int(size) for size in options['sizes'].split(',')]
+        report = run_benchmark(sizes, options['repeat'], options['seed'], options['scenarios'],
+                               log=self.stderr.write, write_threads=options['write_threads'],
+                               writes=options['writes'])
+
+        for run in report['runs']:
+            self.stderr.write('%d questions' % run['size'])
+            for name, result in sorted(run['scenarios'].items()):
+                self.stderr.write('  %-16s p50 %8.2fms  p95 %8.2fms  %3d queries' % (
+                    name, result['p50_ms'], result['p95_ms'], result['queries_p50']))
+            for name, result in sorted(run['tag_queries'].items()):
+                self.stderr.write('  %-16s p50 %8.2fms  p95 %8.2fms  (first page of tag:a tag:b -tag:c)' % (
+                    name, result['p50_ms'], result['p95_ms']))
+            for name, result in sorted(run.get('write_load', {}).items()):
+                self.stderr.write('  %-16s %8.1f writes/s  %4d failed  read p95 %8.2fms  (%d writers)' % (
+                    name, result['writes_per_second'], result['failed'], result['read_p95_ms'] or 0,
+                    options['write_threads']))
+
+        output = json.dumps(report, indent=2, sort_keys=True)
+        if options['output']:
+            with open(options['output'], 'w') as stream:
+                stream.write(output + '\n')
+        else:
+            self.stdout.write(output)
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from stack.transfer import CHUNK_SIZE, export_ndjson
+
+
+class Command(BaseCommand):
+    help = 'Streams users, tags, questions, answers and votes as NDJSON (one record per line)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', nargs='?', default='-', help='Output file, "-" for stdout')
+        parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE,
+                            help='Number of rows read per query')
+
+    def handle(self, *args, **options):
+        if options['path'] == '-':
+            export_ndjson(self.stdout, chunk_size=options['chunk_size'])
+            return
+        with open(options['path'], 'w', encoding='utf-8') as stream:
+            count = export_ndjson(stream, chunk_size=options['chunk_size'])
+        self.stderr.write('Exported %d records' % count)
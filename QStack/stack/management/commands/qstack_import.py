@@ -0,0 +1,29 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from stack.transfer import CHUNK_SIZE, TransferError, import_ndjson
+
+
+class Command(BaseCommand):
+    help = 'Loads NDJSON written by qstack_export in bulk chunks and recomputes counts at the end'
+    stealth_options = ('stdin',)
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', nargs='?', default='-', help='Input file, "-" for stdin')
+        parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE,
+                            help='Number of records of one kind stored per bulk insert')
+        parser.add_argument('--no-index', action='store_false', dest='index',
+                            help='Skip rebuilding the search index')
+
+    def handle(self, *args, **options):
+        try:
+            if options['path'] == '-':
+                counts = import_ndjson(options.get('stdin', sys.stdin), options['chunk_size'], options['index'])
+            else:
+                with open(options['path'], encoding='utf-8') as stream:
+                    counts = import_ndjson(stream, options['chunk_size'], options['index'])
+        except TransferError as e:
+            raise CommandError(str(e))
+        self.stdout.write(self.style.SUCCESS(
+            'Imported ' + ', '.join('%d %s' % (count, model) for model, count in counts.items())))
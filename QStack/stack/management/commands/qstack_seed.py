@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from stack.seeding import dataset, seed
+from stack.transfer import CHUNK_SIZE
+
+
+class Command(BaseCommand):
+    help = 'Generates synthetic users, questions, answers, tags and votes with Zipfian popularity'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--size', type=int, default=1000,
+                            help='Number of questions, other counts keep typical proportions unless given')
+        for name in ('users', 'questions', 'answers', 'tags', 'votes'):
+            parser.add_argument('--' + name, type=int, help='Number of %s to generate' % name)
+        parser.add_argument('--exponent', type=float, default=1.1, help='Exponent of the Zipfian distribution')
+        parser.add_argument('--seed', type=int, help='Random seed making the dataset reproducible')
+        parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE,
+                            help='Number of records of one kind stored per bulk insert')
+        parser.add_argument('--no-index', action='store_false', dest='index',
+                            help='Skip rebuilding the search index')
+
+    def handle(self, *args, **options):
+        counts = dataset(options['size'])
+        counts.update({name: options[name] for name in counts if options[name] is not None})
+        try:
+            created = seed(exponent=options['exponent'], random_seed=options['seed'],
+                           chunk_size=options['chunk_size'], index=options['index'], **counts)
+        except ValueError as e:
+            raise CommandError(str(e))
+        self.stdout.write(self.style.SUCCESS(
+            'Generated ' + ', '.join('%d %s' % (count, model) for model, count in created.items())))
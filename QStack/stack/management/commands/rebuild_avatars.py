@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+
+from stack.avatars import content_name, is_content_named, make_thumbnails
+from stack.models import User
+
+
+class Command(BaseCommand):
+    help = 'Moves avatars uploaded before thumbnails to content based names and creates missing thumbnails'
+
+    def handle(self, *args, **options):
+        moved = 0
+        for user in User.objects.exclude(image='').exclude(image__isnull=True).iterator():
+            if is_content_named(user.image.name):
+                make_thumbnails(user.image.name)
+                continue
+            if not user.image.storage.exists(user.image.name):
+                self.stderr.write('Missing avatar of %s: %s' % (user.username, user.image.name))
+                continue
+            with user.image.open('rb') as original:
+                name = content_name(original, user.image.name)
+                if not user.image.storage.exists(name):
+                    name = user.image.storage.save(name, original)
+            user.image.name = name
+            user.save(update_fields=['image'])
+            moved += 1
+        self.stdout.write(self.style.SUCCESS('Moved %d avatars' % moved))
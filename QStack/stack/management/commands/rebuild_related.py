@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from stack.caching import invalidate_related
+
+
+class Command(BaseCommand):
+    help = 'Stores most similar questions of every question by TF-IDF of their headers, content and tags'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--incremental', action='store_true',
+                            help='update only questions changed since the last run and questions they are similar to')
+        parser.add_argument('--block-entries', type=int, default=None,
+                            help='most similarities computed at once, RELATED_BLOCK_ENTRIES by default')
+
+    def handle(self, *args, **options):
+        try:
+            from stack.related import rebuild_related
+        except ImportError as e:
+            raise CommandError('Related questions need numpy and scipy (pip install numpy scipy): %s' % e)
+        updated = rebuild_related(incremental=options['incremental'], entries=options['block_entries'])
+        if updated:
+            invalidate_related()
+        self.stdout.write(self.style.SUCCESS('Updated related questions of %d questions' % updated))
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from stack.search import rebuild_index
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds search index of questions and answers from scratch'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000,
+                            help='Number of questions/answers indexed per transaction')
+
+    def handle(self, *args, **options):
+        postings = rebuild_index(chunk_size=options['chunk_size'])
+        self.stdout.write(self.style.SUCCESS('Search index rebuilt: %d postings' % postings))
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from stack.recompute import recompute_hot_scores, recompute_question_stats, recompute_tag_counts
+
+
+class Command(BaseCommand):
+    help = ('Recomputes stored answer count, accepted answer, last activity and hot score of every question '
+            'and number of questions of every tag')
+
+    def handle(self, *args, **options):
+        updated = recompute_question_stats()
+        recompute_hot_scores()
+        tags = recompute_tag_counts()
+        self.stdout.write(self.style.SUCCESS('Reconciled %d questions and %d tags' % (updated, tags)))
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from stack.caching import invalidate_leaderboard, invalidate_reputation
+from stack.recompute import recompute_reputation
+
+
+class Command(BaseCommand):
+    help = 'Recomputes reputation of every user from votes on their questions and answers and accepted answers'
+
+    def handle(self, *args, **options):
+        updated = recompute_reputation()
+        invalidate_leaderboard()
+        invalidate_reputation()
+        self.stdout.write(self.style.SUCCESS('Reconciled reputation of %d users' % updated))
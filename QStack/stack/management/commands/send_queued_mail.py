@@ -0,0 +1,29 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from stack.mail import send_queued_mail
+
+
+class Command(BaseCommand):
+    help = 'Sends messages waiting in the outbox, retrying failed ones with exponential backoff'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100,
+                            help='Number of messages sent over one connection')
+        parser.add_argument('--loop', action='store_true',
+                            help='Keep polling the outbox instead of exiting when it is drained')
+        parser.add_argument('--interval', type=float, default=5,
+                            help='Seconds to wait between polls of an empty outbox in loop mode')
+
+    def handle(self, *args, **options):
+        while True:
+            sent, failed = send_queued_mail(batch_size=options['batch_size'])
+            if sent or failed:
+                self.stdout.write('Sent %d, failed %d' % (sent, failed))
+            if sent or (failed and not options['loop']):
+                continue
+            if not options['loop']:
+                break
+            # outbox is drained or nothing could be sent (mail server is down)
+            time.sleep(options['interval'])
@@ -0,0 +1,34 @@
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from stack.caching import invalidate_replica
+
+
+class Command(BaseCommand):
+    help = 'Copies the primary SQLite database into local replicas (development stand-in for replication)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('aliases', nargs='*', help='replicas to refresh, all of DATABASES except default by default')
+
+    def handle(self, *args, **options):
+        primary = connections[DEFAULT_DB_ALIAS]
+        if primary.vendor != 'sqlite':
+            raise CommandError('Only SQLite databases can be copied, use replication of your database server')
+        aliases = options['aliases'] or [alias for alias in settings.DATABASES if alias != DEFAULT_DB_ALIAS]
+        for alias in aliases:
+            if alias not in settings.DATABASES or alias == DEFAULT_DB_ALIAS:
+                raise CommandError('Unknown replica: %s' % alias)
+            name = settings.DATABASES[alias]['NAME']
+            connections[alias].close()
+            # VACUUM INTO writes a consistent snapshot, the replica is swapped for it at once
+            snapshot = name + '.sync'
+            if os.path.exists(snapshot):
+                os.remove(snapshot)
+            with primary.cursor() as cursor:
+                cursor.execute('VACUUM INTO %s', [snapshot])
+            os.replace(snapshot, name)
+            invalidate_replica(alias)
+            self.stdout.write(self.style.SUCCESS('Copied %s into %s' % (primary.settings_dict['NAME'], name)))
@@ -0,0 +1,202 @@
+import threading
+import time
+from bisect import bisect_left
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.db import connections
+from django.template.backends import django as django_backend
+
+from .caching import cache_stats
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+# scrapers allowed without METRICS_ALLOWED_IPS
+LOCAL_ADDRESSES = ('127.0.0.1', '::1')
+
+lock = threading.Lock()
+local = threading.local()
+
+
+class Metric(object):
+    """In-process metric, series are keyed by tuples of label values"""
+    kind = None
+
+    def __init__(self, name, description, labels):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.series = {}
+
+    def header(self):
+        return ['# HELP %s %s' % (self.name, self.description), '# TYPE %s %s' % (self.name, self.kind)]
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, labels, value=1):
+        with lock:
+            self.series[labels] = self.series.get(labels, 0) + value
+
+    def expose(self):
+        lines = self.header()
+        for labels, value in sorted(self.series.items()):
+            lines.append('%s%s %s' % (self.name, format_labels(self.labels, labels), format_value(value)))
+        return lines
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, description, labels, buckets):
+        super(Histogram, self).__init__(name, description, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, labels, value):
+        with lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][bisect_left(self.buckets, value)] += 1
+            series[1] += value
+
+    def expose(self):
+        lines = self.header()
+        for labels, (counts, total) in sorted(self.series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append('%s_bucket%s %d' % (self.name, format_labels(self.labels + ('le',),
+                                                                           labels + (format_value(bound),)),
+                                                 cumulative))
+            lines.append('%s_sum%s %s' % (self.name, format_labels(self.labels, labels), format_value(total)))
+            lines.append('%s_count%s %d' % (self.name, format_labels(self.labels, labels), cumulative))
+        return lines
+
+
+def format_value(value):
+    return value if isinstance(value, str) else repr(value)
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in values)
+    return '{%s}' % ','.join('%s="%s"' % (name, value) for name, value in zip(names, escaped))
+
+
+request_duration = Histogram('qstack_request_duration_seconds', 'Time spent handling requests.',
+                             ('view',), LATENCY_BUCKETS)
+responses = Counter('qstack_responses_total', 'Responses by status code.', ('view', 'status'))
+db_queries = Histogram('qstack_db_queries', 'Database queries executed per request.', ('view',), QUERY_BUCKETS)
+db_duration = Histogram('qstack_db_duration_seconds', 'Time spent in database queries per request.',
+                        ('view',), LATENCY_BUCKETS)
+template_duration = Histogram('qstack_template_render_seconds', 'Time spent rendering templates per request.',
+                              ('view',), LATENCY_BUCKETS)
+REQUEST_METRICS = (request_duration, responses, db_queries, db_duration, template_duration)
+
+
+class RequestMetrics(object):
+    """Database and template costs collected while one request is handled"""
+
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+        self.template_time = 0.0
+
+    def track_query(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.db_time += time.perf_counter() - start
+            self.queries += 1
+
+
+def instrument_templates():
+    """Makes rendering of templates account its time to the request being handled (done once per process)"""
+    render = django_backend.Template.render
+    if getattr(render, 'instrumented', False):
+        return
+
+    def timed_render(self, context=None, request=None):
+        state = getattr(local, 'state', None)
+        if state is None:
+            return render(self, context, request)
+        start = time.perf_counter()
+        try:
+            return render(self, context, request)
+        finally:
+            state.template_time += time.perf_counter() - start
+
+    timed_render.instrumented = True
+    django_backend.Template.render = timed_render
+
+
+def view_label(request):
+    """Returns URL name of the resolved view ('stack:index', 'stack:detail', ...)"""
+    match = getattr(request, 'resolver_match', None)
+    return match.view_name if match is not None else 'unresolved'
+
+
+def record_request(view, status, duration, state):
+    request_duration.observe((view,), duration)
+    responses.inc((view, str(status)))
+    db_queries.observe((view,), state.queries)
+    db_duration.observe((view,), state.db_time)
+    template_duration.observe((view,), state.template_time)
+
+
+class MetricsMiddleware(object):
+    """Records latency, database and template costs of every request labelled by URL name"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        instrument_templates()
+
+    def __call__(self, request):
+        state = local.state = RequestMetrics()
+        start = time.perf_counter()
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(state.track_query))
+                response = self.get_response(request)
+        finally:
+            local.state = None
+        record_request(view_label(request), response.status_code, time.perf_counter() - start, state)
+        return response
+
+
+def cache_metrics():
+    """Returns page and fragment cache counters collected by caching.record"""
+    lookups = Counter('qstack_cache_requests_total', 'Page and fragment cache lookups.', ('cache', 'result'))
+    ratio = Gauge('qstack_cache_hit_ratio', 'Share of cache lookups served from the cache.', ('cache',))
+    for kind, (hits, misses) in cache_stats().items():
+        lookups.series[(kind, 'hit')] = hits
+        lookups.series[(kind, 'miss')] = misses
+        ratio.series[(kind,)] = hits / (hits + misses) if hits + misses else 0.0
+    return lookups.expose() + ratio.expose()
+
+
+def render_metrics():
+    """Returns all metrics of this process in Prometheus text exposition format"""
+    lines = []
+    with lock:
+        for metric in REQUEST_METRICS:
+            lines.extend(metric.expose())
+    lines.extend(cache_metrics())
+    return '\n'.join(lines) + '\n'
+
+
+def metrics_allowed(request):
+    """Metrics are served to METRICS_ALLOWED_IPS, only to the local host when it is not set"""
+    allowed = getattr(settings, 'METRICS_ALLOWED_IPS', None)
+    if allowed is None:
+        allowed = LOCAL_ADDRESSES
+    return request.META.get('REMOTE_ADDR') in allowed
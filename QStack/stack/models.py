@@ -1,12 +1,16 @@
 import datetime
-import os
 
-from django.db import models
+from django.conf import settings
+from django.db import models, transaction
+from django.db.models import BooleanField, Case, F, Value, When
 from django.utils import timezone
 from django.contrib.auth.models import AbstractUser, UserManager
 from django.contrib.auth import get_user_model
 from django.core.exceptions import ValidationError
-from django.db import IntegrityError
+from django.dispatch import Signal
+
+from .avatars import avatar_url, content_name
+from .sqlite import write_transaction
 
 
 class NewUserManager(UserManager):
@@ -47,7 +51,8 @@ class NewUserManager(UserManager):
 
 
 def get_image_path(instance, filename):
-    return os.path.join('photos', str(instance.id), filename)
+    """Stores avatars under hash of their content, so their URLs never change and can be cached forever"""
+    return content_name(instance.image, filename)
 
 
 def prohibit_empty(val):
@@ -60,6 +65,8 @@ class User(AbstractUser):
     image = models.ImageField(upload_to=get_image_path, blank=True, null=True)
     is_active = models.BooleanField(default=True,
                                     verbose_name="Active")
+    # maintained by votes and accepted answers, see Votable.reward_author
+    reputation = models.IntegerField(default=0)
 
     objects = NewUserManager()
 
@@ -69,16 +76,118 @@ class User(AbstractUser):
     def __str__(self):
         return self.email
 
+    def get_avatar_url(self, size=None):
+        """Returns URL of the avatar thumbnail (the smallest one by default)"""
+        if self.image:
+            return avatar_url(self.image, size or settings.AVATAR_SIZES[0])
+
+    def get_large_avatar_url(self):
+        return self.get_avatar_url(settings.AVATAR_SIZES[-1])
+
+    class Meta(AbstractUser.Meta):
+        # leaderboard pages (USER_KEYS)
+        index_together = [('reputation', 'id')]
+
+
+# sent inside the voting transaction after votes count of a question/answer has changed
+votes_changed = Signal(providing_args=['instance', 'user', 'delta'])
+
+
+class Votable(object):
+    """Voting shared by questions and answers, vote_relation names reverse relation to their votes
+
+    vote_points gives reputation the author earns for an up and a down vote, refreshed_fields are read back
+    together with the new votes count
+    """
+    vote_relation = None
+    vote_points = {}
+    refreshed_fields = ['votes']
+
+    def get_vote_set(self):
+        return getattr(self, self.vote_relation)
+
+    @write_transaction
+    def vote(self, user, rate_sign):
+        """Casts up (True) or down (False) vote of the user in a single transaction
+
+        Voting again in the same direction cancels the vote, voting in the opposite one switches it.
+        Returns new votes count and vote state of the user ('up', 'down' or None)
+        """
+        sign = 1 if rate_sign else -1
+        # run_write has started the transaction, a savepoint would only add two statements to every vote
+        with transaction.atomic(savepoint=False):
+            # starts with a write, so concurrent voters queue up instead of failing to upgrade a read lock
+            user_votes = self.get_vote_set().filter(user=user)
+            if user_votes.filter(rate_sign=not rate_sign).update(rate_sign=rate_sign):
+                delta, previous, state = 2 * sign, "down" if rate_sign else "up", "up" if rate_sign else "down"
+            elif user_votes.delete()[0]:
+                delta, previous, state = -sign, "up" if rate_sign else "down", None
+            else:
+                self.get_vote_set().create(user=user, rate_sign=rate_sign)
+                delta, previous, state = sign, None, "up" if rate_sign else "down"
+            self.change_votes(delta, user)
+            self.reward_author(previous, state)
+        return self.votes, state
+
+    def upvote(self, user):
+        return self.vote(user, True)
+
+    def downvote(self, user):
+        return self.vote(user, False)
+
+    @write_transaction
+    def cancel_vote(self, user):
+        """Removes vote of the user, returns new votes count"""
+        with transaction.atomic(savepoint=False):
+            user_votes = self.get_vote_set().filter(user=user)
+            if user_votes.filter(rate_sign=True).delete()[0]:
+                self.change_votes(-1, user)
+                self.reward_author("up", None)
+            elif user_votes.delete()[0]:
+                self.change_votes(1, user)
+                self.reward_author("down", None)
+        return self.votes
+
+    def change_votes(self, delta, user=None):
+        """Adds delta to votes count in the database and reloads the count with other refreshed_fields"""
+        self.votes = F('votes') + delta
+        self.save(update_fields=['votes'])
+        self.refresh_from_db(fields=self.refreshed_fields)
+        votes_changed.send(sender=type(self), instance=self, user=user, delta=delta)
+
+    def reward_author(self, previous, state):
+        """Changes reputation of the author by points of the new vote state less points of the previous one"""
+        points = self.vote_points.get(state, 0) - self.vote_points.get(previous, 0)
+        if points and self.user_id:
+            User.objects.filter(pk=self.user_id).update(reputation=F('reputation') + points)
+
+    def is_voted(self, user):
+        return self.get_vote_set().filter(user=user).exists()
 
-class Answer(models.Model):
+    def check_vote(self, user):
+        rate_sign = self.get_vote_set().filter(user=user).values_list('rate_sign', flat=True).first()
+        if rate_sign is None:
+            return 'was not voted or the vote has been cancelled'
+        return "up" if rate_sign else "down"
+
+    def get_votes_count(self):
+        return self.get_vote_set().count()
+
+
+class Answer(Votable, models.Model):
     id = models.AutoField(primary_key=True)
     content = models.CharField(max_length=15000, null=False, blank=False, validators=[prohibit_empty])
-    pub_date = models.DateTimeField(auto_now_add=True)
+    pub_date = models.DateTimeField(default=timezone.now, editable=False)
     correctness = models.BooleanField(default=False)
     question = models.ForeignKey("Question", null=True, blank=True, on_delete=models.CASCADE)
     user = models.ForeignKey(get_user_model(), null=True, blank=True, on_delete=models.SET_NULL)
     votes = models.IntegerField(default=0)
 
+    vote_relation = 'answer_vote'
+    vote_points = {'up': 10, 'down': -2}
+    # reputation the author earns while the answer is marked correct
+    accepted_points = 15
+
     def __str__(self):
         return self.content
 
@@ -86,75 +195,57 @@ class Answer(models.Model):
         return self.user.username
 
     def get_author_image(self):
-        if self.user.image:
-            return self.user.image.url
+        return self.user.get_avatar_url()
 
+    @write_transaction
     def change_mark(self):
-        self.correctness = not self.correctness
-        self.save()
-        return self.correctness
-
-    def upvote(self, user):
-        try:
-            self.answer_vote.create(user=user, answer=self, rate_sign=True)
-            self.votes += 1
-            self.save()
-        except IntegrityError:
-            return 'already_upvoted'
-        return 'ok'
+        """Toggles the mark of the answer, returns the new one
 
-    def downvote(self, user):
-        try:
-            self.answer_vote.create(user=user, answer=self, rate_sign=False)
-            self.votes -= 1
-            self.save()
-        except IntegrityError:
-            return 'already_downvoted'
-        return 'ok'
-
-    def cancel_vote(self, user):
-        try:
-            vote = self.answer_vote.filter(user=user, answer=self).first()
-            if vote.rate_sign:
-                self.votes -= 1
-            else:
-                self.votes += 1
-            self.save()
-            vote.delete()
-
-        except IntegrityError:
-            return 'was not voted'
-        return 'ok'
-
-    def is_voted(self, user):
-        votes = self.answer_vote.filter(user=user, answer=self).count()
-        if votes == 0:
-            return False
-        else:
-            return True
-
-    def check_vote(self, user):
-        try:
-            vote = self.answer_vote.filter(user=user, answer=self).first()
-            if vote.rate_sign:
-                return "up"
-            else:
-                return "down"
-        except IntegrityError:
-            return 'was not voted or the vote has been cancelled'
+        The mark is flipped in the database and read back, so a transaction retried on busy database flips it once
+        """
+        with transaction.atomic(savepoint=False):
+            self.correctness = Case(When(correctness=True, then=Value(False)), default=Value(True),
+                                    output_field=BooleanField())
+            self.save(update_fields=['correctness'])
+            self.refresh_from_db(fields=['correctness'])
+            if self.user_id:
+                points = self.accepted_points if self.correctness else -self.accepted_points
+                User.objects.filter(pk=self.user_id).update(reputation=F('reputation') + points)
+            if self.question_id:
+                question = Question.objects.filter(pk=self.question_id)
+                if self.correctness:
+                    question.update(accepted_answer=self, last_activity_at=timezone.now())
+                else:
+                    question.filter(accepted_answer=self).update(accepted_answer=None,
+                                                                 last_activity_at=timezone.now())
+        return self.correctness
 
-    def get_votes_count(self):
-        return self.answer_vote.all().count()
+    class Meta:
+        # answer pages of a question (ANSWER_KEYS) and its accepted answer
+        index_together = [('question', 'votes', 'pub_date', 'id'), ('question', 'correctness')]
 
 
-class Question(models.Model):
+class Question(Votable, models.Model):
     id = models.AutoField(primary_key=True)
     header = models.CharField(max_length=200, null=False, blank=False, validators=[prohibit_empty])
     content = models.CharField(max_length=5000, null=True, blank=True)
-    pub_date = models.DateTimeField(auto_now_add=True)
+    pub_date = models.DateTimeField(default=timezone.now, editable=False)
     user = models.ForeignKey(get_user_model(), null=True, blank=True, on_delete=models.SET_NULL)
     tag = models.ManyToManyField("Tag", blank=True)
     votes = models.IntegerField(default=0)
+    answer_count = models.IntegerField(default=0)
+    accepted_answer = models.ForeignKey("Answer", null=True, blank=True, related_name='+',
+                                        on_delete=models.SET_NULL)
+    last_activity_at = models.DateTimeField(default=timezone.now)
+    # maintained by signals, see ranking.hot_score
+    hot_score = models.FloatField(default=0.0)
+    # set when header, content or tags change, cleared by rebuild_related
+    related_stale = models.BooleanField(default=True, db_index=True)
+
+    vote_relation = 'question_vote'
+    vote_points = {'up': 5, 'down': -2}
+    # hot score of the question is computed from them after every vote
+    refreshed_fields = ['votes', 'answer_count', 'pub_date']
 
     def __str__(self):
         return self.header
@@ -163,71 +254,32 @@ class Question(models.Model):
         return [str(tag) for tag in self.tag.all()]
 
     def get_answers_count(self):
-        return Answer.objects.filter(question__id=self.id).count()
+        return self.answer_count
 
     def get_author(self):
         return self.user.username
 
     def get_author_image(self):
-        if self.user.image:
-            return self.user.image.url
+        return self.user.get_avatar_url()
 
     def was_published_recently(self):
         return self.pub_date >= timezone.now() - datetime.timedelta(days=1)
 
-    def upvote(self, user):
-        try:
-            self.question_vote.create(user=user, question=self, rate_sign=True)
-            self.votes += 1
-            self.save()
-        except IntegrityError as e:
-            print(str(e))
-            return 'already_upvoted'
-        return 'ok'
-
-    def downvote(self, user):
-        try:
-            self.question_vote.create(user=user, question=self, rate_sign=False)
-            self.votes -= 1
-            self.save()
-        except IntegrityError:
-            return 'already_downvoted'
-        return 'ok'
-
-    def cancel_vote(self, user):
-        try:
-            vote = self.question_vote.filter(user=user, question=self).first()
-            if vote.rate_sign:
-                self.votes -= 1
-            else:
-                self.votes += 1
-
-            self.save()
-            vote.delete()
-
-        except IntegrityError:
-            return 'was not voted'
-        return 'ok'
+    class Meta:
+        # question lists by date, by votes and hot ones (ORDER_KEYS) and trending questions
+        index_together = [('pub_date', 'id'), ('votes', 'pub_date', 'id'), ('hot_score', 'id')]
 
-    def is_voted(self, user):
-        votes = self.question_vote.filter(user=user, question=self).count()
-        if votes == 0:
-            return False
-        else:
-            return True
 
-    def check_vote(self, user):
-        try:
-            vote = self.question_vote.filter(user=user, question=self).first()
-            if vote.rate_sign:
-                return "up"
-            else:
-                return "down"
-        except IntegrityError:
-            return 'was not voted or the vote has been cancelled'
+class VoteManager(models.Manager):
 
-    def get_votes_count(self):
-        return self.question_vote.all().count()
+    def state_map(self, user, objects):
+        """Returns {question/answer id: 'up'|'down'} for votes of the user on given objects in a single query"""
+        if not user.is_authenticated:
+            return {}
+        field = self.model.target_field
+        rows = self.filter(user=user, **{field + '__in': [obj.pk for obj in objects]})
+        return {target_id: "up" if rate_sign else "down"
+                for target_id, rate_sign in rows.values_list(field + '_id', 'rate_sign')}
 
 
 class VoteQuestion(models.Model):
@@ -236,6 +288,9 @@ class VoteQuestion(models.Model):
     user = models.ForeignKey(get_user_model(), on_delete=models.PROTECT)
     rate_sign = models.BooleanField()
 
+    target_field = 'question'
+    objects = VoteManager()
+
     def __str__(self):
         if self.rate_sign:
             rate = "up"
@@ -253,6 +308,9 @@ class VoteAnswer(models.Model):
     user = models.ForeignKey(get_user_model(), on_delete=models.PROTECT)
     rate_sign = models.BooleanField()
 
+    target_field = 'answer'
+    objects = VoteManager()
+
     def __str__(self):
         if self.rate_sign:
             rate = "up"
@@ -266,7 +324,67 @@ class VoteAnswer(models.Model):
 
 class Tag(models.Model):
     tag = models.CharField(max_length=50, unique=True)
+    question_count = models.IntegerField(default=0)
 
     def __str__(self):
         return self.tag
 
+    class Meta:
+        # popular tags first, equally used ones by name
+        indexes = [models.Index(fields=['-question_count', 'tag'], name='stack_tag_popular_idx')]
+
+
+class RelatedQuestion(models.Model):
+    """Neighbour of a question by similarity of its text and tags at the given rank, see related.py"""
+    question = models.ForeignKey("Question", related_name='related_questions', db_index=False,
+                                 on_delete=models.CASCADE)
+    related = models.ForeignKey("Question", related_name='+', on_delete=models.CASCADE)
+    rank = models.PositiveSmallIntegerField()
+    score = models.FloatField()
+
+    class Meta:
+        # neighbours of a question in rank order are read from this index only
+        unique_together = [('question', 'rank')]
+
+
+class SearchTerm(models.Model):
+    """Single normalized word of the search index"""
+    term = models.CharField(max_length=50, unique=True)
+
+    def __str__(self):
+        return self.term
+
+
+class SearchPosting(models.Model):
+    """Occurrence of a term in a question (answer is set when the term comes from one of its answers)"""
+    term = models.ForeignKey("SearchTerm", related_name='postings', on_delete=models.CASCADE)
+    question = models.ForeignKey("Question", related_name='search_postings', on_delete=models.CASCADE)
+    answer = models.ForeignKey("Answer", related_name='search_postings', null=True, blank=True,
+                               on_delete=models.CASCADE)
+    weight = models.FloatField()
+
+    class Meta:
+        index_together = [('term', 'question'), ]
+
+
+class OutgoingEmail(models.Model):
+    """Message waiting in the outbox until send_queued_mail worker delivers it"""
+    subject = models.CharField(max_length=255)
+    body = models.TextField()
+    from_email = models.CharField(max_length=254)
+    recipients = models.TextField()
+    html = models.BooleanField(default=False)
+    created_at = models.DateTimeField(auto_now_add=True)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    attempts = models.IntegerField(default=0)
+    sent_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+
+    class Meta:
+        index_together = [('sent_at', 'next_attempt_at'), ]
+
+    def __str__(self):
+        return self.subject + ' --- ' + self.recipients
+
+    def get_recipients(self):
+        return self.recipients.split('\n')
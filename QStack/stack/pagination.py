@@ -0,0 +1,164 @@
+import base64
+import binascii
+import datetime
+import json
+import operator
+from functools import reduce
+
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+
+# keys of keyset pagination for every order of questions/answers, the last key has to be unique
+ORDER_KEYS = {
+    '-pub_date': ('-pub_date', '-id'),
+    '-votes': ('-votes', '-pub_date', '-id'),
+    '-hot_score': ('-hot_score', '-id'),
+}
+ANSWER_KEYS = ('-votes', '-pub_date', '-id')
+SEARCH_KEYS = ('-search_rank', '-id')
+USER_KEYS = ('-reputation', '-id')
+TAG_KEYS = {
+    'popular': ('-question_count', 'tag'),
+    'name': ('tag',),
+}
+
+
+class InvalidCursor(Exception):
+    pass
+
+
+def encode_value(value):
+    if isinstance(value, datetime.datetime):
+        return {'dt': value.isoformat()}
+    return value
+
+
+def decode_value(value):
+    if isinstance(value, dict):
+        value = parse_datetime(value['dt'])
+    elif not isinstance(value, (str, int, float)):
+        raise InvalidCursor(value)
+    if value is None:
+        raise InvalidCursor(value)
+    return value
+
+
+def encode_cursor(keys, values, backwards=False):
+    """Returns opaque url safe token pointing to the item with given key values"""
+    payload = json.dumps({'k': keys, 'v': [encode_value(value) for value in values], 'b': backwards},
+                         separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor, keys):
+    """Returns key values and direction of the token, raises InvalidCursor if it does not fit given keys"""
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode())
+        if tuple(payload['k']) != tuple(keys) or len(payload['v']) != len(keys):
+            raise InvalidCursor(cursor)
+        return [decode_value(value) for value in payload['v']], bool(payload['b'])
+    except (ValueError, TypeError, KeyError, binascii.Error):
+        raise InvalidCursor(cursor)
+
+
+class CursorPage(object):
+    """One page of items with tokens of neighbouring pages"""
+
+    def __init__(self, object_list, next_cursor=None, previous_cursor=None):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    @property
+    def has_other_pages(self):
+        return self.has_next or self.has_previous
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __getitem__(self, index):
+        return self.object_list[index]
+
+
+class CursorPaginator(object):
+    """Keyset paginator, every page is a range scan starting after the boundary item of the previous one
+
+    keys are ordering expressions ('-votes', 'id', ...), the last one has to be unique
+    """
+
+    def __init__(self, queryset, keys, per_page=20):
+        self.queryset = queryset
+        self.keys = tuple(keys)
+        self.per_page = per_page
+
+    def page(self, cursor=None):
+        """Returns page following (or preceding for backward tokens) the item of the cursor, first page if it is invalid"""
+        values, backwards = None, False
+        if cursor:
+            try:
+                values, backwards = self.decode(cursor)
+            except InvalidCursor:
+                pass
+
+        keys = self.keys if not backwards else tuple(reverse_key(key) for key in self.keys)
+        queryset = self.queryset.order_by(*keys)
+        if values is not None:
+            queryset = queryset.filter(after(keys, values))
+        items = list(queryset[:self.per_page + 1])
+        has_more = len(items) > self.per_page
+        items = items[:self.per_page]
+
+        if backwards:
+            items.reverse()
+            has_next, has_previous = True, has_more
+        else:
+            has_next, has_previous = has_more, values is not None
+
+        next_cursor = previous_cursor = None
+        if items and has_next:
+            next_cursor = encode_cursor(self.keys, self.key_values(items[-1]))
+        if items and has_previous:
+            previous_cursor = encode_cursor(self.keys, self.key_values(items[0]), backwards=True)
+        return CursorPage(items, next_cursor, previous_cursor)
+
+    def decode(self, cursor):
+        """Returns values of the cursor converted by fields of the keys, raises InvalidCursor for tampered ones"""
+        values, backwards = decode_cursor(cursor, self.keys)
+        try:
+            return [self.key_field(key).to_python(value) for key, value in zip(self.keys, values)], backwards
+        except (ValidationError, ValueError, TypeError):
+            raise InvalidCursor(cursor)
+
+    def key_field(self, key):
+        name = key.lstrip('-')
+        annotation = self.queryset.query.annotations.get(name)
+        return annotation.output_field if annotation is not None else self.queryset.model._meta.get_field(name)
+
+    def key_values(self, item):
+        return [getattr(item, key.lstrip('-')) for key in self.keys]
+
+
+def reverse_key(key):
+    return key[1:] if key.startswith('-') else '-' + key
+
+
+def after(keys, values):
+    """Returns condition selecting items placed after the item with given key values in given ordering"""
+    conditions = []
+    for i, key in enumerate(keys):
+        equal = {keys[j].lstrip('-'): values[j] for j in range(i)}
+        lookup = key.lstrip('-') + ('__lt' if key.startswith('-') else '__gt')
+        conditions.append(Q(**equal) & Q(**{lookup: values[i]}))
+    return reduce(operator.or_, conditions)
@@ -0,0 +1,184 @@
+import logging
+import os
+import re
+import sys
+from collections import Counter, OrderedDict
+from contextlib import ExitStack, contextmanager
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.template.base import TOKEN_VAR
+
+from . import metrics
+from .metrics import view_label
+
+logger = logging.getLogger(__name__)
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+TEMPLATE_BASE = os.path.join('django', 'template', 'base.py')
+# execute wrappers of the app are not callers of queries
+WRAPPER_FILES = {os.path.abspath(__file__), os.path.abspath(metrics.__file__)}
+
+STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+NUMBER_LITERAL = re.compile(r'\b\d+(?:\.\d+)?\b')
+PLACEHOLDER_LIST = re.compile(r'\(\s*(?:(?:%s|\?)\s*,\s*)*(?:%s|\?)\s*\)')
+SAVEPOINT_NAME = re.compile(r'"s\d+_x\d+"')
+WHITESPACE = re.compile(r'\s+')
+# transactions of a request issue these on every atomic block, they are never a sign of N+1 queries
+TRANSACTION_CONTROL = re.compile(r'^(?:BEGIN|COMMIT|ROLLBACK|SAVEPOINT|RELEASE)\b', re.IGNORECASE)
+# EXPLAIN QUERY PLAN step reading the whole table without an index ('SCAN TABLE t' before SQLite 3.36)
+FULL_SCAN = re.compile(r'^SCAN (?:TABLE )?\w+$')
+
+# a normalised query executed more times than this during one request is reported
+REPEAT_THRESHOLD = 3
+
+
+def fingerprint(sql):
+    """Returns the statement with literals and IN lists replaced, so queries differing only in values match"""
+    sql = STRING_LITERAL.sub('?', sql)
+    sql = SAVEPOINT_NAME.sub('?', sql)
+    sql = NUMBER_LITERAL.sub('?', sql)
+    sql = PLACEHOLDER_LIST.sub('(...)', sql)
+    return WHITESPACE.sub(' ', sql.replace('%s', '?')).strip()
+
+
+def template_location(frame):
+    """Returns 'template:line {% tag %}' of the template node being rendered in the frame or None"""
+    node = frame.f_locals.get('self')
+    token = getattr(node, 'token', None)
+    if token is None:
+        return None
+    origin = getattr(node, 'origin', None)
+    name = getattr(origin, 'template_name', None) or '<string>'
+    if token.token_type == TOKEN_VAR:
+        contents = '{{ %s }}' % token.contents
+    else:
+        contents = '{%% %s %%}' % token.contents
+    return '%s:%s %s' % (name, token.lineno, contents)
+
+
+def find_caller():
+    """Returns description of the innermost template node and application function issuing the query"""
+    template = code = None
+    frame = sys._getframe(2)
+    while frame is not None and (template is None or code is None):
+        filename = frame.f_code.co_filename
+        if code is None and filename.startswith(APP_DIR) and filename not in WRAPPER_FILES:
+            owner = frame.f_locals.get('self')
+            name = frame.f_code.co_name
+            if owner is not None and hasattr(type(owner), name):
+                name = type(owner).__name__ + '.' + name
+            code = '%s.%s:%d' % (os.path.splitext(os.path.relpath(filename, APP_DIR))[0].replace(os.sep, '.'),
+                                 name, frame.f_lineno)
+        elif template is None and filename.endswith(TEMPLATE_BASE) and frame.f_code.co_name == 'render_annotated':
+            template = template_location(frame)
+        frame = frame.f_back
+    return ' <- '.join(location for location in (code, template) if location) or '<unknown>'
+
+
+class QueryRecorder(object):
+    """Collects fingerprints and callers of queries run on all databases while it is active"""
+
+    def __init__(self):
+        self.queries = OrderedDict()
+        self.total = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        key = fingerprint(sql)
+        entry = self.queries.get(key)
+        if entry is None:
+            entry = self.queries[key] = {'count': 0, 'sql': sql, 'params': params, 'callers': Counter()}
+        entry['count'] += 1
+        entry['callers'][find_caller()] += 1
+        self.total += 1
+        return execute(sql, params, many, context)
+
+    @contextmanager
+    def record(self):
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(self))
+            yield self
+
+    def repeated(self, threshold=REPEAT_THRESHOLD):
+        """Returns [(fingerprint, entry)] of queries run more than threshold times, most frequent first
+
+        Transaction control statements are counted in the total only
+        """
+        return sorted(((key, entry) for key, entry in self.queries.items()
+                       if entry['count'] > threshold and not TRANSACTION_CONTROL.match(key)),
+                      key=lambda item: -item[1]['count'])
+
+    def report(self, threshold=REPEAT_THRESHOLD):
+        """Returns every distinct query with its count, callers are listed for those repeated over threshold"""
+        lines = ['%d queries, %d distinct' % (self.total, len(self.queries))]
+        for key, entry in self.queries.items():
+            lines.append('%dx %s' % (entry['count'], key))
+            if entry['count'] > threshold:
+                lines.extend('    %dx from %s' % (count, caller)
+                             for caller, count in entry['callers'].most_common())
+        return '\n'.join(lines)
+
+
+def explain(sql, params=None, using='default'):
+    """Returns steps of SQLite query plan of the statement"""
+    with connections[using].cursor() as cursor:
+        cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+        return [row[-1] for row in cursor.fetchall()]
+
+
+def plan_problems(plan):
+    """Returns steps of the plan scanning a whole table or sorting rows in a temporary B-tree"""
+    return [step for step in plan if FULL_SCAN.match(step) or 'TEMP B-TREE' in step]
+
+
+def query_budget_of(view):
+    return getattr(settings, 'QUERY_BUDGETS', {}).get(view)
+
+
+def violations(recorder, budget=None, threshold=REPEAT_THRESHOLD):
+    """Returns list of problems found in recorded queries: repeated statements and exceeded budget"""
+    problems = ['%d identical queries (%s) from %s' % (entry['count'], key, ', '.join(entry['callers']))
+                for key, entry in recorder.repeated(threshold)]
+    if budget is not None and recorder.total > budget:
+        problems.append('%d queries exceed budget of %d' % (recorder.total, budget))
+    return problems
+
+
+@contextmanager
+def query_budget(max_queries=None, view=None, threshold=REPEAT_THRESHOLD):
+    """Fails the block with AssertionError if it runs a query more than threshold times or exceeds the budget
+
+    The budget is either max_queries or QUERY_BUDGETS entry of given URL name ('stack:index', ...)
+    """
+    if max_queries is None and view is not None:
+        max_queries = query_budget_of(view)
+    recorder = QueryRecorder()
+    with recorder.record():
+        yield recorder
+    problems = violations(recorder, max_queries, threshold)
+    if problems:
+        raise AssertionError('\n'.join(problems) + '\n' + recorder.report(threshold))
+
+
+class QueryCheckMiddleware(object):
+    """Logs repeated queries and exceeded QUERY_BUDGETS of every request, used in DEBUG mode only"""
+
+    def __init__(self, get_response):
+        if not settings.DEBUG:
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+        self.threshold = getattr(settings, 'QUERY_REPEAT_THRESHOLD', REPEAT_THRESHOLD)
+
+    def __call__(self, request):
+        recorder = QueryRecorder()
+        with recorder.record():
+            response = self.get_response(request)
+        view = view_label(request)
+        problems = violations(recorder, query_budget_of(view), self.threshold)
+        if problems:
+            logger.warning('%s %s (%s): %s\n%s', request.method, request.path, view, '; '.join(problems),
+                           recorder.report(self.threshold))
+        response['X-Query-Count'] = str(recorder.total)
+        return response
@@ -0,0 +1,34 @@
+import datetime
+import math
+
+from django.utils import timezone
+
+from .models import Question
+
+# an answer counts as much as this many votes
+ANSWER_POINTS = 2
+# a question published this many seconds later outranks one with ten times its points
+HOT_PERIOD = 45000.0
+EPOCH = datetime.datetime(2018, 1, 1, tzinfo=timezone.utc)
+
+
+def hot_score(votes, answers, pub_date):
+    """Returns rank of the question combining its votes and answers (logarithmically) with its age
+
+    Age counts from the publication, so scores never decay and only votes and answers change them
+    """
+    points = votes + ANSWER_POINTS * answers
+    sign = (points > 0) - (points < 0)
+    return sign * math.log10(max(abs(points), 1)) + (pub_date - EPOCH).total_seconds() / HOT_PERIOD
+
+
+def store_hot_score(question_id, votes, answers, pub_date):
+    """Stores hot score of the question computed from its current votes, answer count and publication date"""
+    Question.objects.filter(pk=question_id).update(hot_score=hot_score(votes, answers, pub_date))
+
+
+def update_hot_score(question_id):
+    """Stores hot score of the question reading its current votes and answer count"""
+    row = Question.objects.filter(pk=question_id).values_list('votes', 'answer_count', 'pub_date').first()
+    if row is not None:
+        store_hot_score(question_id, *row)
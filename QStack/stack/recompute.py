@@ -0,0 +1,85 @@
+from django.db import transaction
+from django.db.models import Case, Count, F, FloatField, IntegerField, Max, OuterRef, Subquery, Sum, Value, When
+from django.db.models.functions import Coalesce
+
+from .models import User, Question, Answer, Tag, VoteQuestion, VoteAnswer
+from .ranking import hot_score
+
+# questions rescored by one update, it takes three parameters per question (SQLite allows 999)
+HOT_CHUNK_SIZE = 300
+
+
+def vote_sum(votes):
+    """Returns subquery of the sum of +1/-1 votes of the outer question/answer"""
+    total = votes.order_by().values(votes.model.target_field).annotate(
+        total=Sum(Case(When(rate_sign=True, then=Value(1)), default=Value(-1), output_field=IntegerField())))
+    return Coalesce(Subquery(total.values('total'), output_field=IntegerField()), Value(0))
+
+
+@transaction.atomic
+def recompute_votes():
+    """Recomputes votes counts of all questions and answers from stored votes"""
+    Question.objects.update(votes=vote_sum(VoteQuestion.objects.filter(question=OuterRef('pk'))))
+    Answer.objects.update(votes=vote_sum(VoteAnswer.objects.filter(answer=OuterRef('pk'))))
+
+
+@transaction.atomic
+def recompute_question_stats():
+    """Recomputes stored answer count, accepted answer and last activity of all questions, returns their number"""
+    answers = Answer.objects.filter(question=OuterRef('pk')).order_by().values('question')
+    return Question.objects.update(
+        answer_count=Coalesce(Subquery(answers.annotate(count=Count('id')).values('count'),
+                                       output_field=IntegerField()), Value(0)),
+        accepted_answer=Subquery(answers.filter(correctness=True).order_by('-pub_date').values('id')[:1]),
+        last_activity_at=Coalesce(Subquery(answers.annotate(latest=Max('pub_date')).values('latest')),
+                                  F('pub_date')),
+    )
+
+
+@transaction.atomic
+def recompute_tag_counts():
+    """Recomputes number of questions of all tags in a single aggregate update, returns number of tags"""
+    tagged = (Question.tag.through.objects.filter(tag=OuterRef('pk')).order_by().values('tag')
+              .annotate(count=Count('question')).values('count'))
+    return Tag.objects.update(question_count=Coalesce(Subquery(tagged, output_field=IntegerField()), Value(0)))
+
+
+@transaction.atomic
+def recompute_hot_scores(chunk_size=HOT_CHUNK_SIZE):
+    """Recomputes hot scores of all questions from their stored votes and answer counts, returns their number
+
+    Questions are read by keyset chunks and scores of a chunk are stored by one CASE update
+    """
+    count, last_id = 0, 0
+    while True:
+        rows = list(Question.objects.filter(pk__gt=last_id).order_by('pk')
+                    .values_list('id', 'votes', 'answer_count', 'pub_date')[:chunk_size])
+        if not rows:
+            return count
+        scores = [When(pk=question_id, then=Value(hot_score(votes, answers, pub_date)))
+                  for question_id, votes, answers, pub_date in rows]
+        Question.objects.filter(pk__in=[row[0] for row in rows]).update(
+            hot_score=Case(*scores, output_field=FloatField()))
+        count += len(rows)
+        last_id = rows[-1][0]
+
+
+def points_sum(votes, author_field, points):
+    """Returns subquery of reputation the outer user earned by votes on their questions/answers"""
+    total = votes.filter(**{author_field: OuterRef('pk')}).order_by().values(author_field).annotate(
+        total=Sum(Case(When(rate_sign=True, then=Value(points['up'])), default=Value(points['down']),
+                       output_field=IntegerField())))
+    return Coalesce(Subquery(total.values('total'), output_field=IntegerField()), Value(0))
+
+
+@transaction.atomic
+def recompute_reputation():
+    """Recomputes reputation of all users from votes on their messages and their accepted answers in a single
+    aggregate update, returns number of users
+    """
+    accepted = (Answer.objects.filter(user=OuterRef('pk'), correctness=True).order_by().values('user')
+                .annotate(count=Count('id')).values('count'))
+    return User.objects.update(reputation=(
+        points_sum(VoteQuestion.objects, 'question__user', Question.vote_points) +
+        points_sum(VoteAnswer.objects, 'answer__user', Answer.vote_points) +
+        Coalesce(Subquery(accepted, output_field=IntegerField()), Value(0)) * Answer.accepted_points))
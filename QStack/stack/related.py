@@ -0,0 +1,306 @@
+import os
+import tempfile
+import zlib
+from array import array
+from itertools import islice
+
+import numpy as np
+from scipy import sparse
+from django.conf import settings
+from django.db import transaction
+
+from .models import Question, RelatedQuestion
+from .search import HEADER_WEIGHT, CONTENT_WEIGHT, weigh_terms
+
+# terms are hashed into this many columns, so no vocabulary is kept and columns are stable between runs
+FEATURES = 2 ** 20
+TAG_WEIGHT = 2.0
+# most weighted terms kept of every question. Questions are read once; their raw terms, the matrix and its
+# transposition are written to memory mapped files of a temporary directory (at most 16 * MAX_TERMS bytes per
+# question besides the raw terms), so memory holds similarity blocks bounded by RELATED_BLOCK_ENTRIES, arrays of
+# feature columns (some 16 bytes per column) and 8 bytes per question for bounds of rows, 4 more in incremental runs
+MAX_TERMS = 50
+# terms of more than this share of questions (and of more than two) tell nothing about similarity
+MAX_DF = 0.5
+MIN_SCORE = 0.05
+
+CHUNK_SIZE = 2000
+# most ids of one IN list (SQLite allows 999 variables)
+BATCH_SIZE = 500
+
+
+def feature(term):
+    return zlib.crc32(term.encode()) % FEATURES
+
+
+def question_terms(header, content, tags):
+    """Returns {feature: weight} of the question, tags are whole terms unlike words of the text"""
+    terms = weigh_terms(((header, HEADER_WEIGHT), (content, CONTENT_WEIGHT)))
+    for tag in tags:
+        terms['tag:' + tag] = TAG_WEIGHT
+    features = {}
+    for term, weight in terms.items():
+        column = feature(term)
+        features[column] = features.get(column, 0.0) + weight
+    return features
+
+
+def read_questions(chunk_size=CHUNK_SIZE):
+    """Yields (id, {feature: weight}) of all questions in id order reading them by keyset chunks"""
+    through = Question.tag.through.objects
+    last_id = 0
+    while True:
+        rows = list(Question.objects.filter(pk__gt=last_id).order_by('pk')
+                    .values_list('id', 'header', 'content')[:chunk_size])
+        if not rows:
+            return
+        tags = {}
+        for question_id, tag in through.filter(question_id__in=[row[0] for row in rows]).values_list('question_id',
+                                                                                                      'tag__tag'):
+            tags.setdefault(question_id, []).append(tag)
+        for question_id, header, content in rows:
+            yield question_id, question_terms(header, content, tags.get(question_id, ()))
+        last_id = rows[-1][0]
+
+
+def spill_rows(directory, chunk_size=CHUNK_SIZE):
+    """Reads and vectorizes every question once, appends ids, numbers of features, feature columns and their raw
+    weights to files of the directory, returns number of questions and array of numbers of questions of every feature
+    """
+    df = np.zeros(FEATURES, dtype=np.int32)
+    count = 0
+    ids, lengths = array('q'), array('i')
+    with open(os.path.join(directory, 'ids'), 'wb') as ids_file, \
+            open(os.path.join(directory, 'lengths'), 'wb') as lengths_file, \
+            open(os.path.join(directory, 'columns'), 'wb') as columns_file, \
+            open(os.path.join(directory, 'weights'), 'wb') as weights_file:
+        for question_id, features in read_questions(chunk_size):
+            columns = np.fromiter(features, dtype=np.int32, count=len(features))
+            df[columns] += 1
+            columns.tofile(columns_file)
+            np.fromiter(features.values(), dtype=np.float32, count=len(features)).tofile(weights_file)
+            ids.append(question_id)
+            lengths.append(len(features))
+            count += 1
+            if len(ids) >= chunk_size:
+                ids.tofile(ids_file)
+                lengths.tofile(lengths_file)
+                ids, lengths = array('q'), array('i')
+        ids.tofile(ids_file)
+        lengths.tofile(lengths_file)
+    return count, df
+
+
+def idf_weights(count, df):
+    idf = (np.log((1.0 + count) / (1.0 + df)) + 1.0).astype(np.float32)
+    idf[df > max(MAX_DF * count, 2)] = 0
+    return idf
+
+
+def mapped(directory, name, dtype, size=None):
+    """Returns array in the file of the directory mapped to memory, a new file of given size when it is set"""
+    path = os.path.join(directory, name)
+    if size is None:
+        return np.memmap(path, dtype=dtype, mode='r')
+    # empty files cannot be mapped
+    return np.memmap(path, dtype=dtype, mode='w+', shape=(max(size, 1),))[:size]
+
+
+def build_matrix(directory, count, df):
+    """Returns ids of questions and CSR matrix of their L2 normalized TF-IDF rows (float32) spilled by spill_rows
+
+    Rows of at most MAX_TERMS entries each are written to memory mapped files of the directory
+    """
+    if not count:
+        return np.zeros(0, dtype=np.int64), sparse.csr_matrix((0, FEATURES), dtype=np.float32)
+    idf = idf_weights(count, df)
+    lengths = mapped(directory, 'lengths', np.int32)
+    raw_columns, raw_weights = mapped(directory, 'columns', np.int32), mapped(directory, 'weights', np.float32)
+    # one index type for all arrays, scipy would copy them to a common one otherwise
+    index_type = np.int32 if count * MAX_TERMS < 2 ** 31 else np.int64
+    indptr = mapped(directory, 'indptr', index_type, count + 1)
+    indices = mapped(directory, 'indices', index_type, count * MAX_TERMS)
+    data = mapped(directory, 'data', np.float32, count * MAX_TERMS)
+    indptr[0] = offset = position = 0
+    for row, length in enumerate(lengths.tolist()):
+        columns = np.asarray(raw_columns[offset:offset + length])
+        weights = raw_weights[offset:offset + length] * idf[columns]
+        offset += length
+        if len(columns) > MAX_TERMS:
+            best = np.argpartition(-weights, MAX_TERMS)[:MAX_TERMS]
+            columns, weights = columns[best], weights[best]
+        norm = np.sqrt(np.dot(weights, weights))
+        if norm > 0:
+            present = weights > 0
+            kept = np.count_nonzero(present)
+            indices[position:position + kept] = columns[present]
+            data[position:position + kept] = weights[present] / norm
+            position += kept
+        indptr[row + 1] = position
+    matrix = sparse.csr_matrix((data[:position], indices[:position], indptr), shape=(count, FEATURES), copy=False)
+    return mapped(directory, 'ids', np.int64), matrix
+
+
+def transpose(directory, matrix, chunk_size=CHUNK_SIZE):
+    """Returns transposition of the matrix in CSR written to memory mapped files of the directory
+
+    Entries are placed by counting sort of columns a chunk of rows at a time, so no copy of the matrix is allocated
+    """
+    counts = np.zeros(FEATURES, dtype=np.int64)
+    for start in range(0, matrix.shape[0], chunk_size):
+        end = min(start + chunk_size, matrix.shape[0])
+        counts += np.bincount(matrix.indices[matrix.indptr[start]:matrix.indptr[end]], minlength=FEATURES)
+    indptr = mapped(directory, 'transposed_indptr', matrix.indices.dtype, FEATURES + 1)
+    indptr[0] = 0
+    np.cumsum(counts, out=indptr[1:])
+    indices = mapped(directory, 'transposed_indices', matrix.indices.dtype, matrix.nnz)
+    data = mapped(directory, 'transposed_data', np.float32, matrix.nnz)
+    following = indptr[:-1].astype(np.int64)
+    for start in range(0, matrix.shape[0], chunk_size):
+        end = min(start + chunk_size, matrix.shape[0])
+        first, last = matrix.indptr[start], matrix.indptr[end]
+        columns = np.asarray(matrix.indices[first:last])
+        order = np.argsort(columns, kind='stable')
+        columns = columns[order]
+        present, starts, column_counts = np.unique(columns, return_index=True, return_counts=True)
+        # rows of a chunk come in order, so rows of every column stay sorted
+        targets = following[columns] + np.arange(len(columns)) - np.repeat(starts, column_counts)
+        rows = np.repeat(np.arange(start, end, dtype=indices.dtype), np.diff(matrix.indptr[start:end + 1]))
+        indices[targets] = rows[order]
+        data[targets] = matrix.data[first:last][order]
+        following[present] += column_counts
+    return sparse.csr_matrix((data, indices, indptr), shape=(FEATURES, matrix.shape[0]), copy=False)
+
+
+def block_neighbours(similarity, rows, size):
+    """Yields (row, columns, scores) of the size best entries of every row of the similarity block, best first
+
+    rows are positions of the block rows in the matrix, their own columns are skipped
+    """
+    for row in range(similarity.shape[0]):
+        start, end = similarity.indptr[row], similarity.indptr[row + 1]
+        columns, scores = similarity.indices[start:end], similarity.data[start:end]
+        keep = (columns != rows[row]) & (scores >= MIN_SCORE)
+        columns, scores = columns[keep], scores[keep]
+        if len(scores) > size:
+            best = np.argpartition(-scores, size)[:size]
+            columns, scores = columns[best], scores[best]
+        # equally similar questions by position, older first
+        order = np.lexsort((columns, -scores))
+        yield row, columns[order], scores[order]
+
+
+def blocks(rows, costs, entries):
+    """Splits rows into consecutive blocks which similarities take at most given number of entries together,
+    costs are upper bounds of entries of every row (a row taking more makes a block of its own)
+    """
+    bounds = np.cumsum(costs[rows])
+    start = 0
+    while start < len(rows):
+        limit = (bounds[start - 1] if start else 0) + entries
+        end = min(max(np.searchsorted(bounds, limit, side='right'), start + 1), start + BATCH_SIZE)
+        yield rows[start:end]
+        start = end
+
+
+def row_costs(matrix, transposed, chunk_size=CHUNK_SIZE):
+    """Returns upper bounds of similarities of every row: numbers of questions sharing its terms (capped by the number
+    of rows), summed a chunk of rows at a time so that no array of all entries is allocated besides the matrices
+    """
+    frequencies = np.diff(transposed.indptr)
+    costs = np.empty(matrix.shape[0], dtype=np.int64)
+    for start in range(0, matrix.shape[0], chunk_size):
+        end = min(start + chunk_size, matrix.shape[0])
+        bounds = matrix.indptr[start:end + 1] - matrix.indptr[start]
+        shared = np.concatenate(([0], frequencies[matrix.indices[matrix.indptr[start]:matrix.indptr[end]]].cumsum()))
+        costs[start:end] = shared[bounds[1:]] - shared[bounds[:-1]]
+    return np.minimum(costs, matrix.shape[0])
+
+
+def similarities(matrix, transposed, rows, entries):
+    """Yields (block rows, similarity block) of given rows against all rows, a block at a time
+
+    A row has at most as many similarities as questions share its terms, blocks are cut by this bound
+    """
+    costs = row_costs(matrix, transposed)
+    for block in blocks(rows, costs, entries):
+        yield block, (matrix[block] @ transposed).tocsr()
+
+
+def store_neighbours(ids, matrix, transposed, rows, size, entries):
+    """Replaces stored neighbours of questions at given rows by their size most similar ones"""
+    for block, similarity in similarities(matrix, transposed, rows, entries):
+        question_ids = ids[block].tolist()
+        neighbours = [RelatedQuestion(question_id=question_ids[row], related_id=related_id, rank=rank, score=score)
+                      for row, columns, scores in block_neighbours(similarity, block, size)
+                      for rank, (related_id, score) in enumerate(zip(ids[columns].tolist(), scores.tolist()))]
+        with transaction.atomic():
+            RelatedQuestion.objects.filter(question_id__in=question_ids).delete()
+            RelatedQuestion.objects.bulk_create(neighbours, batch_size=BATCH_SIZE)
+
+
+def positions(ids, question_ids):
+    """Returns rows of given question ids and mask of ids found, questions deleted since are not in the matrix"""
+    question_ids = np.asarray(question_ids, dtype=np.int64)
+    found = np.minimum(np.searchsorted(ids, question_ids), len(ids) - 1)
+    return found, ids[found] == question_ids
+
+
+def affected_rows(ids, matrix, transposed, changed, size, entries):
+    """Returns rows of changed questions and of questions which neighbours they may change: ones listing them
+    and ones they are more similar to than the last stored neighbour
+    """
+    floor = np.zeros(len(ids), dtype=np.float32)
+    last = RelatedQuestion.objects.filter(rank=size - 1).values_list('question_id', 'score').iterator()
+    while True:
+        chunk = list(islice(last, CHUNK_SIZE))
+        if not chunk:
+            break
+        question_ids, scores = zip(*chunk)
+        found, present = positions(ids, question_ids)
+        floor[found[present]] = np.asarray(scores, dtype=np.float32)[present]
+
+    affected = set(changed.tolist())
+    changed_ids = ids[changed].tolist()
+    for start in range(0, len(changed_ids), BATCH_SIZE):
+        listing = RelatedQuestion.objects.filter(related_id__in=changed_ids[start:start + BATCH_SIZE])
+        found, present = positions(ids, list(listing.values_list('question_id', flat=True)))
+        affected.update(found[present].tolist())
+    for block, similarity in similarities(matrix, transposed, changed, entries):
+        closer = (similarity.data >= MIN_SCORE) & (similarity.data > floor[similarity.indices])
+        affected.update(similarity.indices[closer].tolist())
+    return np.array(sorted(affected), dtype=np.int64)
+
+
+def rebuild_related(incremental=False, size=None, entries=None, chunk_size=CHUNK_SIZE):
+    """Stores RELATED_SIZE most similar questions of every question, returns number of updated questions
+
+    Incremental run updates only questions which header, content or tags have changed since the last run and
+    neighbours of other questions they get into or drop out of. Flags of questions are cleared before they are
+    read and set again when the run fails, so changes made during the run are picked up by the next one
+    """
+    size = size or settings.RELATED_SIZE
+    entries = entries or settings.RELATED_BLOCK_ENTRIES
+    stale = Question.objects.filter(related_stale=True)
+    if incremental and not stale.exists():
+        return 0
+    stale_ids = list(stale.values_list('id', flat=True))
+    for start in range(0, len(stale_ids), BATCH_SIZE):
+        Question.objects.filter(pk__in=stale_ids[start:start + BATCH_SIZE]).update(related_stale=False)
+    try:
+        with tempfile.TemporaryDirectory(prefix='qstack-related-') as directory:
+            ids, matrix = build_matrix(directory, *spill_rows(directory, chunk_size))
+            transposed = transpose(directory, matrix, chunk_size)
+            if not len(ids):
+                rows = ids
+            elif incremental:
+                changed = np.flatnonzero(np.isin(ids, stale_ids))
+                rows = affected_rows(ids, matrix, transposed, changed, size, entries)
+            else:
+                rows = np.arange(len(ids))
+            store_neighbours(ids, matrix, transposed, rows, size, entries)
+    except BaseException:
+        for start in range(0, len(stale_ids), BATCH_SIZE):
+            Question.objects.filter(pk__in=stale_ids[start:start + BATCH_SIZE]).update(related_stale=True)
+        raise
+    return len(rows)
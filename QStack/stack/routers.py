@@ -0,0 +1,71 @@
+import random
+import threading
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+
+PIN_COOKIE = 'stack_primary'
+PIN_SALT = 'stack.routers'
+
+# routing state of the request handled by the current thread
+state = threading.local()
+
+
+def replica_reads(view):
+    """Marks the view as read-only, its GET requests may be served from DATABASE_REPLICAS"""
+    view.replica_reads = True
+    return view
+
+
+def reset():
+    state.replica = None
+    state.wrote = False
+
+
+class ReplicaRouter(object):
+    """Sends reads of replica_reads views to a random replica, everything else and all writes to the primary"""
+
+    def db_for_read(self, model, **hints):
+        if getattr(state, 'wrote', False):
+            return DEFAULT_DB_ALIAS
+        return getattr(state, 'replica', None) or DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        state.wrote = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # replicas hold the same rows as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return True
+
+
+class ReplicaMiddleware(object):
+    """Chooses database of every request and pins clients to the primary for REPLICA_PIN_SECONDS after they write,
+    so that they read their own votes, answers and questions before replicas catch up
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        reset()
+        try:
+            response = self.get_response(request)
+            if state.wrote and settings.DATABASE_REPLICAS:
+                response.set_signed_cookie(PIN_COOKIE, '1', salt=PIN_SALT, max_age=settings.REPLICA_PIN_SECONDS,
+                                           httponly=True)
+        finally:
+            reset()
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if (settings.DATABASE_REPLICAS and request.method in ('GET', 'HEAD') and
+                getattr(view_func, 'replica_reads', False) and not self.pinned(request)):
+            state.replica = random.choice(settings.DATABASE_REPLICAS)
+
+    def pinned(self, request):
+        return request.get_signed_cookie(PIN_COOKIE, None, salt=PIN_SALT,
+                                         max_age=settings.REPLICA_PIN_SECONDS) is not None
@@ -0,0 +1,200 @@
+import datetime
+import math
+import operator
+import re
+from collections import defaultdict
+from functools import reduce
+
+from django.db import transaction
+from django.db.models import Case, Count, F, FloatField, Max, Q, Sum, Value, When
+from django.utils import timezone
+
+from .models import Question, Answer, SearchTerm, SearchPosting
+from .tagindex import filter_questions
+
+TOKEN_PATTERN = re.compile(r'[^\W_]+')
+MAX_TERM_LENGTH = 50
+MIN_PREFIX_LENGTH = 3
+MAX_EXPANSIONS = 500
+
+HEADER_WEIGHT = 3.0
+CONTENT_WEIGHT = 1.0
+ANSWER_WEIGHT = 0.5
+
+VOTE_BOOST = 0.2
+# relevance of questions published this number of days later is doubled
+RECENCY_DOUBLING_DAYS = 365.0
+EPOCH = datetime.datetime(2018, 1, 1, tzinfo=timezone.utc)
+
+# most relevant questions listed for key words (after tag filters)
+RESULT_LIMIT = 200
+BATCH_SIZE = 500
+
+
+def tokenize(text):
+    """Splits text into lowercase words suitable for the index"""
+    if not text:
+        return []
+    return [token for token in TOKEN_PATTERN.findall(text.lower()) if len(token) <= MAX_TERM_LENGTH]
+
+
+def weigh_terms(fields):
+    """Returns {term: weight} for given (text, field weight) pairs, term frequency is dampened logarithmically"""
+    counts = defaultdict(lambda: defaultdict(int))
+    for text, field_weight in fields:
+        for token in tokenize(text):
+            counts[token][field_weight] += 1
+    return {term: sum(field_weight * (1 + math.log(count)) for field_weight, count in per_field.items())
+            for term, per_field in counts.items()}
+
+
+def resolve_terms(terms, cache=None):
+    """Returns {term: id} creating missing terms in bulk"""
+    term_ids = {}
+    missing = []
+    for term in set(terms):
+        if cache is not None and term in cache:
+            term_ids[term] = cache[term]
+        else:
+            missing.append(term)
+
+    for start in range(0, len(missing), BATCH_SIZE):
+        chunk = missing[start:start + BATCH_SIZE]
+        found = dict(SearchTerm.objects.filter(term__in=chunk).values_list('term', 'id'))
+        new_terms = [SearchTerm(term=term) for term in chunk if term not in found]
+        if new_terms:
+            SearchTerm.objects.bulk_create(new_terms)
+            found.update(SearchTerm.objects.filter(term__in=[t.term for t in new_terms]).values_list('term', 'id'))
+        term_ids.update(found)
+
+    if cache is not None:
+        cache.update(term_ids)
+    return term_ids
+
+
+def store_postings(documents, cache=None):
+    """Writes postings for given (question_id, answer_id, {term: weight}) documents"""
+    term_ids = resolve_terms((term for _, _, weights in documents for term in weights), cache)
+    SearchPosting.objects.bulk_create(
+        (SearchPosting(term_id=term_ids[term], question_id=question_id, answer_id=answer_id, weight=weight)
+         for question_id, answer_id, weights in documents for term, weight in weights.items()),
+        batch_size=BATCH_SIZE)
+
+
+def question_document(question):
+    return question.id, None, weigh_terms([(question.header, HEADER_WEIGHT), (question.content, CONTENT_WEIGHT)])
+
+
+def answer_document(answer):
+    return answer.question_id, answer.id, weigh_terms([(answer.content, ANSWER_WEIGHT)])
+
+
+@transaction.atomic
+def index_question(question):
+    """(Re)indexes header and content of the question"""
+    SearchPosting.objects.filter(question=question, answer__isnull=True).delete()
+    store_postings([question_document(question)])
+
+
+@transaction.atomic
+def index_answer(answer):
+    """(Re)indexes content of the answer under its question"""
+    SearchPosting.objects.filter(answer=answer).delete()
+    if answer.question_id:
+        store_postings([answer_document(answer)])
+
+
+def rebuild_index(chunk_size=1000):
+    """Drops the whole index and builds it again from questions and answers, returns number of postings"""
+    with transaction.atomic():
+        SearchPosting.objects.all().delete()
+        SearchTerm.objects.all().delete()
+
+    cache = {}
+    for queryset, to_document in ((Question.objects.only('id', 'header', 'content'), question_document),
+                                  (Answer.objects.filter(question__isnull=False).only('id', 'question_id', 'content'),
+                                   answer_document)):
+        documents = []
+        for obj in queryset.order_by('id').iterator():
+            documents.append(to_document(obj))
+            if len(documents) >= chunk_size:
+                with transaction.atomic():
+                    store_postings(documents, cache)
+                documents = []
+        if documents:
+            with transaction.atomic():
+                store_postings(documents, cache)
+    return SearchPosting.objects.count()
+
+
+def match_terms(words):
+    """Returns {term_id: idf} for terms matching given words (words of 3+ letters match as prefixes)"""
+    conditions = []
+    for word in set(words):
+        if len(word) >= MIN_PREFIX_LENGTH:
+            conditions.append(Q(term__gte=word, term__lt=word + '\uffff'))
+        else:
+            conditions.append(Q(term=word))
+    if not conditions:
+        return {}
+
+    term_ids = list(SearchTerm.objects.filter(reduce(operator.or_, conditions))
+                    .order_by('term').values_list('id', flat=True)[:MAX_EXPANSIONS])
+    if not term_ids:
+        return {}
+
+    frequencies = dict(SearchPosting.objects.filter(term_id__in=term_ids)
+                       .values_list('term_id').annotate(df=Count('question_id', distinct=True)))
+
+    total = Question.objects.aggregate(total=Max('id'))['total'] or 1
+    return {term_id: math.log(1 + total / df) for term_id, df in frequencies.items()}
+
+
+def boost(score, votes, pub_date):
+    """Returns log-scaled rank of text relevance boosted by votes and recency
+
+    Recency is measured from a fixed epoch rather than from now, so ranks do not drift between requests
+    """
+    if votes >= 0:
+        score *= 1 + VOTE_BOOST * math.log1p(votes)
+    else:
+        score /= 1 + VOTE_BOOST * math.log1p(-votes)
+    days = (pub_date - EPOCH).total_seconds() / 86400
+    return math.log(score) + math.log(2) * days / RECENCY_DOUBLING_DAYS
+
+
+def search(user_query, limit=RESULT_LIMIT, tags=(), excluded=()):
+    """Returns list of (question_id, score) best matching the query, most relevant first
+
+    Only the limit best matches are returned; postings are restricted to questions having all tags and none of
+    excluded ones before that, so tag filters do not drop questions from the already limited result
+    """
+    idf = match_terms(tokenize(user_query))
+    if not idf:
+        return []
+
+    relevance = Sum(Case(*[When(term_id=term_id, then=F('weight') * Value(value)) for term_id, value in idf.items()],
+                         default=Value(0.0), output_field=FloatField()))
+    candidates = SearchPosting.objects.filter(term_id__in=list(idf))
+    if tags or excluded:
+        candidates = filter_questions(candidates, tags, excluded, field='question_id')
+    candidates = candidates.values('question_id').annotate(relevance=relevance).order_by('-relevance')[:limit]
+    scores = {row['question_id']: row['relevance'] for row in candidates}
+
+    ranked = [(question_id, boost(scores[question_id], votes, pub_date))
+              for question_id, votes, pub_date in
+              Question.objects.filter(id__in=list(scores)).values_list('id', 'votes', 'pub_date')]
+    ranked.sort(key=lambda item: (-item[1], -item[0]))
+    return ranked
+
+
+def search_questions(user_query, tags=(), excluded=()):
+    """Returns queryset of questions matching the query (and tag filters) annotated with search_rank and ordered by it
+    """
+    ranked = search(user_query, RESULT_LIMIT, tags, excluded)
+    if not ranked:
+        return Question.objects.none()
+    rank = Case(*[When(id=question_id, then=Value(score)) for question_id, score in ranked],
+                default=Value(0.0), output_field=FloatField())
+    return (Question.objects.filter(id__in=[question_id for question_id, _ in ranked])
+            .annotate(search_rank=rank).order_by('-search_rank', '-id'))
@@ -0,0 +1,118 @@
+import datetime
+import itertools
+import random
+
+from django.contrib.auth.hashers import make_password
+from django.db.models import Max
+from django.utils import timezone
+
+from .models import User, Question, Answer
+from .transfer import CHUNK_SIZE, Importer, finish_import
+
+SYLLABLES = ('ba', 'ko', 'li', 'mu', 'ne', 'ro', 'sa', 'ti', 'vo', 'ze', 'ga', 'pe')
+VOCABULARY_SIZE = 5000
+UP_RATIO = 0.8
+ACCEPT_RATIO = 0.15
+SEED_PASSWORD = 'password'
+
+
+class ZipfSampler(object):
+    """Draws items of the population with probability proportional to 1 / rank ** exponent"""
+
+    def __init__(self, population, exponent=1.1, rng=random):
+        self.population = list(population)
+        self.cum_weights = list(itertools.accumulate(1 / rank ** exponent
+                                                     for rank in range(1, len(self.population) + 1)))
+        self.rng = rng
+
+    def sample(self, k=1):
+        return self.rng.choices(self.population, cum_weights=self.cum_weights, k=k)
+
+    def one(self):
+        return self.sample()[0]
+
+
+def vocabulary(size=VOCABULARY_SIZE):
+    """Returns list of distinct made up words, shorter ones first"""
+    words = []
+    for length in itertools.count(2):
+        for syllables in itertools.product(SYLLABLES, repeat=length):
+            words.append(''.join(syllables))
+            if len(words) >= size:
+                return words
+
+
+def dataset(size):
+    """Returns seed arguments of a dataset with given number of questions keeping typical proportions"""
+    return {'users': max(size // 10, 10), 'questions': size, 'answers': size * 2,
+            'tags': max(size // 20, 10), 'votes': size * 5}
+
+
+def seed_records(users, questions, answers, tags, votes, exponent=1.1, rng=random, days=365):
+    """Yields NDJSON records of a synthetic dataset, authors, tags, answered questions and voted posts are Zipfian"""
+    now = timezone.now()
+    words = ZipfSampler(vocabulary(), exponent, rng)
+    user_offset = (User.objects.aggregate(last=Max('id'))['last'] or 0) + 1
+    question_offset = (Question.objects.aggregate(last=Max('id'))['last'] or 0) + 1
+    answer_offset = (Answer.objects.aggregate(last=Max('id'))['last'] or 0) + 1
+
+    password = make_password(SEED_PASSWORD)
+    usernames = ['seed%d' % (user_offset + i) for i in range(users)]
+    for username in usernames:
+        yield {'model': 'user', 'username': username, 'email': username + '@example.com', 'password': password,
+               'date_joined': (now - datetime.timedelta(days=days)).isoformat()}
+
+    tag_names = ['%s%d' % (words.population[i % len(words.population)], i) for i in range(tags)]
+    for name in tag_names:
+        yield {'model': 'tag', 'tag': name}
+    authors = ZipfSampler(rng.sample(usernames, len(usernames)), exponent, rng)
+    tag_sampler = ZipfSampler(tag_names, exponent, rng)
+
+    # questions are spread over the period in id order, answers come after their question
+    question_dates = sorted(now - datetime.timedelta(seconds=rng.uniform(0, days * 86400))
+                            for _ in range(questions))
+    for i, pub_date in enumerate(question_dates):
+        yield {'model': 'question', 'id': question_offset + i, 'pub_date': pub_date.isoformat(),
+               'user': authors.one(),
+               'header': ' '.join(words.sample(rng.randint(4, 10))).capitalize(),
+               'content': ' '.join(words.sample(rng.randint(10, 60))),
+               'tags': sorted(set(tag_sampler.sample(rng.randint(1, 3))))}
+
+    question_ids = list(range(question_offset, question_offset + questions))
+    popular_questions = ZipfSampler(rng.sample(question_ids, len(question_ids)), exponent, rng)
+    accepted = set()
+    for i in range(answers if questions else 0):
+        question_id = popular_questions.one()
+        asked = question_dates[question_id - question_offset]
+        correctness = question_id not in accepted and rng.random() < ACCEPT_RATIO
+        if correctness:
+            accepted.add(question_id)
+        yield {'model': 'answer', 'id': answer_offset + i, 'question': question_id, 'user': authors.one(),
+               'pub_date': (asked + (now - asked) * rng.random()).isoformat(), 'correctness': correctness,
+               'content': ' '.join(words.sample(rng.randint(10, 80)))}
+
+    # votes are split between questions and answers, a user votes at most once per post
+    answer_ids = list(range(answer_offset, answer_offset + answers)) if questions else []
+    targets = [('vote_question', 'question', popular_questions)]
+    if answer_ids:
+        targets.append(('vote_answer', 'answer', ZipfSampler(rng.sample(answer_ids, len(answer_ids)), exponent, rng)))
+    voters = ZipfSampler(rng.sample(usernames, len(usernames)), exponent, rng)
+    cast = set()
+    for _ in range(votes if questions and users else 0):
+        model, field, sampler = rng.choice(targets)
+        vote = (model, sampler.one(), voters.one())
+        if vote not in cast:
+            cast.add(vote)
+            yield {'model': model, field: vote[1], 'user': vote[2], 'up': rng.random() < UP_RATIO}
+
+
+def seed(users, questions, answers, tags, votes, exponent=1.1, random_seed=None, chunk_size=CHUNK_SIZE, index=True):
+    """Generates synthetic dataset storing it in bulk chunks, returns {model: number of records}"""
+    if users < 1 or tags < 1:
+        raise ValueError('Dataset needs at least one user and one tag')
+    importer = Importer(chunk_size)
+    for record in seed_records(users, questions, answers, tags, votes, exponent, random.Random(random_seed)):
+        importer.add(record)
+    importer.flush()
+    finish_import(index)
+    return importer.counts
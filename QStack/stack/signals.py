@@ -0,0 +1,214 @@
+from django.db.backends.signals import connection_created
+from django.db.models import F
+from django.db.models.signals import pre_save, post_save, pre_delete, post_delete, m2m_changed
+from django.dispatch import receiver
+from django.utils import timezone
+
+from . import avatars, caching, ranking, search, sqlite, tagindex
+from .models import User, Question, Answer, Tag, votes_changed
+
+# fields of questions shown in rows of question lists or ordering them
+LIST_FIELDS = ('header', 'votes', 'answer_count', 'hot_score', 'pub_date', 'user')
+
+
+def touches(update_fields, fields):
+    """Returns True if save with given update_fields could change any of fields"""
+    return update_fields is None or bool(set(update_fields) & set(fields))
+
+
+@receiver(connection_created)
+def configure_sqlite(sender, connection, **kwargs):
+    """Applies SQLITE_PRAGMAS to every new database connection"""
+    sqlite.configure(connection)
+
+
+@receiver(post_save, sender=Question)
+def index_question(sender, instance, raw=False, update_fields=None, **kwargs):
+    """Keeps search index of the question up to date"""
+    if not raw and touches(update_fields, ('header', 'content')):
+        search.index_question(instance)
+
+
+@receiver(post_save, sender=Question)
+def queue_related_of_question(sender, instance, created=False, raw=False, update_fields=None, **kwargs):
+    """Queues edited question for the next incremental rebuild_related, new ones are queued by default"""
+    if not raw and not created and touches(update_fields, ('header', 'content')):
+        Question.objects.filter(pk=instance.pk).update(related_stale=True)
+
+
+@receiver(post_save, sender=Answer)
+def index_answer(sender, instance, raw=False, update_fields=None, **kwargs):
+    """Keeps search index of the answer up to date"""
+    if not raw and touches(update_fields, ('content', 'question')):
+        search.index_answer(instance)
+
+
+@receiver(post_save, sender=Answer)
+def count_given_answer(sender, instance, created=False, raw=False, **kwargs):
+    """Counts new answer in the stored summary of its question"""
+    if created and not raw and instance.question_id:
+        Question.objects.filter(pk=instance.question_id).update(answer_count=F('answer_count') + 1,
+                                                                last_activity_at=instance.pub_date)
+        ranking.update_hot_score(instance.question_id)
+
+
+@receiver(post_delete, sender=Answer)
+def count_deleted_answer(sender, instance, **kwargs):
+    """Removes deleted answer from the stored summary of its question"""
+    if instance.question_id:
+        Question.objects.filter(pk=instance.question_id).update(answer_count=F('answer_count') - 1,
+                                                                last_activity_at=timezone.now())
+        ranking.update_hot_score(instance.question_id)
+
+
+@receiver(pre_save, sender=Question)
+def score_new_question(sender, instance, raw=False, **kwargs):
+    """Gives new question its hot score, later it changes with votes and answers only"""
+    if instance._state.adding and not raw:
+        instance.hot_score = ranking.hot_score(instance.votes, instance.answer_count, instance.pub_date)
+
+
+@receiver(votes_changed, sender=Question)
+def rescore_on_vote(sender, instance, **kwargs):
+    # change_votes has just read them back with the votes count
+    ranking.store_hot_score(instance.id, instance.votes, instance.answer_count, instance.pub_date)
+
+
+@receiver(votes_changed, sender=Question)
+def refresh_trending_on_vote(sender, instance, **kwargs):
+    """Drops cached trending questions when the vote changes the top"""
+    caching.update_trending(instance.id, instance.votes)
+
+
+@receiver(votes_changed)
+def flag_reputation_on_vote(sender, **kwargs):
+    """Votes change reputation of authors shown on cached pages, see caching.reputation_version"""
+    caching.reputation_changed()
+
+
+@receiver(post_save, sender=Answer)
+def flag_reputation_on_mark(sender, instance, created=False, raw=False, update_fields=None, **kwargs):
+    if not raw and not created and instance.user_id and touches(update_fields, ('correctness',)):
+        caching.reputation_changed()
+
+
+@receiver(post_save, sender=Question)
+def refresh_trending_on_question(sender, instance, created=False, raw=False, **kwargs):
+    """New question can get into trending while the top is not full yet"""
+    if created and not raw:
+        caching.update_trending(instance.id, instance.votes)
+
+
+@receiver(post_delete, sender=Question)
+def refresh_trending_on_delete(sender, instance, **kwargs):
+    caching.update_trending(instance.id, instance.votes)
+
+
+@receiver(post_save, sender=Question)
+@receiver(post_delete, sender=Question)
+def invalidate_question_pages(sender, instance, raw=False, update_fields=None, **kwargs):
+    """Drops cached pages showing the question, lists only when the change shows in their rows or order"""
+    if not raw:
+        caching.invalidate_question(instance.id)
+        if touches(update_fields, LIST_FIELDS):
+            caching.invalidate_listing()
+
+
+@receiver(post_save, sender=Answer)
+def invalidate_answer_pages(sender, instance, created=False, raw=False, **kwargs):
+    """Drops cached pages showing the answer, lists show only number of answers"""
+    if not raw and instance.question_id:
+        caching.invalidate_question(instance.question_id)
+        if created:
+            caching.invalidate_listing()
+
+
+@receiver(post_delete, sender=Answer)
+def invalidate_deleted_answer_pages(sender, instance, **kwargs):
+    if instance.question_id:
+        caching.invalidate_question(instance.question_id)
+        caching.invalidate_listing()
+
+
+
+@receiver(m2m_changed, sender=Question.tag.through)
+def remember_unlinked(sender, instance, action, reverse=False, pk_set=None, **kwargs):
+    """Keeps ids of the other side which remove() or clear() actually unlinks, remove() passes also ones which
+    were never linked and clear() none
+    """
+    if action in ('pre_remove', 'pre_clear'):
+        links = Question.tag.through.objects
+        if reverse:
+            links = links.filter(tag=instance).values_list('question_id', flat=True)
+            if action == 'pre_remove':
+                links = links.filter(question_id__in=pk_set)
+        else:
+            links = links.filter(question=instance).values_list('tag_id', flat=True)
+            if action == 'pre_remove':
+                links = links.filter(tag_id__in=pk_set)
+        instance.unlinked_ids = list(links)
+
+
+def changed_links(instance, action, pk_set):
+    """Returns ids of the other side linked or unlinked by the change, add() passes only new ones"""
+    if action == 'post_add':
+        return pk_set or ()
+    return instance.unlinked_ids
+
+
+@receiver(m2m_changed, sender=Question.tag.through)
+def invalidate_tagged_pages(sender, instance, action, reverse=False, pk_set=None, **kwargs):
+    """Drops cached pages of questions which tags have changed"""
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        question_ids = changed_links(instance, action, pk_set) if reverse else [instance.pk]
+        for question_id in question_ids:
+            caching.invalidate_question(question_id)
+        caching.invalidate_listing()
+
+
+@receiver(m2m_changed, sender=Question.tag.through)
+def count_tagged_questions(sender, instance, action, reverse=False, pk_set=None, **kwargs):
+    """Keeps number of questions of tags up to date"""
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    ids = changed_links(instance, action, pk_set)
+    if not ids:
+        return
+    delta = 1 if action == 'post_add' else -1
+    if reverse:
+        Tag.objects.filter(pk=instance.pk).update(question_count=F('question_count') + delta * len(ids))
+    else:
+        Tag.objects.filter(pk__in=ids).update(question_count=F('question_count') + delta)
+    caching.invalidate_tags()
+
+
+@receiver(m2m_changed, sender=Question.tag.through)
+def invalidate_tag_postings(sender, instance, action, reverse=False, pk_set=None, **kwargs):
+    """Drops cached question lists of tags which questions have changed"""
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        tagindex.invalidate_postings([instance.pk] if reverse else changed_links(instance, action, pk_set))
+
+
+@receiver(m2m_changed, sender=Question.tag.through)
+def queue_related_of_tagged(sender, instance, action, reverse=False, pk_set=None, **kwargs):
+    """Queues questions which tags have changed for the next incremental rebuild_related"""
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        question_ids = changed_links(instance, action, pk_set) if reverse else [instance.pk]
+        Question.objects.filter(pk__in=question_ids).update(related_stale=True)
+
+
+@receiver(pre_delete, sender=Question)
+def count_deleted_tagged_question(sender, instance, **kwargs):
+    """Tags of deleted question lose it, its tag links are removed without m2m_changed"""
+    tag_ids = list(Tag.objects.filter(question=instance).values_list('id', flat=True))
+    if tag_ids:
+        Tag.objects.filter(pk__in=tag_ids).update(question_count=F('question_count') - 1)
+        tagindex.invalidate_postings(tag_ids)
+        caching.invalidate_tags()
+
+
+@receiver(post_save, sender=User)
+def make_avatar_thumbnails(sender, instance, raw=False, update_fields=None, **kwargs):
+    """Pre-sizes newly uploaded avatar, rows and admin show thumbnails instead of the original"""
+    if not raw and touches(update_fields, ('image',)) and avatars.is_content_named(instance.image.name):
+        avatars.make_thumbnails(instance.image.name)
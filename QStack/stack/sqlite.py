@@ -0,0 +1,69 @@
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+
+from django.conf import settings
+from django.db import OperationalError, connections, router, transaction
+
+# first retry of a busy write waits about this many seconds, every next one twice as long
+RETRY_DELAY = 0.01
+
+# vote and answer writes of the process are run one at a time here when SQLITE_WRITE_QUEUE is set
+writer = ThreadPoolExecutor(max_workers=1)
+
+
+def configure(connection):
+    """Applies SQLITE_PRAGMAS to a new SQLite connection"""
+    if connection.vendor != 'sqlite' or not settings.SQLITE_PRAGMAS:
+        return
+    with connection.cursor() as cursor:
+        for name, value in settings.SQLITE_PRAGMAS.items():
+            cursor.execute('PRAGMA %s = %s' % (name, value))
+
+
+def is_busy(error):
+    return 'database is locked' in str(error) or 'database is busy' in str(error)
+
+
+def run_retrying(using, func, args, kwargs):
+    """Runs func in a transaction, repeating it with backoff while SQLite reports the database busy"""
+    attempts = max(settings.SQLITE_WRITE_RETRIES, 1)
+    for attempt in range(attempts):
+        try:
+            with transaction.atomic(using=using):
+                return func(*args, **kwargs)
+        except OperationalError as e:
+            if not is_busy(e) or attempt == attempts - 1:
+                raise
+        time.sleep(RETRY_DELAY * 2 ** attempt * (1 + random.random()))
+
+
+def run_queued(using, func, args, kwargs):
+    try:
+        return run_retrying(using, func, args, kwargs)
+    finally:
+        # the writer thread lives as long as the process, its connection is dropped like ones of requests
+        connections[using].close_if_unusable_or_obsolete()
+
+
+def run_write(func, model, *args, **kwargs):
+    """Runs func writing rows of the model in its own transaction retried on busy database
+
+    With SQLITE_WRITE_QUEUE the transaction is passed to the single writer thread, so writers of the process never
+    compete for the SQLite write lock. Calls inside an outer transaction run as they are, it is retried as a whole
+    """
+    using = router.db_for_write(model)
+    if connections[using].in_atomic_block:
+        return func(*args, **kwargs)
+    if settings.SQLITE_WRITE_QUEUE and connections[using].vendor == 'sqlite':
+        return writer.submit(run_queued, using, func, args, kwargs).result()
+    return run_retrying(using, func, args, kwargs)
+
+
+def write_transaction(method):
+    """Runs model method through run_write"""
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        return run_write(method, type(self), self, *args, **kwargs)
+    return wrapper
@@ -0,0 +1,193 @@
+import re
+from array import array
+from bisect import bisect_left
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Exists, OuterRef
+
+from .caching import after_commit
+from .models import Question, Tag
+
+TAG_ID_KEY = 'stack:tag:id:%s'
+POSTINGS_KEY = 'stack:tag:postings:%d'
+TAG_TERM = re.compile(r'^(-?)tag:(.+)$')
+# intersection switches from hashing to binary search when one list is this many times longer
+GALLOP_RATIO = 16
+# most ids passed as parameters of one IN list (SQLite allows 999 variables), larger tags are matched by the database
+MAX_INLINE_IDS = 500
+
+
+class TagQuery(object):
+    """Parsed search box query: required tags, excluded tags and remaining key words"""
+
+    def __init__(self, tags=(), excluded=(), words=()):
+        self.tags = list(tags)
+        self.excluded = list(excluded)
+        self.words = list(words)
+
+    def __bool__(self):
+        return bool(self.tags or self.excluded)
+
+
+def parse_query(user_query):
+    """Splits 'tag:python tag:django -tag:flask sorting' into required, excluded tags and key words"""
+    query = TagQuery()
+    for term in user_query.replace(';', ' ').replace(',', ' ').split():
+        match = TAG_TERM.match(term.lower())
+        if match and match.group(1):
+            query.excluded.append(match.group(2))
+        elif match:
+            query.tags.append(match.group(2))
+        else:
+            query.words.append(term)
+    return query
+
+
+def tag_ids(names):
+    """Returns {name: id} of existing tags, ids are cached along with question lists"""
+    keys = {TAG_ID_KEY % name: name for name in names}
+    found = {keys[key]: tag_id for key, tag_id in cache.get_many(list(keys)).items()}
+    missing = set(keys.values()).difference(found)
+    if missing:
+        loaded = dict(Tag.objects.filter(tag__in=missing).values_list('tag', 'id'))
+        cache.set_many({TAG_ID_KEY % name: tag_id for name, tag_id in loaded.items()}, settings.TAG_POSTINGS_TIMEOUT)
+        found.update(loaded)
+    return found
+
+
+def postings(ids):
+    """Returns {tag id: sorted array of ids of its questions}, lists missing in cache are loaded in one query"""
+    lists = cached_postings(ids)
+    lists.update(load_postings(set(ids).difference(lists)))
+    return lists
+
+
+def short_postings(ids):
+    """Returns postings of those tags which have at most MAX_INLINE_IDS questions
+
+    Sizes of lists missing in cache are read from Tag.question_count first, so long lists are never loaded
+    """
+    lists = cached_postings(ids)
+    missing = set(ids).difference(lists)
+    if missing:
+        lists.update(load_postings(list(Tag.objects.filter(pk__in=missing, question_count__lte=MAX_INLINE_IDS)
+                                        .values_list('id', flat=True))))
+    return {tag_id: question_ids for tag_id, question_ids in lists.items() if len(question_ids) <= MAX_INLINE_IDS}
+
+
+def cached_postings(ids):
+    lists = {}
+    for key, data in cache.get_many([POSTINGS_KEY % tag_id for tag_id in ids]).items():
+        lists[int(key.rsplit(':', 1)[1])] = unpack(data)
+    return lists
+
+
+def load_postings(ids):
+    """Loads posting lists of tags from the link table in one query and caches them"""
+    if not ids:
+        return {}
+    loaded = {tag_id: [] for tag_id in ids}
+    for tag_id, question_id in (Question.tag.through.objects.filter(tag_id__in=ids)
+                                .values_list('tag_id', 'question_id')):
+        loaded[tag_id].append(question_id)
+    # sorted here, the link table has no (tag, question) index to return them in order
+    loaded = {tag_id: array('l', sorted(question_ids)) for tag_id, question_ids in loaded.items()}
+    cache.set_many({POSTINGS_KEY % tag_id: pack(question_ids) for tag_id, question_ids in loaded.items()},
+                   settings.TAG_POSTINGS_TIMEOUT)
+    return loaded
+
+
+def pack(question_ids):
+    return question_ids.tobytes()
+
+
+def unpack(data):
+    question_ids = array('l')
+    question_ids.frombytes(data)
+    return question_ids
+
+
+def invalidate_postings(ids):
+    """Drops cached question lists of tags once the current transaction commits, see caching.after_commit"""
+    after_commit(cache.delete_many, [POSTINGS_KEY % tag_id for tag_id in ids])
+
+
+def contains(sorted_ids, value):
+    position = bisect_left(sorted_ids, value)
+    return position < len(sorted_ids) and sorted_ids[position] == value
+
+
+def intersect(smaller, larger):
+    """Returns sorted ids present in both sorted lists"""
+    if len(smaller) * GALLOP_RATIO < len(larger):
+        return [value for value in smaller if contains(larger, value)]
+    larger = set(larger)
+    return [value for value in smaller if value in larger]
+
+
+def subtract(ids, excluded):
+    """Returns sorted ids not present in sorted excluded list"""
+    if len(ids) * GALLOP_RATIO < len(excluded):
+        return [value for value in ids if not contains(excluded, value)]
+    excluded = set(excluded)
+    return [value for value in ids if value not in excluded]
+
+
+def match(required, rejected=()):
+    """Returns sorted ids present in all required posting lists and in none of rejected ones"""
+    required = sorted(required, key=len)
+    result = list(required[0])
+    for question_ids in required[1:]:
+        result = intersect(result, question_ids)
+    for question_ids in rejected:
+        result = subtract(result, question_ids)
+    return result
+
+
+def filter_questions(queryset, tags, excluded=(), field='pk'):
+    """Returns queryset restricted to questions having all tags and none of excluded ones, field of its model refers
+    to the question (search postings are restricted by 'question_id')
+
+    Posting lists are loaded only for tags having at most MAX_INLINE_IDS questions and their ids are passed as
+    parameters. Larger tags are matched by correlated lookups of the link table, so the database keeps reading
+    questions in order of the index of the requested sorting and stops at the page limit
+    """
+    tags, excluded = set(tags), set(excluded)
+    ids = tag_ids(tags | excluded)
+    if any(name not in ids for name in tags):
+        return queryset.none()
+    required = {ids[name] for name in tags}
+    rejected = {ids[name] for name in excluded if name in ids}
+    lists = short_postings(required | rejected)
+    loaded = [lists[tag_id] for tag_id in required if tag_id in lists]
+    if loaded:
+        ids = match(loaded, [lists[tag_id] for tag_id in rejected if tag_id in lists])
+        queryset = queryset.filter(**{field + '__in': ids})
+        return link_questions(queryset, required.difference(lists), rejected.difference(lists), field)
+
+    rejected_ids = sorted(set().union(*(lists[tag_id] for tag_id in rejected if tag_id in lists)))
+    if len(rejected_ids) > MAX_INLINE_IDS:
+        return link_questions(queryset, required, rejected, field)
+    if rejected_ids:
+        queryset = queryset.exclude(**{field + '__in': rejected_ids})
+    return link_questions(queryset, required, rejected.difference(lists), field)
+
+
+def link_questions(queryset, required=(), rejected=(), field='pk'):
+    """Restricts queryset by EXISTS lookups of the link table on tag ids, each one a search of its unique index"""
+    links = Question.tag.through.objects
+    for tag_id, tagged in sorted([(tag_id, True) for tag_id in required] + [(tag_id, False) for tag_id in rejected]):
+        name = 'tagged_%d' % tag_id
+        queryset = (queryset.annotate(**{name: Exists(links.filter(question_id=OuterRef(field), tag_id=tag_id))})
+                    .filter(**{name: tagged}))
+    return queryset
+
+
+def join_questions(queryset, tags, excluded=()):
+    """Join based equivalent of filter_questions, kept as the baseline of benchmarks"""
+    for name in set(tags):
+        queryset = queryset.filter(tag__tag=name)
+    if excluded:
+        queryset = queryset.exclude(tag__tag__in=set(excluded))
+    return queryset
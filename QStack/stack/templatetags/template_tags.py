@@ -1,6 +1,6 @@
 from django import template
 
-from stack.models import Question, Answer
+from stack.caching import get_trending
 
 register = template.Library()
 
@@ -14,6 +14,12 @@ def is_voted(obj, current_user):
         return
 
 
+@register.simple_tag
+def vote_state(vote_states, obj):
+    """Returns vote sign of current user for question/answer from preloaded vote states"""
+    return vote_states.get(obj.id)
+
+
 @register.simple_tag
 def is_there_correct(answer):
     """Returns True if given answer is accepted"""
@@ -23,9 +29,7 @@ def is_there_correct(answer):
 @register.simple_tag
 def is_correct_answer_given(question):
     """Returns True if given question already has accepted answer"""
-    if Answer.objects.filter(correctness=True, question=question).count() > 0:
-        return True
-    return False
+    return question.accepted_answer_id is not None
 
 
 @register.simple_tag
@@ -36,5 +40,5 @@ def get_author(obj):
 
 @register.simple_tag
 def trending_list():
-    """Returns top 10 questions by number of votes"""
-    return Question.objects.order_by('-votes')[:10]
+    """Returns top questions by number of votes, served from cache"""
+    return get_trending()
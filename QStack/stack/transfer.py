@@ -0,0 +1,237 @@
+import datetime
+import json
+
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from django.utils.dateparse import parse_datetime
+
+from .caching import (invalidate_leaderboard, invalidate_listing, invalidate_reputation, invalidate_tags,
+                      invalidate_trending)
+from .models import User, Question, Answer, Tag, VoteQuestion, VoteAnswer
+from .recompute import (recompute_votes, recompute_question_stats, recompute_tag_counts, recompute_hot_scores,
+                        recompute_reputation)
+from .search import rebuild_index
+
+CHUNK_SIZE = 1000
+
+USER_FIELDS = ('username', 'email', 'password', 'first_name', 'last_name', 'is_active', 'is_staff',
+               'is_superuser', 'date_joined', 'last_login', 'image')
+
+# records are flushed in this order so that every reference points to an already stored row
+MODELS = ('user', 'tag', 'question', 'answer', 'vote_question', 'vote_answer')
+
+
+class TransferError(Exception):
+    pass
+
+
+def encode_value(value):
+    """Keeps full precision of datetimes, unlike DjangoJSONEncoder which truncates them to milliseconds"""
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    raise TypeError(repr(value))
+
+
+def chunked(queryset, chunk_size=CHUNK_SIZE):
+    """Yields objects of the queryset in id order reading it by keyset chunks"""
+    last_id = 0
+    while True:
+        chunk = list(queryset.filter(pk__gt=last_id).order_by('pk')[:chunk_size])
+        if not chunk:
+            return
+        yield from chunk
+        last_id = chunk[-1].pk
+
+
+def export_records(chunk_size=CHUNK_SIZE):
+    """Yields NDJSON records of all users, tags, questions, answers and votes"""
+    usernames = {}
+    for user in chunked(User.objects.only(*USER_FIELDS), chunk_size):
+        usernames[user.id] = user.username
+        record = {field: getattr(user, field) for field in USER_FIELDS}
+        record['image'] = user.image.name or None
+        yield dict(record, model='user')
+
+    tags = {}
+    for tag in chunked(Tag.objects.all(), chunk_size):
+        tags[tag.id] = tag.tag
+        yield {'model': 'tag', 'tag': tag.tag}
+
+    for question in chunked(Question.objects.only('id', 'header', 'content', 'pub_date', 'user_id')
+                            .prefetch_related('tag'), chunk_size):
+        yield {'model': 'question', 'id': question.id, 'header': question.header, 'content': question.content,
+               'pub_date': question.pub_date, 'user': usernames.get(question.user_id),
+               'tags': [tags[tag.id] for tag in question.tag.all()]}
+
+    for answer in chunked(Answer.objects.only('id', 'question_id', 'content', 'pub_date', 'correctness', 'user_id'),
+                          chunk_size):
+        yield {'model': 'answer', 'id': answer.id, 'question': answer.question_id, 'content': answer.content,
+               'pub_date': answer.pub_date, 'correctness': answer.correctness,
+               'user': usernames.get(answer.user_id)}
+
+    for model, vote_model in (('vote_question', VoteQuestion), ('vote_answer', VoteAnswer)):
+        field = vote_model.target_field + '_id'
+        for vote in chunked(vote_model.objects.all(), chunk_size):
+            yield {'model': model, vote_model.target_field: getattr(vote, field),
+                   'user': usernames[vote.user_id], 'up': vote.rate_sign}
+
+
+def export_ndjson(stream, chunk_size=CHUNK_SIZE):
+    """Writes all Q&A data into the stream one JSON record per line, returns number of records"""
+    count = 0
+    for line in export_lines(chunk_size):
+        stream.write(line)
+        count += 1
+    return count
+
+
+def export_lines(chunk_size=CHUNK_SIZE):
+    """Yields NDJSON lines of all records"""
+    for record in export_records(chunk_size):
+        yield json.dumps(record, default=encode_value) + '\n'
+
+
+class Importer(object):
+    """Buffers NDJSON records and stores them with bulk_create, users and tags are resolved through in-memory maps"""
+
+    def __init__(self, chunk_size=CHUNK_SIZE):
+        self.chunk_size = chunk_size
+        self.buffers = {model: [] for model in MODELS}
+        self.users = {}
+        self.tags = {}
+        self.counts = {model: 0 for model in MODELS}
+
+    def add(self, record):
+        model = record.get('model')
+        if model not in self.buffers:
+            raise TransferError('Unknown record: %r' % record)
+        self.buffers[model].append(record)
+        if len(self.buffers[model]) >= self.chunk_size:
+            self.flush()
+
+    @transaction.atomic
+    def flush(self):
+        """Stores all buffered records in dependency order"""
+        for model in MODELS:
+            records = self.buffers[model]
+            if records:
+                getattr(self, 'store_' + model)(records)
+                self.counts[model] += len(records)
+                self.buffers[model] = []
+
+    def user_ids(self, usernames):
+        """Returns {username: id} for given usernames, loading the unknown ones in bulk"""
+        missing = {name for name in usernames if name and name not in self.users}
+        if missing:
+            self.users.update(User.objects.filter(username__in=missing).values_list('username', 'id'))
+            unknown = missing.difference(self.users)
+            if unknown:
+                raise TransferError('Unknown users: %s' % ', '.join(sorted(unknown)))
+        return self.users
+
+    def tag_ids(self, names):
+        """Returns {tag: id} for given tags, existing ones are loaded and missing ones created in bulk"""
+        missing = {name for name in names if name not in self.tags}
+        if missing:
+            found = dict(Tag.objects.filter(tag__in=missing).values_list('tag', 'id'))
+            new_tags = [Tag(tag=name) for name in missing if name not in found]
+            if new_tags:
+                Tag.objects.bulk_create(new_tags)
+                found.update(Tag.objects.filter(tag__in=[tag.tag for tag in new_tags]).values_list('tag', 'id'))
+            self.tags.update(found)
+        return self.tags
+
+    def store_user(self, records):
+        """Creates users not present yet, existing ones are matched by username"""
+        self.users.update(User.objects.filter(username__in=[record['username'] for record in records])
+                          .values_list('username', 'id'))
+        users = []
+        for record in records:
+            if record['username'] in self.users:
+                continue
+            fields = {field: record[field] for field in USER_FIELDS if field in record}
+            for field in ('date_joined', 'last_login'):
+                if fields.get(field):
+                    fields[field] = parse_datetime(fields[field])
+            users.append(User(**fields))
+        User.objects.bulk_create(users)
+        self.user_ids(user.username for user in users)
+
+    def store_tag(self, records):
+        self.tag_ids(record['tag'] for record in records)
+
+    def store_question(self, records):
+        users = self.user_ids(record.get('user') for record in records)
+        tags = self.tag_ids(tag for record in records for tag in record.get('tags', ()))
+        Question.objects.bulk_create(
+            Question(id=record['id'], header=record['header'], content=record.get('content'),
+                     pub_date=parse_datetime(record['pub_date']), last_activity_at=parse_datetime(record['pub_date']),
+                     user_id=users.get(record.get('user')))
+            for record in records)
+        Question.tag.through.objects.bulk_create(
+            Question.tag.through(question_id=record['id'], tag_id=tags[tag])
+            for record in records for tag in set(record.get('tags', ())))
+
+    def store_answer(self, records):
+        users = self.user_ids(record.get('user') for record in records)
+        Answer.objects.bulk_create(
+            Answer(id=record['id'], question_id=record.get('question'), content=record['content'],
+                   pub_date=parse_datetime(record['pub_date']), correctness=record.get('correctness', False),
+                   user_id=users.get(record.get('user')))
+            for record in records)
+
+    def store_votes(self, vote_model, records):
+        users = self.user_ids(record['user'] for record in records)
+        field = vote_model.target_field + '_id'
+        vote_model.objects.bulk_create(
+            vote_model(**{field: record[vote_model.target_field], 'user_id': users[record['user']],
+                          'rate_sign': record['up']})
+            for record in records)
+
+    def store_vote_question(self, records):
+        self.store_votes(VoteQuestion, records)
+
+    def store_vote_answer(self, records):
+        self.store_votes(VoteAnswer, records)
+
+
+def finish_import(index=True):
+    """Recomputes denormalized counts once for the whole dataset and drops stale caches"""
+    with connection.cursor() as cursor:
+        for sql in connection.ops.sequence_reset_sql(no_style(), [User, Tag, Question, Answer]):
+            cursor.execute(sql)
+    recompute_votes()
+    recompute_question_stats()
+    recompute_hot_scores()
+    recompute_tag_counts()
+    recompute_reputation()
+    if index:
+        rebuild_index()
+    invalidate_listing()
+    invalidate_tags()
+    invalidate_trending()
+    invalidate_leaderboard()
+    invalidate_reputation()
+
+
+def import_ndjson(stream, chunk_size=CHUNK_SIZE, index=True):
+    """Reads NDJSON records from the stream storing them chunk by chunk, returns {model: number of records}
+
+    Questions and answers keep their exported ids, so they can only be imported into a database without them
+    """
+    if Question.objects.exists() or Answer.objects.exists():
+        raise TransferError('The database already has questions or answers, import keeps exported ids and needs '
+                            'a database without them (users and tags are matched by name)')
+    importer = Importer(chunk_size)
+    for number, line in enumerate(stream, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            raise TransferError('Line %d is not valid JSON' % number)
+        importer.add(record)
+    importer.flush()
+    finish_import(index)
+    return importer.counts
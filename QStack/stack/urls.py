@@ -15,6 +15,7 @@ urlpatterns = [
     path('profile/', views.Profile.as_view(), name='profile'),
     path('ask/', views.ask, name='ask'),
     path('tags/', views.tags, name='tags'),
+    path('users/', views.users, name='users'),
     path('ask_question/', views.ask_question, name='ask_question'),
     url(r'^account_activation_sent/$', views.account_activation_sent, name='account_activation_sent'),
     url(r'^activate/(?P<uidb64>.+)/(?P<token>.+)/$',
@@ -1,92 +1,115 @@
-import operator
+from django.db import IntegrityError, transaction
 
-from django.core.paginator import EmptyPage, PageNotAnInteger
-from django.utils.datastructures import MultiValueDictKeyError
-from django.db.models import Q
-from functools import reduce
+from .models import Question, Answer, Tag, VoteQuestion, VoteAnswer, RelatedQuestion
+from .pagination import ORDER_KEYS, SEARCH_KEYS
+from .search import search_questions
+from .tagindex import filter_questions, parse_query
 
-from .models import Question, Answer, Tag
 
+def load_questions(queryset=None):
+    """Returns questions with everything rendered for a list row (author, tags, answer count) loaded in bulk"""
+    if queryset is None:
+        queryset = Question.objects.all()
+    return queryset.select_related('user').prefetch_related('tag')
 
-def set_list_order(request):
-    """Switches order od rendered questions (either by date or by votes number)"""
-    if "current_order" not in request.session:
-        request.session['current_order'] = '-pub_date'
 
-    if request.method == "GET":
-        if 'order' in request.GET:
-            if request.GET['order'] == 'date':
-                request.session['current_order'] = '-pub_date'
-            elif request.GET['order'] == 'vote':
-                request.session['current_order'] = '-votes'
+def load_related(question):
+    """Returns [(id, header)] of related questions stored by rebuild_related in a single indexed lookup"""
+    return list(RelatedQuestion.objects.filter(question=question).order_by('rank')
+                .values_list('related_id', 'related__header'))
+
+
+# values of ?order= parameter of question lists, lists are ordered by date without it
+LIST_ORDERS = {'date': '-pub_date', 'vote': '-votes', 'hot': '-hot_score'}
+
+
+def get_list_order(request):
+    """Returns order of listed questions (by date, by votes number or hot ones) carried in the URL, not in the session"""
+    return LIST_ORDERS.get(request.GET.get('order'), '-pub_date')
 
 
 def fetch_questions(user_query, order, by_tag=False):
-    """Returns list of question matching against search query (either by key words or by tag)"""
-    try:
-        if user_query:
-            tag_query = user_query.split(':')
-            if len(tag_query) == 2 and tag_query[0] == 'tag':
-                by_tag = True
-                key_words = [tag_query[1]]
-            else:
-                key_words = user_query.replace(';', ' ').replace(',', ' ').split()
-            if by_tag:
-                question_list = Question.objects.filter(tag__tag__in=key_words)
-            else:
-                query = reduce(operator.or_, (Q(header__icontains=word) |
-                                              Q(content__icontains=word) for word in key_words))
-                question_list = Question.objects.filter(query)
-            question_list = question_list.order_by(order)
-            return question_list
-    except KeyError:
-        pass
-
-
-def paginate(request, paginator, item_list):
-    """Returns list of items (questions or answers) should be rendered on given page"""
-
-    def get_page_range():
-        """Returns range of pages rendered at the bottom"""
-        index = item_list.number - 1
-        max_index = len(paginator.page_range)
-        start_index = index - 3 if index >= 3 else 0
-        end_index = index + 3 if index <= max_index - 3 else max_index
-        return list(paginator.page_range)[start_index:end_index]
-
-    try:
-        page_num = request.GET["page_number"]
-        item_list = paginator.page(page_num)
-    except (KeyError, EmptyPage, PageNotAnInteger, MultiValueDictKeyError) as e:
-        page_num = 1
-        item_list = paginator.page(page_num)
-    finally:
-        return item_list, get_page_range()
+    """Returns list of question matching against search query (either by key words or by tags)
+
+    The query may require and exclude tags ('tag:python tag:django -tag:flask'), with by_tag all its words are tags.
+    Questions found by key words are ranked by relevance (the search.RESULT_LIMIT best ones), tag matches follow the
+    given order
+    """
+    if not user_query:
+        return None
+    query = parse_query(user_query)
+    if by_tag:
+        query.tags.extend(word.lower() for word in query.words)
+        query.words = []
+    if query.words:
+        questions = search_questions(' '.join(query.words), query.tags, query.excluded)
+    elif query:
+        questions = filter_questions(Question.objects.order_by(order), query.tags, query.excluded)
+    else:
+        questions = Question.objects.order_by(order)
+    return load_questions(questions)
+
+
+def find_questions(params, order):
+    """Returns questions listed for 'search' or 'tag' parameter (all of them without it), their pagination keys
+    and the parameter to be kept in page links
+    """
+    question_list = None
+    page_query = {}
+    if 'search' in params:
+        question_list = fetch_questions(params['search'], order)
+        page_query['search'] = params['search']
+    elif 'tag' in params:
+        question_list = fetch_questions(params['tag'], order, by_tag=True)
+        page_query['tag'] = params['tag']
+
+    if question_list is None:
+        return load_questions(), ORDER_KEYS[order], page_query
+    if 'search_rank' in question_list.query.annotations:
+        return question_list, SEARCH_KEYS, page_query
+    return question_list, ORDER_KEYS[order], page_query
 
 
 def vote(request, message):
-    """Either upvotes or downvotes questions, answers"""
+    """Either upvotes or downvotes questions, answers (repeated vote cancels it)
+
+    Returns new votes count and vote state of the user or None if nothing has been voted
+    """
     if request.method == "POST" and request.user.is_authenticated:
         if 'upvote' in request.POST:
-                if message.upvote(request.user) == 'already_upvoted':
-                    message.cancel_vote(request.user)
+            return message.upvote(request.user)
         elif 'downvote' in request.POST:
-                if message.downvote(request.user) == 'already_downvoted':
-                    message.cancel_vote(request.user)
+            return message.downvote(request.user)
+
+
+def resolve_tags(names):
+    """Returns tags with given names creating missing ones in bulk"""
+    names = set(names)
+    tags = list(Tag.objects.filter(tag__in=names))
+    missing = names.difference(tag.tag for tag in tags)
+    if missing:
+        try:
+            with transaction.atomic():
+                Tag.objects.bulk_create([Tag(tag=name) for name in missing])
+        except IntegrityError:
+            # some of them have just been created by a concurrent request, the rest is created one by one
+            tags.extend(Tag.objects.get_or_create(tag=name)[0] for name in missing)
+        else:
+            tags.extend(Tag.objects.filter(tag__in=missing))
+    return tags
+
+
+def add_tags(new_tags, question):
+    """Puts tags into given question with a single insert of links"""
+    if new_tags:
+        question.tag.add(*resolve_tags(new_tags))
 
 
 def add_tag(new_tag, question):
     """Puts tag into given question"""
-    if not Tag.objects.filter(tag=new_tag).exists():
-        tag = Tag(tag=new_tag)
-        tag.save()
-    else:
-        tag = Tag.objects.get(tag=new_tag)
-    question.tag.add(tag)
+    add_tags([new_tag], question)
 
 
 def is_correct_answer_given(question):
     """Returns true if question already has acceoted answer"""
-    if Answer.objects.filter(correctness=True, question=question).count() > 0:
-        return True
-    return False
+    return question.accepted_answer_id is not None
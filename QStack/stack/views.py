@@ -1,52 +1,102 @@
+import os
+
+from django.conf import settings
 from django.template import loader
+from django.template.loader import render_to_string
 from django.shortcuts import get_object_or_404, render
-from django.http import HttpResponseRedirect, HttpResponse
+from django.http import HttpResponseRedirect, HttpResponse, HttpResponseForbidden
 from django.urls import reverse, reverse_lazy
 from django.views import generic
 from django.contrib import messages
-from django.core.paginator import Paginator
-from django.core.mail import send_mail
 from django.contrib.auth import get_user_model
 from django.contrib.auth import login
-from django.utils.http import urlsafe_base64_decode
-
+from django.utils.cache import patch_cache_control
+from django.utils.http import urlsafe_base64_decode, urlencode
+from django.views.decorators.http import require_POST
+from django.views.static import serve
+
+from .avatars import AVATAR_DIR
+from .caching import (get_question_count, cache_anonymous_page, cached_fragment, conditional_page, csrf_secret,
+                      listing_version, question_version, tags_version, trending_version, leaderboard_version,
+                      related_version, reputation_version)
 from .forms import CustomUserCreationForm, CustomUserChangeForm
+from .mail import enqueue_mail
+from .metrics import metrics_allowed, render_metrics
+from .pagination import CursorPaginator, ANSWER_KEYS, TAG_KEYS, USER_KEYS
+from .routers import replica_reads
+from .sqlite import run_write
 from .tokens import account_activation_token
 from .utils import *
 
 
-def index(request):
-    question_list = []
-    set_list_order(request)
+def index_page_key(request):
+    return listing_version(), reputation_version(), get_list_order(request), sorted(request.GET.items())
+
+
+def detail_page_key(request, question_id):
+    return (question_id, question_version(question_id), related_version(), reputation_version(),
+            request.GET.get('cursor'))
+
 
-    if 'search' in request.GET:
-        question_list = fetch_questions(request.GET['search'], request.session['current_order'])
-    elif 'tag' in request.GET:
-        question_list = fetch_questions(request.GET['tag'], request.session['current_order'], by_tag=True)
+def index_validators(request):
+    return (listing_version(), reputation_version(), trending_version()), index_page_key(request)[2:]
 
-    if not question_list and not any(param in ['search', 'tag'] for param in request.GET):
-        question_list = Question.objects.order_by(request.session['current_order'])
 
-    pag = Paginator(question_list, 20, orphans=0, allow_empty_first_page=True)
-    question_list, page_range = paginate(request, pag, question_list)
+def detail_validators(request, question_id):
+    return ((question_version(question_id), trending_version(), related_version(), reputation_version()),
+            (question_id, request.GET.get('cursor')))
+
+
+@replica_reads
+@conditional_page(index_validators)
+@cache_anonymous_page(index_page_key)
+def index(request):
+    order = get_list_order(request)
+    question_list, keys, page_query = find_questions(request.GET, order)
+    # all questions are counted whatever their order, searches and tags are not
+    question_count = None if page_query else get_question_count()
+    if order != '-pub_date':
+        page_query['order'] = request.GET['order']
+    question_list = CursorPaginator(question_list, keys, per_page=20).page(request.GET.get('cursor'))
 
     template = loader.get_template('stack/index.html')
     context = {
             'question_list': question_list,
-            'page_range': page_range,
-            'list_order': request.session['current_order'],
+            'page_query': urlencode(page_query),
+            'question_count': question_count,
+            'list_order': order,
         }
     return HttpResponse(template.render(context, request))
 
 
+@replica_reads
+@conditional_page(detail_validators)
+@cache_anonymous_page(detail_page_key)
 def detail(request, question_id):
-    question = get_object_or_404(Question, pk=question_id)
-    answer_list = question.answer_set.get_queryset().order_by('-votes', '-pub_date')
-    pag = Paginator(answer_list, 20, orphans=0, allow_empty_first_page=True)
-    answer_list, page_range = paginate(request, pag, answer_list)
+    question = get_object_or_404(load_questions(), pk=question_id)
+    question_resolved = is_correct_answer_given(question)
+
+    def render_answers():
+        answer_list = question.answer_set.select_related('user')
+        answer_list = CursorPaginator(answer_list, ANSWER_KEYS, per_page=20).page(request.GET.get('cursor'))
+        context = {'question': question, 'answer_list': answer_list, 'question_resolved': question_resolved,
+                   'answer_votes': VoteAnswer.objects.state_map(request.user, answer_list)}
+        return (render_to_string('stack/answer_list.html', context, request),
+                render_to_string('stack/answer_pages.html', context, request))
+
+    # answer list depends on the viewer (vote arrows, mark buttons, csrf tokens of the forms), the secret is made
+    # before the lookup so that a fragment is never shared by clients without the cookie
+    answer_list_html, answer_pages_html = cached_fragment(
+        ('answers', question.id, question_version(question.id), reputation_version(), request.GET.get('cursor'),
+         request.user.pk, csrf_secret(request)), render_answers)
+
     return render(request, 'stack/detail.html', {'question': question,
-                                                 'answer_list': answer_list, 'page_range': page_range,
-                                                 'question_resolved': is_correct_answer_given(question)})
+                                                 'answer_list_html': answer_list_html,
+                                                 'answer_pages_html': answer_pages_html,
+                                                 'question_resolved': question_resolved,
+                                                 'related_questions': load_related(question),
+                                                 'question_vote': VoteQuestion.objects.state_map(
+                                                     request.user, [question]).get(question.id)})
 
 
 def vote_question(request, question_id):
@@ -61,8 +111,12 @@ def vote_answer(request, question_id, answer_id):
     return HttpResponseRedirect(request.META.get('HTTP_REFERER'))
 
 
+@require_POST
 def mark_answer(request, question_id, answer_id):
-    answer = get_object_or_404(Answer, pk=answer_id)
+    """Toggles the mark of the answer, only the author of the question may mark its answers"""
+    answer = get_object_or_404(Answer.objects.select_related('question'), pk=answer_id, question_id=question_id)
+    if not request.user.is_authenticated or answer.question.user_id != request.user.pk:
+        return HttpResponseForbidden()
     answer.change_mark()
     return HttpResponseRedirect(request.META.get('HTTP_REFERER'))
 
@@ -74,12 +128,16 @@ def give_answer(request, question_id):
 
     question = get_object_or_404(Question, pk=question_id)
     if request.method == 'POST' and request.user.is_authenticated:
-        answer = Answer(content=request.POST['answer'].rstrip(), question=question, user=request.user)
-        answer.save()
+        def save_answer():
+            answer = Answer(content=request.POST['answer'].rstrip(), question=question, user=request.user)
+            answer.save()
 
-        send_mail('New answer', 'You have gotten a new answer to your question: '
-                  + request.build_absolute_uri().replace('give_answer/', ''),
-                  'test@example.com', [request.user.email], fail_silently=True)
+            if question.user and question.user != request.user and question.user.email:
+                enqueue_mail('New answer', 'You have gotten a new answer to your question: '
+                             + request.build_absolute_uri(reverse('stack:detail', args=(question_id,))),
+                             [question.user.email])
+
+        run_write(save_answer, Answer)
 
     return HttpResponseRedirect(reverse('stack:detail', args=(question_id,)))
 
@@ -110,9 +168,7 @@ def ask_question(request):
                                 user=request.user)
         new_question.save()
 
-        if entered_tags:
-            for entered_tag in entered_tags:
-                add_tag(entered_tag, new_question)
+        add_tags(entered_tags, new_question)
 
         return detail(request, new_question.id)
 
@@ -124,10 +180,49 @@ def ask(request):
     return HttpResponse(template.render({}, request))
 
 
+@replica_reads
 def tags(request):
+    order = request.GET.get('order')
+    if order not in TAG_KEYS:
+        order = 'popular'
+    cursor = request.GET.get('cursor')
+
+    def render_tags():
+        tag_list = CursorPaginator(Tag.objects.all(), TAG_KEYS[order], per_page=60).page(cursor)
+        return render_to_string('stack/tag_list.html', {'tags': tag_list, 'tag_order': order})
+
     template = loader.get_template('stack/tags.html')
-    tag_list = Tag.objects.order_by('tag')
-    return HttpResponse(template.render({'tags': tag_list}, request))
+    tag_list_html = cached_fragment(('tags', tags_version(), order, cursor), render_tags)
+    return HttpResponse(template.render({'tag_list_html': tag_list_html, 'tag_order': order}, request))
+
+
+@replica_reads
+def users(request):
+    """Leaderboard of active users by reputation, pages are cached for LEADERBOARD_TIMEOUT seconds"""
+    cursor = request.GET.get('cursor')
+
+    def render_users():
+        user_list = get_user_model().objects.filter(is_active=True).only('id', 'username', 'image', 'reputation')
+        page = CursorPaginator(user_list, USER_KEYS, per_page=settings.LEADERBOARD_PAGE_SIZE).page(cursor)
+        return render_to_string('stack/user_list.html', {'users': page})
+
+    template = loader.get_template('stack/users.html')
+    user_list_html = cached_fragment(('users', leaderboard_version(), cursor), render_users,
+                                     settings.LEADERBOARD_TIMEOUT)
+    return HttpResponse(template.render({'user_list_html': user_list_html}, request))
+
+
+def avatar(request, path):
+    """Serves avatar files, their names are content hashes so they can be cached forever"""
+    response = serve(request, path, document_root=os.path.join(settings.MEDIA_ROOT, AVATAR_DIR))
+    patch_cache_control(response, public=True, max_age=settings.AVATAR_CACHE_MAX_AGE, immutable=True)
+    return response
+
+
+def metrics(request):
+    if not metrics_allowed(request):
+        return HttpResponseForbidden()
+    return HttpResponse(render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
 
 
 class SignUp(generic.CreateView):
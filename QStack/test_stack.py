@@ -0,0 +1,1821 @@
+import base64
+import datetime
+import hashlib
+import json
+import mmap
+import re
+import shutil
+import tempfile
+import threading
+from io import BytesIO, StringIO
+from unittest import mock
+
+from PIL import Image
+
+from django.conf import settings
+from django.contrib import admin
+from django.core import mail
+from django.core.exceptions import ValidationError
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.cache import cache
+from django.core.mail.backends.locmem import EmailBackend
+from django.core.management import CommandError, call_command
+from django.db import OperationalError, connection, connections, transaction
+from django.db.models import Count
+from django.template import Context, Template
+from django import test
+from django.test import Client, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from stack.mail import claim_batch, due_messages, enqueue_mail, send_queued_mail
+from stack.models import (Question, Answer, User, Tag, SearchPosting, VoteQuestion, VoteAnswer, OutgoingEmail,
+                          RelatedQuestion)
+from stack.admin import CustomUserAdmin
+from stack.avatars import validate_avatar
+from stack.benchmark import run_scenarios, write_load
+from stack.forms import CustomUserCreationForm
+from stack.caching import get_trending, cache_stats, invalidate_replica, listing_version, question_version
+from stack.checks import check_shared_cache
+from stack.pagination import CursorPaginator, ORDER_KEYS, encode_cursor
+from stack.querycheck import QueryRecorder, explain, fingerprint, plan_problems, query_budget
+from stack.ranking import hot_score
+from stack.recompute import recompute_hot_scores, recompute_tag_counts
+from stack.search import search, rebuild_index
+from stack.sqlite import run_write
+from stack.tagindex import (MAX_INLINE_IDS, POSTINGS_KEY, filter_questions, intersect, join_questions, parse_query,
+                            postings)
+from stack.utils import fetch_questions, add_tag, add_tags, load_related
+
+
+class TestCase(test.TestCase):
+    """Runs on_commit callbacks at once, transactions of test cases are rolled back instead of committed
+
+    Order of invalidations and commits is checked by CommitOrderTestSet against real commits
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.on_commit = mock.patch('django.db.transaction.on_commit', lambda func, using=None: func())
+        cls.on_commit.start()
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        cls.on_commit.stop()
+
+
+class SearchIndexTestSet(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username="search_user", email="search@mail.com", password="password")
+        cls.sorting = Question.objects.create(header="Why is sorted array faster",
+                                              content="Branch prediction question", user=cls.user)
+        cls.python = Question.objects.create(header="Python list comprehension",
+                                             content="How to flatten a list", user=cls.user)
+        Answer.objects.create(content="Use itertools chain to flatten", question=cls.python, user=cls.user)
+
+    def test_index_updated_on_save(self):
+        """Verify that new and edited questions/answers are searchable without rebuilding the index"""
+        question = Question.objects.create(header="Django migrations", content="", user=self.user)
+        self.assertEqual(search("migrations")[0][0], question.id)
+
+        question.header = "Django signals"
+        question.save()
+        self.assertEqual(search("migrations"), [])
+        self.assertEqual(search("signals")[0][0], question.id)
+
+        answer = Answer.objects.create(content="receiver decorator", question=question, user=self.user)
+        self.assertEqual(search("receiver")[0][0], question.id)
+        answer.delete()
+        self.assertEqual(search("receiver"), [])
+
+    def test_prefix_and_answer_match(self):
+        """Verify that words match as prefixes and terms of answers lead to their questions"""
+        self.assertEqual([question_id for question_id, _ in search("sort")], [self.sorting.id])
+        self.assertEqual([question_id for question_id, _ in search("itertools")], [self.python.id])
+
+    def test_relevance_order(self):
+        """Verify that header matches outrank content matches and votes boost the rank"""
+        other = Question.objects.create(header="Flatten nested list", content="", user=self.user)
+        self.assertEqual(list(fetch_questions("flatten", '-pub_date')), [other, self.python])
+
+        Question.objects.filter(id=self.python.id).update(votes=1000)
+        self.assertEqual(list(fetch_questions("flatten", '-pub_date')), [self.python, other])
+
+    def test_rebuild(self):
+        """Verify that rebuilding the index restores postings"""
+        postings = SearchPosting.objects.count()
+        SearchPosting.objects.all().delete()
+        self.assertEqual(search("python"), [])
+
+        self.assertEqual(rebuild_index(chunk_size=1), postings)
+        self.assertEqual(search("python")[0][0], self.python.id)
+
+
+class QuestionSummaryTestSet(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username="summary_user", email="summary@mail.com", password="password")
+        cls.question = Question.objects.create(header="Summary question", content="", user=cls.user)
+
+    def test_summary_maintained(self):
+        """Verify that answer count, accepted answer and last activity follow answers and marks"""
+        first = Answer.objects.create(content="first", question=self.question, user=self.user)
+        second = Answer.objects.create(content="second", question=self.question, user=self.user)
+        self.question.refresh_from_db()
+        self.assertEqual(self.question.answer_count, 2)
+        self.assertEqual(self.question.last_activity_at, second.pub_date)
+
+        first.change_mark()
+        self.question.refresh_from_db()
+        self.assertEqual(self.question.accepted_answer, first)
+
+        first.delete()
+        self.question.refresh_from_db()
+        self.assertEqual(self.question.answer_count, 1)
+        self.assertIsNone(self.question.accepted_answer)
+
+        second.change_mark()
+        second.change_mark()
+        self.question.refresh_from_db()
+        self.assertIsNone(self.question.accepted_answer)
+
+    def test_reconcile(self):
+        """Verify that reconcile command restores drifted summaries"""
+        answer = Answer.objects.create(content="answer", question=self.question, user=self.user, correctness=True)
+        Question.objects.update(answer_count=42, accepted_answer=None)
+
+        call_command('reconcile_question_stats', stdout=StringIO())
+        self.question.refresh_from_db()
+        self.assertEqual(self.question.answer_count, 1)
+        self.assertEqual(self.question.accepted_answer, answer)
+        self.assertEqual(self.question.last_activity_at, answer.pub_date)
+
+
+class QuestionListQueriesTestSet(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username="list_user", email="list@mail.com", password="password")
+
+    def create_questions(self, count):
+        for i in range(count):
+            user = User.objects.create(username="author%d_%d" % (count, i), email="a%d@mail.com" % i)
+            question = Question.objects.create(header="listed question %d" % i, content="", user=user)
+            add_tag("tag%d" % i, question)
+            add_tag("common", question)
+            Answer.objects.create(content="answer", question=question, user=self.user)
+
+    def count_queries(self, params):
+        cache.clear()
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(reverse('stack:index'), params)
+        self.assertEqual(response.status_code, 200)
+        return len(context.captured_queries)
+
+    def test_constant_queries(self):
+        """Verify that index, search and tag pages run the same number of queries for 2 and 20 questions"""
+        pages = [{}, {'search': 'listed'}, {'tag': 'common'}]
+        self.client.get(reverse('stack:index'))
+
+        self.create_questions(2)
+        small = [self.count_queries(params) for params in pages]
+        self.create_questions(18)
+        large = [self.count_queries(params) for params in pages]
+
+        self.assertEqual(small, large)
+        for queries in large:
+            self.assertLessEqual(queries, 12)
+
+    def test_question_count(self):
+        """Verify that all questions are counted in every order, search and tag lists are not"""
+        self.create_questions(2)
+        for order in ('date', 'vote', 'hot'):
+            self.assertEqual(self.client.get(reverse('stack:index'), {'order': order}).context['question_count'], 2)
+        for params in ({'search': 'listed'}, {'tag': 'common', 'order': 'vote'}):
+            self.assertIsNone(self.client.get(reverse('stack:index'), params).context['question_count'])
+
+
+class VoteStateTestSet(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username="voter", email="voter@mail.com")
+        cls.question = Question.objects.create(header="Voted question", content="", user=cls.user)
+        cls.answers = [Answer.objects.create(content="answer %d" % i, question=cls.question, user=cls.user)
+                       for i in range(4)]
+        VoteQuestion.objects.create(question=cls.question, user=cls.user, rate_sign=False)
+        VoteAnswer.objects.create(answer=cls.answers[0], user=cls.user, rate_sign=True)
+        VoteAnswer.objects.create(answer=cls.answers[1], user=cls.user, rate_sign=False)
+
+    def test_state_map(self):
+        """Verify that vote states of all given answers are returned by one query"""
+        with self.assertNumQueries(1):
+            states = VoteAnswer.objects.state_map(self.user, self.answers)
+        self.assertEqual(states, {self.answers[0].id: 'up', self.answers[1].id: 'down'})
+        self.assertEqual(VoteQuestion.objects.state_map(self.user, [self.question]), {self.question.id: 'down'})
+
+    def test_detail_page(self):
+        """Verify that detail page renders vote arrows of the viewer without per-answer queries"""
+        self.client.force_login(self.user)
+        url = reverse('stack:detail', args=(self.question.id,))
+        self.client.get(url)
+
+        cache.clear()
+        with CaptureQueriesContext(connection) as few_answers:
+            response = self.client.get(url)
+        self.assertContains(response, 'arrow-up_active', count=1)
+        self.assertContains(response, 'arrow-down_active', count=2)
+
+        for i in range(10):
+            Answer.objects.create(content="more %d" % i, question=self.question, user=self.user)
+        cache.clear()
+        with CaptureQueriesContext(connection) as many_answers:
+            self.client.get(url)
+        self.assertEqual(len(few_answers.captured_queries), len(many_answers.captured_queries))
+
+
+class VoteEngineTestSet(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username="engine_voter", email="engine@mail.com")
+        cls.other = User.objects.create(username="engine_voter2", email="engine2@mail.com")
+        cls.question = Question.objects.create(header="Engine question", content="", user=cls.user)
+        cls.answer = Answer.objects.create(content="Engine answer", question=cls.question, user=cls.user)
+
+    def test_transitions(self):
+        """Verify up, switch, cancel and down transitions of a vote"""
+        self.assertEqual(self.answer.upvote(self.user), (1, 'up'))
+        self.assertEqual(self.answer.downvote(self.user), (-1, 'down'))
+        self.assertEqual(self.answer.downvote(self.user), (0, None))
+        self.assertEqual(self.answer.downvote(self.user), (-1, 'down'))
+        self.assertEqual(self.answer.cancel_vote(self.user), 0)
+        self.assertEqual(self.question.upvote(self.user), (1, 'up'))
+        self.assertEqual(VoteAnswer.objects.count(), 0)
+        self.assertEqual(VoteQuestion.objects.get().rate_sign, True)
+
+    def test_stale_instances(self):
+        """Verify that votes through stale copies of the same answer are not lost"""
+        first, second = Answer.objects.get(pk=self.answer.pk), Answer.objects.get(pk=self.answer.pk)
+        first.upvote(self.user)
+        self.assertEqual(second.upvote(self.other), (2, 'up'))
+        self.answer.refresh_from_db()
+        self.assertEqual(self.answer.votes, 2)
+
+    def test_vote_view(self):
+        """Verify that repeated vote through the view cancels it"""
+        self.client.force_login(self.user)
+        url = reverse('stack:vote', args=(self.question.id,))
+        self.client.post(url, {'upvote': 'upvote'})
+        self.client.post(url, {'upvote': 'upvote'})
+        self.question.refresh_from_db()
+        self.assertEqual(self.question.votes, 0)
+
+
+class VoteConcurrencyTestSet(TransactionTestCase):
+
+    threads = 8
+    votes_per_thread = 10
+
+    def setUp(self):
+        if connection.vendor == 'sqlite' and connection.is_in_memory_db():
+            self.skipTest("concurrent voting needs a database shared by several connections")
+        author = User.objects.create(username="author", email="author@mail.com")
+        self.question = Question.objects.create(header="Concurrent question", content="", user=author)
+        self.answer = Answer.objects.create(content="Concurrent answer", question=self.question, user=author)
+        self.users = [User.objects.create(username="voter%d" % i, email="voter%d@mail.com" % i)
+                      for i in range(self.threads)]
+
+    def test_concurrent_votes(self):
+        """Verify that vote counts stay exact when many users vote and switch at the same time"""
+        errors = []
+        barrier = threading.Barrier(self.threads)
+
+        def run(user):
+            # every thread votes through its own instances, as separate requests do
+            answer = Answer.objects.get(pk=self.answer.pk)
+            question = Question.objects.get(pk=self.question.pk)
+            try:
+                barrier.wait()
+                # even number of toggles of the up vote followed by a final switch to down
+                for i in range(self.votes_per_thread):
+                    answer.upvote(user)
+                    question.upvote(user)
+                answer.downvote(user)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connections.close_all()
+
+        workers = [threading.Thread(target=run, args=(user,)) for user in self.users]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        self.assertEqual(errors, [])
+        self.answer.refresh_from_db()
+        self.question.refresh_from_db()
+        self.assertEqual(self.answer.votes, -self.threads)
+        self.assertEqual(self.question.votes, 0)
+        self.assertEqual(VoteAnswer.objects.filter(rate_sign=False).count(), self.threads)
+
+
+class SqliteProfileTestSet(TransactionTestCase):
+
+    def setUp(self):
+        if connection.vendor != 'sqlite' or connection.is_in_memory_db():
+            self.skipTest("production profile applies to SQLite database files")
+        self.users = [User.objects.create(username="writer%d" % i, email="writer%d@mail.com" % i) for i in range(4)]
+        for i in range(3):
+            question = Question.objects.create(header="Written question %d" % i, content="", user=self.users[0])
+            add_tag("written", question)
+            Answer.objects.create(content="Written answer", question=question, user=self.users[1])
+
+    def test_pragmas(self):
+        """Verify that new connections run in WAL mode with relaxed syncing"""
+        connection.close()
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA journal_mode')
+            self.assertEqual(cursor.fetchone()[0], 'wal')
+            cursor.execute('PRAGMA synchronous')
+            self.assertEqual(cursor.fetchone()[0], 1)
+
+    def test_retry_on_busy(self):
+        """Verify that writes are repeated while the database is locked and other errors are raised at once"""
+        calls = []
+
+        def flaky(error='database is locked'):
+            calls.append(error)
+            if len(calls) < 3:
+                raise OperationalError(error)
+            return len(calls)
+
+        self.assertEqual(run_write(flaky, Question), 3)
+        del calls[:]
+        with override_settings(SQLITE_WRITE_RETRIES=2), self.assertRaises(OperationalError):
+            run_write(flaky, Question)
+        del calls[:]
+        with self.assertRaises(OperationalError):
+            run_write(flaky, Question, 'no such table')
+        self.assertEqual(len(calls), 1)
+
+    def test_retried_mark(self):
+        """Verify that a mark retried on busy database is toggled and rewarded once"""
+        answer = Answer.objects.first()
+        calls = []
+        now = timezone.now
+
+        def busy_once():
+            calls.append(None)
+            if len(calls) == 1:
+                raise OperationalError('database is locked')
+            return now()
+
+        with mock.patch('django.utils.timezone.now', busy_once):
+            self.assertTrue(answer.change_mark())
+        self.assertEqual(len(calls), 2)
+        self.assertTrue(Answer.objects.get(pk=answer.pk).correctness)
+        self.assertEqual(User.objects.get(pk=answer.user_id).reputation, answer.accepted_points)
+        self.assertEqual(Question.objects.get(pk=answer.question_id).accepted_answer_id, answer.pk)
+
+    @override_settings(SQLITE_WRITE_QUEUE=True)
+    def test_write_queue(self):
+        """Verify that queued writes run in the writer thread and concurrent load keeps counts exact"""
+        self.assertNotEqual(run_write(threading.get_ident, Question), threading.get_ident())
+        report = write_load(threads=4, writes=10, readers=1)
+        self.assertEqual((report['writes'], report['failed']), (40, 0))
+        for question in Question.objects.annotate(answers=Count('answer', distinct=True)):
+            self.assertEqual(question.votes, VoteQuestion.objects.filter(question=question).count())
+            self.assertEqual(question.answer_count, question.answers)
+
+
+class CommitOrderTestSet(TransactionTestCase):
+    """Readers running while a write is not committed yet must not cache its old rows under new versions"""
+
+    def setUp(self):
+        if connection.vendor != 'sqlite' or connection.is_in_memory_db():
+            self.skipTest("concurrent readers need a database file")
+        cache.clear()
+        self.user = User.objects.create(username="committer", email="committer@mail.com")
+        self.question = Question.objects.create(header="Before commit", content="", user=self.user)
+
+    def read_meanwhile(self, func):
+        """Runs func in another thread with its own connection, returns its result"""
+        result = []
+
+        def read():
+            try:
+                result.append(func())
+            finally:
+                connection.close()
+        thread = threading.Thread(target=read)
+        thread.start()
+        thread.join()
+        return result[0]
+
+    def test_page_cached_meanwhile(self):
+        """Verify that a page rendered before the commit is not served after it"""
+        url = reverse('stack:detail', args=(self.question.id,))
+        self.assertContains(Client().get(url), "Before commit")
+        with transaction.atomic():
+            self.question.header = "After commit"
+            self.question.save()
+            self.assertContains(self.read_meanwhile(lambda: Client().get(url)), "Before commit")
+        self.assertContains(Client().get(url), "After commit")
+
+    def test_postings_cached_meanwhile(self):
+        """Verify that question lists of tags loaded before the commit are dropped after it"""
+        add_tag("committed", self.question)
+        tag = Tag.objects.get(tag="committed")
+        with transaction.atomic():
+            question = Question.objects.create(header="Tagged meanwhile", content="", user=self.user)
+            add_tag("committed", question)
+            self.assertEqual(list(self.read_meanwhile(lambda: postings([tag.id]))[tag.id]), [self.question.id])
+        self.assertEqual(list(postings([tag.id])[tag.id]), [self.question.id, question.id])
+
+
+@override_settings(TRENDING_SIZE=2)
+class TrendingTestSet(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username="trend_voter", email="trend@mail.com")
+        cls.questions = [Question.objects.create(header="Trending %d" % i, content="", user=cls.user, votes=10 - i)
+                         for i in range(3)]
+
+    def setUp(self):
+        cache.clear()
+
+    def trending_ids(self):
+        return [question['id'] for question in get_trending()]
+
+    def test_served_from_cache(self):
+        """Verify that trending questions are computed once and then served without queries"""
+        self.assertEqual(self.trending_ids(), [self.questions[0].id, self.questions[1].id])
+        with self.assertNumQueries(0):
+            self.trending_ids()
+
+    def test_invalidated_by_vote(self):
+        """Verify that vote moving a question into the top invalidates it and vote below the top does not"""
+        self.trending_ids()
+        Question.objects.create(header="Fresh", content="", user=self.user)
+        with self.assertNumQueries(0):
+            self.trending_ids()
+
+        self.questions[2].upvote(self.user)
+        self.questions[2].upvote(User.objects.create(username="trend_voter2", email="trend2@mail.com"))
+        self.assertEqual(self.trending_ids(), [self.questions[2].id, self.questions[0].id])
+
+    @override_settings(TRENDING_WINDOW_DAYS=7)
+    def test_window(self):
+        """Verify that questions older than the window are not trending"""
+        Question.objects.filter(id=self.questions[0].id).update(pub_date=timezone.now() - datetime.timedelta(days=8))
+        self.assertEqual(self.trending_ids(), [self.questions[1].id, self.questions[2].id])
+
+
+class CursorPaginationTestSet(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username="pager", email="pager@mail.com")
+        for i in range(25):
+            Question.objects.create(header="Paged %d" % i, content="", user=cls.user, votes=i % 3)
+
+    def walk(self, keys, per_page=4):
+        paginator = CursorPaginator(Question.objects.all(), keys, per_page=per_page)
+        pages = [paginator.page()]
+        while pages[-1].has_next:
+            pages.append(paginator.page(pages[-1].next_cursor))
+        return paginator, pages
+
+    def test_walk_forward_and_back(self):
+        """Verify that cursor pages cover every question once in the order of the list and lead back"""
+        for order, keys in ORDER_KEYS.items():
+            paginator, pages = self.walk(keys)
+            walked = [question for page in pages for question in page]
+            self.assertEqual(walked, list(Question.objects.order_by(*keys)))
+            self.assertFalse(pages[0].has_previous)
+
+            page = pages[-1]
+            backwards = [list(page)]
+            while page.has_previous:
+                page = paginator.page(page.previous_cursor)
+                backwards.insert(0, list(page))
+            self.assertEqual(backwards, [list(page) for page in pages])
+
+    def test_invalid_cursor(self):
+        """Verify that malformed cursors and cursors of another order fall back to the first page"""
+        paginator = CursorPaginator(Question.objects.all(), ORDER_KEYS['-votes'], per_page=4)
+        first = list(paginator.page())
+        self.assertEqual(list(paginator.page("garbage")), first)
+        self.assertEqual(list(paginator.page(encode_cursor(ORDER_KEYS['-pub_date'], [timezone.now(), 1]))), first)
+
+        keys = list(ORDER_KEYS['-pub_date'])
+        paginator = CursorPaginator(Question.objects.all(), keys, per_page=4)
+        first = list(paginator.page())
+        now = {'dt': timezone.now().isoformat()}
+        for values in ([{'dt': 'garbage'}, 1], [now, 'x'], [now, None], [now, [1]], [{'dt': 1}, 1], [1, 1]):
+            cursor = base64.urlsafe_b64encode(json.dumps({'k': keys, 'v': values, 'b': False}).encode()).decode()
+            self.assertEqual(list(paginator.page(cursor)), first)
+            self.assertEqual(self.client.get(reverse('stack:index'), {'cursor': cursor}).status_code, 200)
+
+    def test_deep_page_cost(self):
+        """Verify that the last page runs the same single range query as the first one"""
+        _, pages = self.walk(ORDER_KEYS['-votes'])
+        paginator = CursorPaginator(Question.objects.all(), ORDER_KEYS['-votes'], per_page=4)
+        for cursor in (None, pages[-2].next_cursor):
+            with CaptureQueriesContext(connection) as context:
+                paginator.page(cursor)
+            self.assertEqual(len(context.captured_queries), 1)
+            self.assertNotIn('OFFSET', context.captured_queries[0]['sql'])
+
+    def test_index_pages(self):
+        """Verify that index page links to the next page keeping the search"""
+        response = self.client.get(reverse('stack:index'), {'search': 'paged'})
+        page = response.context['question_list']
+        self.assertEqual(len(page), 20)
+        self.assertContains(response, 'search=paged&cursor=' + page.next_cursor)
+
+        response = self.client.get(reverse('stack:index'), {'search': 'paged', 'cursor': page.next_cursor})
+        self.assertEqual(len(response.context['question_list']), 5)
+
+
+class PageCacheTestSet(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username="cached", email="cached@mail.com")
+        cls.question = Question.objects.create(header="Cached question", content="", user=cls.user)
+        cls.answer = Answer.objects.create(content="Cached answer", question=cls.question, user=cls.user)
+
+    def setUp(self):
+        cache.clear()
+
+    def test_anonymous_pages(self):
+        """Verify that anonymous pages are served from cache until the question changes"""
+        for url in (reverse('stack:index'), reverse('stack:detail', args=(self.question.id,))):
+            self.assertEqual(self.client.get(url)['X-Page-Cache'], 'miss')
+            with CaptureQueriesContext(connection) as context:
+                self.assertEqual(self.client.get(url)['X-Page-Cache'], 'hit')
+            self.assertEqual([query for query in context.captured_queries if 'stack_' in query['sql']], [])
+
+            Answer.objects.create(content="Fresh answer", question=self.question, user=self.user)
+            response = self.client.get(url)
+            self.assertEqual(response['X-Page-Cache'], 'miss')
+            self.assertContains(response, "%d" % Question.objects.get().answer_count)
+        self.assertGreaterEqual(cache_stats()['page'], (2, 4))
+
+    def test_answer_fragment(self):
+        """Verify that answer list of logged in user is cached and invalidated by votes"""
+        self.client.force_login(self.user)
+        url = reverse('stack:detail', args=(self.question.id,))
+        self.client.get(url)
+        cache.clear()
+        with CaptureQueriesContext(connection) as cold:
+            self.client.get(url)
+        with CaptureQueriesContext(connection) as warm:
+            response = self.client.get(url)
+        self.assertFalse(any('stack_answer' in query['sql'] for query in warm.captured_queries))
+        self.assertLess(len(warm.captured_queries), len(cold.captured_queries))
+        self.assertNotContains(response, 'arrow-up_active')
+
+        self.answer.upvote(self.user)
+        self.assertContains(self.client.get(url), 'arrow-up_active', count=1)
+
+    def test_list_invalidation(self):
+        """Verify that lists are dropped by changes of their rows only and votes do not load their answers again"""
+        listing, page = listing_version(), question_version(self.question.id)
+        self.question.content = "Edited content"
+        self.question.save(update_fields=['content'])
+        self.assertEqual(listing_version(), listing)
+        self.assertGreater(question_version(self.question.id), page)
+
+        page = question_version(self.question.id)
+        with CaptureQueriesContext(connection) as context:
+            self.answer.upvote(self.user)
+        self.assertEqual(listing_version(), listing)
+        self.assertGreater(question_version(self.question.id), page)
+        # only the votes count is read back
+        self.assertEqual(len([query for query in context.captured_queries
+                              if query['sql'].startswith('SELECT') and 'FROM "stack_answer"' in query['sql']]), 1)
+
+        self.question.upvote(self.user)
+        self.assertGreater(listing_version(), listing)
+
+    def test_fragment_csrf(self):
+        """Verify that a client without csrf cookie does not get forms of an answer list cached for another one"""
+        url = reverse('stack:detail', args=(self.question.id,))
+        clients = [Client(enforce_csrf_checks=True) for _ in range(2)]
+        pages = []
+        for client in clients:
+            client.force_login(self.user)
+            pages.append(client.get(url).content.decode())
+        token = re.search(r'id="upvote_answer%d">\s*<input [^>]*value=\'([^\']+)\'' % self.answer.id, pages[1])
+        response = clients[1].post(reverse('stack:vote', args=(self.question.id, self.answer.id)),
+                                   {'upvote': '', 'csrfmiddlewaretoken': token.group(1)}, HTTP_REFERER=url)
+        self.assertEqual(response.status_code, 302)
+
+
+class ConditionalGetTestSet(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username="validated", email="validated@mail.com")
+        cls.other = User.objects.create(username="other", email="other@mail.com")
+        cls.question = Question.objects.create(header="Validated question", content="", user=cls.user)
+        cls.answer = Answer.objects.create(content="Validated answer", question=cls.question, user=cls.other)
+
+    def setUp(self):
+        cache.clear()
+        self.urls = (reverse('stack:index'), reverse('stack:detail', args=(self.question.id,)))
+
+    def test_not_modified(self):
+        """Verify that repeated requests are answered with 304 without touching questions"""
+        self.client.force_login(self.user)
+        for url in self.urls:
+            # the first page sets csrf cookie the forms of later pages depend on
+            self.client.get(url)
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertIn('Cookie', response['Vary'])
+            with CaptureQueriesContext(connection) as context:
+                repeated = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+            self.assertEqual(repeated.status_code, 304)
+            self.assertEqual(repeated.content, b'')
+            self.assertEqual([query for query in context.captured_queries if 'stack_question' in query['sql']], [])
+            self.assertEqual(self.client.get(url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified']).status_code, 304)
+
+    def test_varies_by_user(self):
+        """Verify that validators differ between users and change with votes"""
+        url = self.urls[1]
+        anonymous = self.client.get(url)['ETag']
+        self.client.force_login(self.user)
+        author = self.client.get(url)['ETag']
+        self.client.force_login(self.other)
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=author).status_code, 200)
+        self.assertNotEqual(anonymous, author)
+
+        etags = [self.client.get(url)['ETag'] for url in self.urls]
+        self.question.upvote(self.user)
+        for url, etag in zip(self.urls, etags):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 200)
+            self.assertNotEqual(response['ETag'], etag)
+
+        etag = self.client.get(url)['ETag']
+        self.answer.change_mark()
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_shared_cache_check(self):
+        """Verify that deployment checks reject a cache local to each process, versions of ETags live there"""
+        self.assertEqual([error.id for error in check_shared_cache(None)], ['stack.E001'])
+        with override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+                                                   'LOCATION': 'stack_cache'}}):
+            self.assertEqual(check_shared_cache(None), [])
+
+
+class SessionlessListTestSet(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username="sessionless", email="sessionless@mail.com")
+        cls.old = Question.objects.create(header="Old popular", content="", user=cls.user, votes=5,
+                                          pub_date=timezone.now() - datetime.timedelta(days=1))
+        cls.new = Question.objects.create(header="New", content="", user=cls.user)
+
+    def setUp(self):
+        cache.clear()
+
+    def test_anonymous_pages(self):
+        """Verify that anonymous readers get ordered lists and questions without touching sessions"""
+        with CaptureQueriesContext(connection) as context:
+            by_votes = self.client.get(reverse('stack:index'), {'order': 'vote'})
+            self.client.get(reverse('stack:index'))
+            self.client.get(reverse('stack:detail', args=(self.new.id,)))
+        self.assertEqual([query for query in context.captured_queries if 'django_session' in query['sql']], [])
+        self.assertNotIn(settings.SESSION_COOKIE_NAME, self.client.cookies)
+        self.assertEqual(list(by_votes.context['question_list']), [self.old, self.new])
+
+        # order is kept by following links, not remembered between requests
+        cache.clear()
+        self.assertEqual(list(self.client.get(reverse('stack:index')).context['question_list']), [self.new, self.old])
+        self.assertContains(by_votes, '<input type="hidden" name="order" value="vote">')
+
+
+@override_settings(DATABASE_REPLICAS=['replica'])
+class ReplicaRoutingTestSet(TestCase):
+    multi_db = True
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username="replicated", email="replicated@mail.com", password="password")
+        cls.question = Question.objects.create(header="Primary question", content="", user=cls.user)
+        cls.answer = Answer.objects.create(content="Primary answer", question=cls.question, user=cls.user)
+        # lagging replica, bulk_create skips signals writing to the primary
+        User.objects.using('replica').bulk_create([User(id=cls.user.id, username=cls.user.username,
+                                                        email=cls.user.email, password=cls.user.password)])
+        Question.objects.using('replica').bulk_create([Question(id=cls.question.id, header="Stale question",
+                                                                content="", user_id=cls.user.id)])
+        Answer.objects.using('replica').bulk_create([Answer(id=cls.answer.id, content="Stale answer",
+                                                            question_id=cls.question.id, user_id=cls.user.id)])
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.user)
+
+    def test_reads_from_replica(self):
+        """Verify that read-only views are served from the replica and writes go to the primary"""
+        self.assertContains(self.client.get(reverse('stack:detail', args=(self.question.id,))), "Stale question")
+        self.assertContains(self.client.get(reverse('api:question', args=(self.question.id,))), "Stale answer")
+        self.client.post(reverse('stack:vote', args=(self.question.id,)), {'upvote': ''})
+        self.assertEqual(Question.objects.using('default').get().votes, 1)
+        self.assertEqual(Question.objects.using('replica').get().votes, 0)
+
+    def test_reads_own_writes(self):
+        """Verify that vote and answer views never show stale counts right after the write"""
+        url = reverse('stack:detail', args=(self.question.id,))
+        response = self.client.post(reverse('api:vote', args=(self.question.id, self.answer.id)), {'upvote': ''})
+        self.assertEqual(response.json()['votes'], 1)
+        data = self.client.get(reverse('api:question', args=(self.question.id,))).json()
+        self.assertEqual((data['header'], data['answer_list'][0]['votes']), ("Primary question", 1))
+
+        response = self.client.post(reverse('stack:give_answer', args=(self.question.id,)), {'answer': "Fresh"},
+                                    follow=True)
+        self.assertContains(response, "Fresh")
+        self.assertEqual(response.context['question'].answer_count, 2)
+
+        # other clients read the replica until it catches up
+        other = self.client_class()
+        other.force_login(self.user)
+        self.assertContains(other.get(url), "Stale question")
+
+    def test_lagging_replica_cache(self):
+        """Verify that pages, fragments and ETags rendered from a lagging replica are dropped once it is synced"""
+        url = reverse('stack:detail', args=(self.question.id,))
+        anonymous = self.client_class()
+        page = anonymous.get(url)
+        self.assertContains(page, "Stale question")
+        self.assertContains(self.client.get(url), "Stale answer")
+
+        Question.objects.using('replica').update(header="Primary question")
+        Answer.objects.using('replica').update(content="Primary answer")
+        invalidate_replica('replica')
+        response = anonymous.get(url, HTTP_IF_NONE_MATCH=page['ETag'])
+        self.assertContains(response, "Primary question")
+        self.assertEqual(response['X-Page-Cache'], 'miss')
+        self.assertContains(self.client.get(url), "Primary answer")
+
+
+class HotRankingTestSet(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username="ranker", email="ranker@mail.com")
+        cls.voters = [User.objects.create(username="fan%d" % i, email="fan%d@mail.com" % i) for i in range(10)]
+        now = timezone.now()
+        cls.old = Question.objects.create(header="Old famous", content="", user=cls.user,
+                                          pub_date=now - datetime.timedelta(days=30))
+        cls.fresh = Question.objects.create(header="Fresh", content="", user=cls.user, pub_date=now)
+        cls.rising = Question.objects.create(header="Rising", content="", user=cls.user,
+                                             pub_date=now - datetime.timedelta(hours=1))
+        for voter in cls.voters:
+            cls.old.upvote(voter)
+
+    def setUp(self):
+        cache.clear()
+
+    def hot_list(self):
+        return list(self.client.get(reverse('stack:index'), {'order': 'hot'}).context['question_list'])
+
+    def test_hot_order(self):
+        """Verify that new questions outrank old famous ones and votes and answers lift them incrementally"""
+        self.assertEqual(Question.objects.order_by('-votes').first(), self.old)
+        self.assertEqual(self.hot_list(), [self.fresh, self.rising, self.old])
+
+        before = Question.objects.get(pk=self.rising.pk).hot_score
+        for voter in self.voters[:5]:
+            self.rising.upvote(voter)
+        Answer.objects.create(content="Lift", question=self.rising, user=self.user)
+        self.assertGreater(Question.objects.get(pk=self.rising.pk).hot_score, before)
+        cache.clear()
+        self.assertEqual(self.hot_list(), [self.rising, self.fresh, self.old])
+
+    def test_vote_rescore(self):
+        """Verify that a vote rescores the question from values it reads back, without reading them again"""
+        with CaptureQueriesContext(connection) as context:
+            self.rising.upvote(self.voters[0])
+        reads = [query['sql'] for query in context.captured_queries
+                 if query['sql'].startswith('SELECT') and 'FROM "stack_question"' in query['sql']]
+        self.assertEqual(len(reads), 1)
+        self.assertAlmostEqual(Question.objects.get(pk=self.rising.pk).hot_score,
+                               hot_score(1, 0, self.rising.pub_date))
+
+    def test_reconcile(self):
+        """Verify that incrementally maintained scores equal recomputed ones"""
+        Answer.objects.create(content="Answer", question=self.fresh, user=self.user)
+        self.old.downvote(self.voters[0])
+        scores = dict(Question.objects.values_list('id', 'hot_score'))
+        Question.objects.update(hot_score=0)
+        call_command('reconcile_question_stats', stdout=StringIO())
+        for question_id, score in Question.objects.values_list('id', 'hot_score'):
+            self.assertAlmostEqual(score, scores[question_id])
+
+        Question.objects.update(hot_score=0)
+        # read and update of two chunks, the empty last read, savepoint and its release
+        with self.assertNumQueries(7):
+            self.assertEqual(recompute_hot_scores(chunk_size=2), 3)
+        for question_id, score in Question.objects.values_list('id', 'hot_score'):
+            self.assertAlmostEqual(score, scores[question_id])
+
+
+class ReputationTestSet(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.asker = User.objects.create_user(username="asker", email="asker@mail.com", password="password")
+        cls.replier = User.objects.create(username="replier", email="replier@mail.com")
+        cls.voters = [User.objects.create(username="judge%d" % i, email="judge%d@mail.com" % i) for i in range(3)]
+        cls.question = Question.objects.create(header="Reputable", content="", user=cls.asker)
+        cls.answer = Answer.objects.create(content="Reputable answer", question=cls.question, user=cls.replier)
+
+    def setUp(self):
+        cache.clear()
+        # change_mark toggles the mark of the instance
+        self.answer = Answer.objects.get(pk=self.answer.pk)
+
+    def reputation(self, user):
+        return User.objects.get(pk=user.pk).reputation
+
+    def test_votes_and_marks(self):
+        """Verify that votes, switched and cancelled votes and marks change reputation of authors"""
+        self.question.upvote(self.voters[0])
+        self.assertEqual(self.reputation(self.asker), 5)
+        self.question.downvote(self.voters[0])
+        self.assertEqual(self.reputation(self.asker), -2)
+        self.question.cancel_vote(self.voters[0])
+        self.assertEqual(self.reputation(self.asker), 0)
+
+        self.answer.upvote(self.voters[1])
+        self.answer.downvote(self.voters[2])
+        self.assertEqual(self.reputation(self.replier), 8)
+        self.answer.change_mark()
+        self.assertEqual(self.reputation(self.replier), 23)
+        self.answer.change_mark()
+        self.assertEqual(self.reputation(self.replier), 8)
+        self.assertEqual(self.reputation(self.voters[1]), 0)
+
+    def test_cached_signatures(self):
+        """Verify that cached pages show changed reputation of authors once REPUTATION_REFRESH has passed"""
+        elsewhere = Question.objects.create(header="Elsewhere", content="", user=self.replier)
+        url = reverse('stack:detail', args=(elsewhere.id,))
+        anonymous = self.client_class()
+        anonymous.get(url)
+        page = anonymous.get(url)
+        self.assertContains(page, '<span class="reputation">0</span>')
+
+        self.answer.upvote(self.voters[0])
+        with self.settings(REPUTATION_REFRESH=60):
+            self.assertEqual(anonymous.get(url, HTTP_IF_NONE_MATCH=page['ETag']).status_code, 304)
+            self.assertContains(anonymous.get(url), '<span class="reputation">0</span>')
+        with self.settings(REPUTATION_REFRESH=0):
+            self.assertEqual(anonymous.get(url, HTTP_IF_NONE_MATCH=page['ETag']).status_code, 200)
+            self.assertContains(anonymous.get(url), '<span class="reputation">10</span>')
+            self.assertContains(anonymous.get(reverse('stack:index')), '<span class="reputation">10</span>')
+
+    def test_mark_permissions(self):
+        """Verify that only the author of the question marks its answers and only by POST"""
+        url = reverse('stack:mark_answer', args=(self.question.id, self.answer.id))
+        detail = reverse('stack:detail', args=(self.question.id,))
+        self.assertEqual(self.client.post(url, HTTP_REFERER=detail).status_code, 403)
+        self.client.force_login(self.replier)
+        self.assertEqual(self.client.post(url, HTTP_REFERER=detail).status_code, 403)
+        self.client.force_login(self.asker)
+        self.assertEqual(self.client.get(url, HTTP_REFERER=detail).status_code, 405)
+        self.assertFalse(Answer.objects.get(pk=self.answer.pk).correctness)
+
+        self.assertRedirects(self.client.post(url, HTTP_REFERER=detail), detail)
+        self.assertTrue(Answer.objects.get(pk=self.answer.pk).correctness)
+        other = Question.objects.create(header="Other", content="", user=self.asker)
+        self.assertEqual(self.client.post(reverse('stack:mark_answer', args=(other.id, self.answer.id))).status_code,
+                         404)
+
+    def test_reconcile(self):
+        """Verify that incrementally maintained reputation equals recomputed one"""
+        for voter in self.voters:
+            self.question.downvote(voter)
+            self.answer.upvote(voter)
+        self.question.upvote(self.voters[0])
+        self.answer.cancel_vote(self.voters[1])
+        self.answer.change_mark()
+        reputation = dict(User.objects.values_list('id', 'reputation'))
+        User.objects.update(reputation=0)
+        out = StringIO()
+        call_command('reconcile_reputation', stdout=out)
+        self.assertIn('Reconciled reputation of %d users' % len(reputation), out.getvalue())
+        self.assertEqual(dict(User.objects.values_list('id', 'reputation')), reputation)
+
+    def test_signatures(self):
+        """Verify that signatures show reputation of authors loaded with the messages"""
+        self.answer.upvote(self.voters[0])
+        self.client.force_login(self.asker)
+        response = self.client.get(reverse('stack:detail', args=(self.question.id,)))
+        self.assertContains(response, '<span class="reputation">10</span>')
+        response = self.client.get(reverse('stack:index'))
+        self.assertContains(response, '<span class="reputation">0</span>')
+
+    def test_leaderboard(self):
+        """Verify that users are listed by reputation page by page and pages are cached"""
+        self.answer.upvote(self.voters[0])
+        self.question.upvote(self.voters[0])
+        url = reverse('stack:users')
+        with self.settings(LEADERBOARD_PAGE_SIZE=1):
+            first = self.client.get(url)
+            self.assertContains(first, 'replier <span class="reputation">10</span>')
+            self.assertNotContains(first, 'asker')
+            cursor = re.search(r'cursor=([^"&]+)', first.content.decode()).group(1)
+            self.assertContains(self.client.get(url, {'cursor': cursor}), 'asker <span class="reputation">5</span>')
+
+            self.question.upvote(self.voters[1])
+            self.question.upvote(self.voters[2])
+            self.assertEqual(self.client.get(url).content, first.content)
+            call_command('reconcile_reputation', stdout=StringIO())
+            self.assertContains(self.client.get(url), 'asker <span class="reputation">15</span>')
+
+
+class RelatedQuestionTestSet(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username="reader", email="reader@mail.com", password="password")
+        cls.sorting = cls.ask("Sorting a python list", "How to sort list of tuples by second item", "python")
+        cls.sorted = cls.ask("Python list sorted in reverse", "Sort a list descending", "python")
+        cls.promise = cls.ask("Awaiting a javascript promise", "Promise never resolves inside async function",
+                              "javascript")
+        cls.async_ = cls.ask("Async javascript function", "Returning value of a promise from async code",
+                             "javascript")
+        cls.css = cls.ask("Centering a div", "Flexbox margin auto", "css")
+
+    @classmethod
+    def ask(cls, header, content, tag):
+        question = Question.objects.create(header=header, content=content, user=cls.user)
+        add_tag(tag, question)
+        return question
+
+    def setUp(self):
+        try:
+            import stack.related
+        except ImportError:
+            self.skipTest("related questions need numpy and scipy")
+        cache.clear()
+
+    def related(self, question):
+        return [related_id for related_id, _ in load_related(question)]
+
+    def rebuild(self, *args):
+        out = StringIO()
+        call_command('rebuild_related', *args, stdout=out)
+        return int(re.search(r'of (\d+) questions', out.getvalue()).group(1))
+
+    def test_rebuild(self):
+        """Verify that questions get similar ones by text and tags, best first, and the page shows them"""
+        self.assertEqual(self.rebuild(), 5)
+        self.assertEqual(self.related(self.sorting), [self.sorted.id])
+        self.assertEqual(self.related(self.promise), [self.async_.id])
+        self.assertEqual(self.related(self.css), [])
+        self.assertFalse(Question.objects.filter(related_stale=True).exists())
+
+        with self.assertNumQueries(1):
+            load_related(self.sorting)
+        response = self.client.get(reverse('stack:detail', args=(self.sorting.id,)))
+        self.assertContains(response, '<h2>Related</h2>')
+        self.assertContains(response, self.sorted.header)
+
+    def test_matrix_on_disk(self):
+        """Verify that the matrix and its transposition built by chunks of rows are kept in memory mapped files and
+        bounds of similarities summed by chunks count questions sharing terms of every row"""
+        import numpy as np
+        from stack.related import build_matrix, row_costs, spill_rows, transpose
+        with tempfile.TemporaryDirectory() as directory:
+            ids, matrix = build_matrix(directory, *spill_rows(directory, chunk_size=2))
+            transposed = transpose(directory, matrix, chunk_size=2)
+            self.assertEqual(ids.tolist(), sorted(Question.objects.values_list('id', flat=True)))
+            self.assertEqual((transposed != matrix.T.tocsr()).nnz, 0)
+            self.assertTrue(transposed.has_sorted_indices)
+            for array in (ids, matrix.data, matrix.indices, matrix.indptr, transposed.data, transposed.indices):
+                while isinstance(array, np.ndarray):
+                    array = array.base
+                self.assertIsInstance(array, mmap.mmap)
+
+            frequencies = (matrix != 0).sum(axis=0).A1
+            expected = [min(frequencies[matrix[row].indices].sum(), len(ids)) for row in range(len(ids))]
+            self.assertEqual(row_costs(matrix, transposed, chunk_size=2).tolist(), expected)
+
+    def test_incremental(self):
+        """Verify that incremental runs update changed questions and questions they get close to only"""
+        self.rebuild()
+        self.assertEqual(self.rebuild('--incremental'), 0)
+
+        third = self.ask("Sort python list of dicts", "Sorting list by a key", "python")
+        self.assertEqual(self.rebuild('--incremental'), 3)
+        self.assertEqual(set(self.related(third)), {self.sorting.id, self.sorted.id})
+        self.assertIn(third.id, self.related(self.sorted))
+
+        self.css.header = "Centering a javascript promise"
+        self.css.save()
+        self.rebuild('--incremental')
+        self.assertIn(self.css.id, self.related(self.promise))
+        self.assertEqual(self.related(self.promise)[0], self.async_.id)
+
+        self.css.tag.clear()
+        self.assertTrue(Question.objects.get(pk=self.css.pk).related_stale)
+        self.rebuild('--incremental')
+        self.assertEqual(RelatedQuestion.objects.filter(question=third).count(), 2)
+
+
+class FailingEmailBackend(EmailBackend):
+    """Mail backend refusing messages to failing@mail.com"""
+
+    def send_messages(self, messages):
+        if any('failing@mail.com' in message.to for message in messages):
+            raise ConnectionError("SMTP server is down")
+        return super().send_messages(messages)
+
+
+class UnreachableEmailBackend(EmailBackend):
+    """Mail backend which server cannot be connected to"""
+
+    def open(self):
+        raise ConnectionRefusedError("Connection refused")
+
+
+class MailQueueTestSet(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create(username="asker", email="asker@mail.com")
+        cls.replier = User.objects.create(username="replier", email="replier@mail.com")
+        cls.question = Question.objects.create(header="Mailed question", content="", user=cls.author)
+
+    def test_answer_notifies_question_author(self):
+        """Verify that answer queues a notification to the question author which the worker sends"""
+        self.client.force_login(self.replier)
+        self.client.post(reverse('stack:give_answer', args=(self.question.id,)), {'answer': "Reply"})
+        self.assertEqual(len(mail.outbox), 0)
+
+        call_command('send_queued_mail', stdout=StringIO())
+        self.assertEqual([message.to for message in mail.outbox], [["asker@mail.com"]])
+        self.assertIn(reverse('stack:detail', args=(self.question.id,)), mail.outbox[0].body)
+        self.assertIsNotNone(OutgoingEmail.objects.get().sent_at)
+
+    @override_settings(EMAIL_BACKEND='test_stack.FailingEmailBackend', MAIL_MAX_ATTEMPTS=2)
+    def test_retry_with_backoff(self):
+        """Verify that failed message is retried later and given up after MAIL_MAX_ATTEMPTS"""
+        enqueue_mail("Broken", "body", ["failing@mail.com"])
+        enqueue_mail("Fine", "body", ["fine@mail.com"])
+        self.assertEqual(send_queued_mail(), (1, 1))
+
+        failed = OutgoingEmail.objects.get(subject="Broken")
+        self.assertEqual(failed.attempts, 1)
+        self.assertIn("SMTP server is down", failed.last_error)
+        self.assertGreater(failed.next_attempt_at, timezone.now())
+        self.assertEqual(send_queued_mail(), (0, 0))
+
+        OutgoingEmail.objects.update(next_attempt_at=timezone.now())
+        self.assertEqual(send_queued_mail(), (0, 1))
+        OutgoingEmail.objects.update(next_attempt_at=timezone.now())
+        self.assertEqual(send_queued_mail(), (0, 0))
+
+    def test_claimed_meanwhile(self):
+        """Verify that messages another worker claims between the read and the lease are not sent twice"""
+        taken, left = enqueue_mail("Taken", "body", ["a@mail.com"]), enqueue_mail("Left", "body", ["b@mail.com"])
+
+        def read_then_claimed(now, batch_size):
+            messages = due_messages(now, batch_size)
+            OutgoingEmail.objects.filter(pk=taken.pk).update(next_attempt_at=now + datetime.timedelta(seconds=60))
+            return messages
+
+        with mock.patch('stack.mail.due_messages', side_effect=read_then_claimed):
+            self.assertEqual(claim_batch(10), [left])
+        self.assertEqual(send_queued_mail(), (0, 0))
+
+    @override_settings(EMAIL_BACKEND='test_stack.UnreachableEmailBackend')
+    def test_unreachable_server(self):
+        """Verify that messages are postponed without using up attempts while the server is down and the worker
+        keeps running
+        """
+        enqueue_mail("Postponed", "body", ["fine@mail.com"])
+        self.assertEqual(send_queued_mail(), (0, 1))
+        message = OutgoingEmail.objects.get()
+        self.assertEqual(message.attempts, 0)
+        self.assertIn("Connection refused", message.last_error)
+        self.assertGreater(message.next_attempt_at, timezone.now())
+
+        OutgoingEmail.objects.update(next_attempt_at=timezone.now())
+        with mock.patch('stack.management.commands.send_queued_mail.time.sleep', side_effect=InterruptedError):
+            with self.assertRaises(InterruptedError):
+                call_command('send_queued_mail', '--loop', stdout=StringIO())
+        self.assertIsNone(OutgoingEmail.objects.get().sent_at)
+
+
+class TransferTestSet(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.asker = User.objects.create_user(username="asker", email="asker@mail.com", password="password")
+        cls.voter = User.objects.create_user(username="voter", email="voter@mail.com", password="password")
+        cls.questions = []
+        for i in range(5):
+            question = Question.objects.create(header="Exported question %d" % i, content="", user=cls.asker,
+                                               pub_date=timezone.now() - datetime.timedelta(days=i))
+            add_tag("tag%d" % (i % 2), question)
+            answer = Answer.objects.create(content="Exported answer %d" % i, question=question, user=cls.voter)
+            if i % 2:
+                answer.change_mark()
+            question.upvote(cls.voter)
+            answer.downvote(cls.asker)
+            cls.questions.append(question)
+
+    def snapshot(self):
+        return (list(Question.objects.order_by('id').values_list(
+                    'id', 'header', 'pub_date', 'user__username', 'votes', 'answer_count', 'accepted_answer')),
+                list(Answer.objects.order_by('id').values_list('id', 'question', 'votes', 'correctness')),
+                sorted(Question.tag.through.objects.values_list('question', 'tag__tag')),
+                list(User.objects.exclude(username="renamed").order_by('username')
+                     .values_list('username', 'password')))
+
+    def test_round_trip(self):
+        """Verify that exported data is imported back in chunks with votes and answer counts recomputed"""
+        before = self.snapshot()
+        stream = StringIO()
+        call_command('qstack_export', stdout=stream)
+
+        VoteQuestion.objects.all().delete()
+        VoteAnswer.objects.all().delete()
+        Question.objects.all().delete()
+        Tag.objects.all().delete()
+        User.objects.filter(username="voter").update(username="renamed")
+
+        stream.seek(0)
+        with CaptureQueriesContext(connection) as queries:
+            call_command('qstack_import', '-', '--chunk-size', '2', stdin=stream, stdout=StringIO())
+        self.assertEqual(self.snapshot(), before)
+        self.assertEqual(search("exported")[0][0], self.questions[0].id)
+        inserts = [query for query in queries if query['sql'].startswith('INSERT INTO "stack_question"')]
+        self.assertEqual(len(inserts), 3)
+
+    def test_non_empty_target(self):
+        """Verify that import into a database which has questions fails before storing anything"""
+        stream = StringIO()
+        call_command('qstack_export', stdout=stream)
+        stream.seek(0)
+        with self.assertRaisesRegex(CommandError, 'already has questions'):
+            call_command('qstack_import', '-', stdin=stream, stdout=StringIO())
+        self.assertEqual(Question.objects.count(), 5)
+
+
+class SeedTestSet(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        call_command('qstack_seed', '--users', '20', '--questions', '60', '--answers', '120', '--tags', '10',
+                     '--votes', '300', '--seed', '1', stdout=StringIO())
+
+    def test_dataset(self):
+        """Verify that seeded dataset has requested size, consistent counts and skewed popularity"""
+        self.assertEqual(User.objects.count(), 20)
+        self.assertEqual(Question.objects.count(), 60)
+        self.assertEqual(Answer.objects.count(), 120)
+        self.assertEqual(Tag.objects.count(), 10)
+
+        question = Question.objects.order_by('-answer_count').first()
+        self.assertEqual(question.answer_count, question.answer_set.count())
+        self.assertEqual(question.votes, question.question_vote.filter(rate_sign=True).count()
+                         - question.question_vote.filter(rate_sign=False).count())
+        self.assertGreater(question.answer_count, 120 / 60 * 3)
+        tag_usage = sorted(Tag.objects.annotate(used=Count('question')).values_list('used', flat=True))
+        self.assertGreater(tag_usage[-1], tag_usage[len(tag_usage) // 2] * 2)
+
+    def test_benchmark_scenarios(self):
+        """Verify that every benchmark scenario succeeds and reports latency and query counts"""
+        report = run_scenarios(repeat=3)
+        self.assertEqual(set(report), {'index', 'index_by_votes', 'index_hot', 'detail', 'search', 'tag', 'multi_tag',
+                                       'vote_question', 'vote_answer', 'ask_question'})
+        for result in report.values():
+            self.assertEqual(result['errors'], 0)
+            self.assertEqual(result['requests'], 3)
+            self.assertLessEqual(result['p50_ms'], result['p95_ms'])
+            self.assertGreater(result['queries_max'], 0)
+
+
+class MetricsTestSet(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username="metrics_user", email="metrics@mail.com", password="password")
+        cls.question = Question.objects.create(header="Measured question", content="", user=cls.user)
+
+    def sample(self, name):
+        """Returns value of the sample scraped from /metrics, 0 if it is missing"""
+        for line in self.client.get(reverse('metrics')).content.decode().splitlines():
+            if line.startswith(name + ' '):
+                return float(line.rsplit(' ', 1)[1])
+        return 0
+
+    def test_views_measured(self):
+        """Verify that latency, queries and template time are recorded under URL names of the views"""
+        count = 'qstack_request_duration_seconds_count{view="stack:detail"}'
+        queries = 'qstack_db_queries_sum{view="stack:detail"}'
+        templates = 'qstack_template_render_seconds_sum{view="stack:detail"}'
+        before = [self.sample(name) for name in (count, queries, templates)]
+
+        self.client.force_login(self.user)
+        with CaptureQueriesContext(connection) as captured:
+            self.client.get(reverse('stack:detail', args=(self.question.id,)))
+        detail_queries = len(captured)
+        self.client.post(reverse('stack:vote', args=(self.question.id,)), {'upvote': ''})
+
+        self.assertEqual(self.sample(count), before[0] + 1)
+        self.assertEqual(self.sample(queries), before[1] + detail_queries)
+        self.assertGreater(self.sample(templates), before[2])
+        self.assertGreater(self.sample('qstack_responses_total{view="stack:vote",status="302"}'), 0)
+
+    def test_exposition(self):
+        """Verify that metrics are served in Prometheus text format with cache hit ratios"""
+        cache.clear()
+        self.client.get(reverse('stack:index'))
+        self.client.get(reverse('stack:index'))
+        response = self.client.get(reverse('metrics'))
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        content = response.content.decode()
+        self.assertIn('# TYPE qstack_request_duration_seconds histogram', content)
+        self.assertIn('qstack_request_duration_seconds_bucket{view="stack:index",le="+Inf"}', content)
+        self.assertIn('qstack_cache_hit_ratio{cache="page"}', content)
+
+        with self.settings(METRICS_ALLOWED_IPS=['10.0.0.1']):
+            self.assertEqual(self.client.get(reverse('metrics')).status_code, 403)
+        with self.settings(METRICS_ALLOWED_IPS=None):
+            self.assertEqual(self.client.get(reverse('metrics')).status_code, 200)
+            self.assertEqual(self.client.get(reverse('metrics'), REMOTE_ADDR='203.0.113.7').status_code, 403)
+
+
+class QueryCheckTestSet(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username="budget_user", email="budget@mail.com", password="password")
+        for i in range(6):
+            question = Question.objects.create(header="Budget question %d" % i, content="", user=cls.user)
+            add_tag("budget", question)
+            for j in range(3):
+                Answer.objects.create(content="Budget answer %d" % j, question=question, user=cls.user)
+        cls.question = question
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.user)
+
+    def test_fingerprint(self):
+        """Verify that queries differing only in values and IN list lengths share a fingerprint"""
+        self.assertEqual(fingerprint('SELECT * FROM t WHERE id IN (%s, %s, %s) AND name = \'x\' LIMIT 21'),
+                         fingerprint('SELECT * FROM t WHERE id IN (%s) AND name = \'y\'  LIMIT 5'))
+
+    def test_repeats_attributed(self):
+        """Verify that repeated queries are reported with the template tag and model method issuing them"""
+        template = Template('{% load template_tags %}{% for q in questions %}{% get_author q %}{% endfor %}')
+        recorder = QueryRecorder()
+        with recorder.record():
+            template.render(Context({'questions': Question.objects.all()}))
+
+        (key, entry), = recorder.repeated()
+        self.assertEqual(entry['count'], 6)
+        caller, = entry['callers']
+        self.assertIn('models.Question.get_author', caller)
+        self.assertIn('{% get_author q %}', caller)
+
+    def test_transactions_not_repeats(self):
+        """Verify that statements of nested transactions are not reported as repeated queries"""
+        recorder = QueryRecorder()
+        with recorder.record():
+            for i in range(5):
+                with transaction.atomic():
+                    with transaction.atomic():
+                        User.objects.filter(pk=self.user.pk).update(reputation=i)
+        self.assertEqual([key for key, _ in recorder.repeated()], ['UPDATE "stack_user" SET "reputation" = ? WHERE '
+                                                                   '"stack_user"."id" = ?'])
+        self.assertGreaterEqual(recorder.queries['SAVEPOINT ?']['count'], 5)
+
+    def test_budget_exceeded(self):
+        """Verify that the test helper fails on exceeded budget and repeated queries"""
+        with self.assertRaisesRegex(AssertionError, 'exceed budget of 1'):
+            with query_budget(1):
+                list(Question.objects.all())
+                list(Answer.objects.all())
+        with self.assertRaisesRegex(AssertionError, 'identical queries'):
+            with query_budget():
+                for question in Question.objects.all():
+                    question.get_author()
+
+    def test_views_within_budget(self):
+        """Verify that main views stay within QUERY_BUDGETS and repeat no query"""
+        with query_budget(view='stack:index'):
+            self.client.get(reverse('stack:index'))
+        with query_budget(view='stack:index'):
+            self.client.get(reverse('stack:index'), {'tag': 'budget'})
+        with query_budget(view='stack:index'):
+            self.client.get(reverse('stack:index'), {'search': 'budget'})
+        with query_budget(view='stack:detail'):
+            self.client.get(reverse('stack:detail', args=(self.question.id,)))
+        with query_budget(view='stack:vote'):
+            self.client.post(reverse('stack:vote', args=(self.question.id,)), {'upvote': ''})
+        with query_budget(view='stack:ask_question'):
+            self.client.post(reverse('stack:ask_question'), {'q_header': "Budget", 'q_content': "",
+                                                             'q_tags': "one two three"})
+
+
+class TransactionBudgetTestSet(TransactionTestCase):
+    """Write views counted with their real transactions, test cases run them inside one outer transaction"""
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username="budget_author", email="author@mail.com", password="password")
+        self.question = Question.objects.create(header="Budget question", content="", user=self.user)
+        self.answer = Answer.objects.create(content="Budget answer", question=self.question, user=self.user)
+        self.client.force_login(User.objects.create_user(username="budget_voter", email="voter@mail.com",
+                                                         password="password"))
+
+    def test_votes_within_budget(self):
+        """Verify that first votes with their transaction and reputation change stay within QUERY_BUDGETS"""
+        with query_budget(view='stack:vote') as recorder:
+            self.client.post(reverse('stack:vote', args=(self.question.id,)), {'upvote': ''})
+        self.assertIn('BEGIN', recorder.queries)
+        with query_budget(view='api:vote'):
+            response = self.client.post(reverse('api:vote', args=(self.question.id, self.answer.id)), {'upvote': ''})
+        self.assertEqual(response.json()['votes'], 1)
+        self.assertEqual(User.objects.get(pk=self.user.pk).reputation, 15)
+
+
+class ApiTestSet(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username="api_user", email="api@mail.com", password="password")
+        cls.questions = []
+        for i in range(5):
+            question = Question.objects.create(header="Api question %d" % i, content="Body %d" % i, user=cls.user)
+            add_tags(["api", "tag%d" % i], question)
+            for j in range(3):
+                Answer.objects.create(content="Api answer %d" % j, question=question, user=cls.user)
+            cls.questions.append(question)
+        cls.answer = Answer.objects.filter(question=cls.questions[0]).first()
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.user)
+
+    def test_lists(self):
+        """Verify list, tag filter, batch and detail endpoints within their query budgets"""
+        with query_budget(view='api:questions'):
+            data = self.client.get(reverse('api:questions'), {'order': 'vote'}).json()
+        self.assertEqual(len(data['questions']), 5)
+        self.assertEqual(data['questions'][0]['tags'], ['api', 'tag4'])
+        with query_budget(view='api:questions'):
+            data = self.client.get(reverse('api:questions'), {'tag': 'tag1'}).json()
+        self.assertEqual([question['id'] for question in data['questions']], [self.questions[1].id])
+
+        ids = [self.questions[3].id, 0, self.questions[1].id]
+        with query_budget(view='api:questions'):
+            data = self.client.get(reverse('api:questions'), {'ids': ','.join(map(str, ids))}).json()
+        self.assertEqual([question['id'] for question in data['questions']], [ids[0], ids[2]])
+        self.assertEqual(self.client.get(reverse('api:questions'), {'ids': '1,x'}).status_code, 400)
+        with self.settings(API_BATCH_SIZE=2):
+            self.assertEqual(self.client.get(reverse('api:questions'), {'ids': '1,2,3'}).status_code, 400)
+
+        self.questions[0].upvote(self.user)
+        with query_budget(view='api:question'):
+            data = self.client.get(reverse('api:question', args=(self.questions[0].id,))).json()
+        self.assertEqual((data['content'], data['vote'], len(data['answer_list'])), ("Body 0", "up", 3))
+        self.assertEqual(self.client.get(reverse('api:question', args=(0,))).status_code, 404)
+
+    def test_vote(self):
+        """Verify that votes return new count and state without redirect"""
+        url = reverse('api:vote', args=(self.questions[0].id, self.answer.id))
+        with query_budget(view='api:vote'):
+            response = self.client.post(url, {'upvote': ''})
+        self.assertEqual(response.json(), {'id': self.answer.id, 'votes': 1, 'vote': 'up'})
+        self.assertEqual(self.client.post(url, {'downvote': ''}).json()['votes'], -1)
+        self.assertEqual(self.client.post(url, {'downvote': ''}).json(), {'id': self.answer.id, 'votes': 0, 'vote': None})
+        self.assertEqual(self.client.post(url).status_code, 400)
+        self.assertEqual(self.client.post(reverse('api:vote', args=(self.questions[1].id, self.answer.id)),
+                                          {'upvote': ''}).status_code, 404)
+        self.assertEqual(self.client.get(url).status_code, 405)
+
+        response = self.client.post(reverse('api:vote', args=(self.questions[0].id,)), {'downvote': ''})
+        self.assertEqual(response.json()['vote'], 'down')
+        self.client.logout()
+        self.assertEqual(self.client.post(url, {'upvote': ''}).status_code, 403)
+
+    def test_export(self):
+        """Verify that staff can stream the dump in import format"""
+        self.assertEqual(self.client.get(reverse('api:export')).status_code, 403)
+        User.objects.filter(pk=self.user.pk).update(is_staff=True)
+        response = self.client.get(reverse('api:export'))
+        self.assertTrue(response.streaming)
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(sum(1 for line in lines if '"model": "question"' in line), 5)
+
+
+class QueryPlanTestSet(TestCase):
+    """Statements of hot pages have to be served by indexes, without full scans and sorts in temporary B-trees"""
+
+    # statements sorting only few rows picked by index: questions of tag posting lists or search results
+    # passed as id parameters (at most MAX_INLINE_IDS) and relevance of search terms computed from their postings
+    bounded_sorts = re.compile(r'"stack_question"\."id" IN \(%s[,)]|FROM "stack_searchterm"|FROM "stack_searchposting"')
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username="planner", email="planner@mail.com", password="password")
+        # a tag too large for its posting list to be passed as parameters
+        Question.objects.bulk_create([Question(header="Crowded question %d" % i, content="", user=cls.user)
+                                      for i in range(MAX_INLINE_IDS + 10)])
+        tag, links = Tag.objects.create(tag="crowded"), Question.tag.through
+        links.objects.bulk_create([links(question_id=question_id, tag=tag)
+                                   for question_id in Question.objects.values_list('id', flat=True)])
+        recompute_tag_counts()
+        for i in range(25):
+            question = Question.objects.create(header="Planned question %d" % i, content="Planned", user=cls.user)
+            add_tags(["planned", "plan%d" % (i % 3)], question)
+            for j in range(3):
+                Answer.objects.create(content="Planned answer %d" % j, question=question, user=cls.user)
+        cls.question = question
+        cls.answer = Answer.objects.filter(question=question).first()
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.user)
+
+    def assertIndexed(self, *requests):
+        recorder = QueryRecorder()
+        with recorder.record():
+            for request in requests:
+                self.assertLess(request().status_code, 400)
+        problems = []
+        for entry in recorder.queries.values():
+            if entry['sql'].split(None, 1)[0].upper() not in ('SELECT', 'UPDATE', 'DELETE'):
+                continue
+            steps = plan_problems(explain(entry['sql'], entry['params']))
+            if steps and self.bounded_sorts.search(entry['sql']) and all('B-TREE' in step for step in steps):
+                continue
+            if steps:
+                problems.append('%s: %s' % (', '.join(steps), entry['sql']))
+        self.assertEqual(problems, [])
+
+    def test_question_lists(self):
+        """Verify that question lists, their next pages, tag filters and the sidebar use indexes"""
+        index = reverse('stack:index')
+        first = self.client.get(index, {'order': 'vote'}).context['question_list']
+        cache.clear()
+        self.assertIndexed(lambda: self.client.get(index),
+                           lambda: self.client.get(index, {'order': 'vote'}),
+                           lambda: self.client.get(index, {'order': 'vote', 'cursor': first.next_cursor}),
+                           lambda: self.client.get(index, {'order': 'hot'}),
+                           lambda: self.client.get(index, {'tag': 'plan1'}),
+                           lambda: self.client.get(index, {'search': 'tag:planned -tag:plan2'}),
+                           lambda: self.client.get(index, {'search': '-tag:plan2'}),
+                           lambda: self.client.get(index, {'search': 'planned question'}),
+                           lambda: self.client.get(index, {'tag': 'crowded'}),
+                           lambda: self.client.get(index, {'tag': 'crowded', 'order': 'vote'}),
+                           lambda: self.client.get(index, {'tag': 'crowded', 'order': 'hot'}),
+                           lambda: self.client.get(index, {'search': 'tag:crowded -tag:plan2'}),
+                           lambda: self.client.get(index, {'search': '-tag:crowded'}),
+                           lambda: self.client.get(index, {'search': 'tag:crowded -tag:plan2 question'}),
+                           lambda: self.client.get(reverse('stack:tags')),
+                           lambda: self.client.get(reverse('stack:users')),
+                           lambda: self.client.get(reverse('api:questions')))
+
+    def test_create_indexes(self):
+        """Verify that indexes missing in an existing database are created"""
+        with connection.cursor() as cursor:
+            cursor.execute('DROP INDEX stack_tag_popular_idx')
+        out = StringIO()
+        call_command('create_indexes', stdout=out)
+        self.assertIn('Created 1 indexes', out.getvalue())
+
+    def test_add_columns(self):
+        """Verify that columns missing in an existing database are added with their indexes and backfilled"""
+        answer = self.question.answer_set.first()
+        answer.change_mark()
+        with connection.cursor() as cursor:
+            for table, column in (('stack_question', 'accepted_answer_id'), ('stack_question', 'hot_score'),
+                                  ('stack_tag', 'question_count')):
+                for name, constraint in connection.introspection.get_constraints(cursor, table).items():
+                    if constraint['index'] and column in constraint['columns']:
+                        cursor.execute('DROP INDEX %s' % name)
+                cursor.execute('ALTER TABLE %s DROP COLUMN %s' % (table, column))
+        out = StringIO()
+        call_command('create_indexes', stdout=out)
+        self.assertIn('Added 3 columns: question.accepted_answer, question.hot_score, tag.question_count',
+                      out.getvalue())
+        self.assertIn('Created 3 indexes', out.getvalue())
+        question = Question.objects.get(pk=self.question.pk)
+        self.assertEqual(question.accepted_answer, answer)
+        self.assertGreater(question.hot_score, 0)
+        self.assertEqual(Tag.objects.get(tag='planned').question_count, 25)
+        out = StringIO()
+        call_command('create_indexes', stdout=out)
+        self.assertEqual(out.getvalue(), 'Added 0 columns: -\nCreated 0 indexes\n')
+
+    def test_question_page(self):
+        """Verify that question page, its answer pages, votes and marks use indexes"""
+        url = reverse('stack:detail', args=(self.question.id,))
+        with self.settings(API_PAGE_SIZE=2):
+            cursor = self.client.get(reverse('api:question', args=(self.question.id,))).json()['next']
+        self.assertIndexed(lambda: self.client.get(url),
+                           lambda: self.client.get(url, {'cursor': cursor}),
+                           lambda: self.client.post(reverse('stack:vote', args=(self.question.id,)), {'upvote': ''}),
+                           lambda: self.client.post(reverse('api:vote', args=(self.question.id, self.answer.id)),
+                                                    {'downvote': ''}),
+                           lambda: self.client.post(reverse('stack:mark_answer', args=(self.question.id,
+                                                                                        self.answer.id)),
+                                                    HTTP_REFERER=url),
+                           lambda: self.client.get(reverse('api:question', args=(self.question.id,))))
+
+
+class TagTestSet(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username="tag_user", email="tag@mail.com", password="password")
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.user)
+
+    def ask(self, tags):
+        self.client.post(reverse('stack:ask_question'), {'q_header': "Tagged", 'q_content': "", 'q_tags': tags})
+        return Question.objects.latest('id')
+
+    def counts(self):
+        return dict(Tag.objects.values_list('tag', 'question_count'))
+
+    def test_question_count_maintained(self):
+        """Verify that number of questions of tags follows adding, removing and deleting of tagged questions"""
+        first = self.ask("python django")
+        second = self.ask("python")
+        self.assertEqual(self.counts(), {'python': 2, 'django': 1})
+
+        second.tag.remove(Tag.objects.get(tag='python'))
+        Tag.objects.get(tag='django').question_set.add(second)
+        self.assertEqual(self.counts(), {'python': 1, 'django': 2})
+
+        first.tag.clear()
+        self.assertEqual(self.counts(), {'python': 0, 'django': 1})
+        second.delete()
+        self.assertEqual(self.counts(), {'python': 0, 'django': 0})
+
+        Tag.objects.update(question_count=5)
+        call_command('reconcile_question_stats', stdout=StringIO())
+        self.assertEqual(self.counts(), {'python': 0, 'django': 0})
+
+    def test_unlinked_removal(self):
+        """Verify that removing tags a question does not have leaves counts alone and clearing from the tag side
+        updates its questions
+        """
+        first = self.ask("python django")
+        second = self.ask("python")
+        python, django = Tag.objects.get(tag='python'), Tag.objects.get(tag='django')
+        second.tag.remove(django)
+        django.question_set.remove(second)
+        self.assertEqual(self.counts(), {'python': 2, 'django': 1})
+
+        Question.objects.update(related_stale=False)
+        version = question_version(second.id)
+        python.question_set.clear()
+        self.assertEqual(self.counts(), {'python': 0, 'django': 1})
+        self.assertNotEqual(question_version(second.id), version)
+        self.assertEqual(set(Question.objects.filter(related_stale=True)), {first, second})
+        self.assertEqual(second.get_tags(), [])
+
+    def test_bulk_tag_resolution(self):
+        """Verify that entered tags are resolved with one bulk insert of new tags and one insert of links"""
+        Tag.objects.create(tag='existing')
+        with CaptureQueriesContext(connection) as queries:
+            question = self.ask("existing new1 new2")
+        inserts = [query['sql'].split('(')[0] for query in queries if query['sql'].startswith('INSERT')]
+        self.assertEqual(inserts.count('INSERT INTO "stack_tag" '), 1)
+        self.assertEqual(inserts.count('INSERT INTO "stack_question_tag" '), 1)
+        self.assertEqual(sorted(question.get_tags()), ['existing', 'new1', 'new2'])
+
+    def test_concurrently_created_tags(self):
+        """Verify that new tags are all created when another request has just inserted one of them"""
+        Tag.objects.create(tag='raced')
+        lookups = [Tag.objects.none()]
+        real_filter = Tag.objects.filter
+
+        def filter_missing_raced(**kwargs):
+            return lookups.pop() if lookups else real_filter(**kwargs)
+
+        with mock.patch.object(Tag.objects, 'filter', side_effect=filter_missing_raced):
+            question = self.ask("raced new")
+        self.assertEqual(sorted(question.get_tags()), ['new', 'raced'])
+        self.assertEqual(Tag.objects.filter(tag='raced').count(), 1)
+
+    def test_tag_directory(self):
+        """Verify that tag page is sorted by popularity, paginated, cached and refreshed on changes"""
+        for i in range(70):
+            Tag.objects.create(tag='tag%02d' % i, question_count=i)
+        response = self.client.get(reverse('stack:tags'))
+        tags = list(response.context['tags'])
+        self.assertEqual(len(tags), 60)
+        self.assertEqual(tags[0].tag, 'tag69')
+        next_page = self.client.get(reverse('stack:tags'), {'cursor': response.context['tags'].next_cursor})
+        self.assertEqual([tag.tag for tag in next_page.context['tags']], ['tag%02d' % i for i in range(9, -1, -1)])
+
+        by_name = self.client.get(reverse('stack:tags'), {'order': 'name'})
+        self.assertEqual(by_name.context['tags'][0].tag, 'tag00')
+
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(reverse('stack:tags'))
+        self.assertFalse([query for query in queries if 'stack_tag' in query['sql']])
+
+        self.ask("tag00")
+        response = self.client.get(reverse('stack:tags'), {'order': 'name'})
+        self.assertEqual(response.context['tags'][0].question_count, 1)
+
+
+class TagQueryTestSet(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username="tagquery_user", email="tq@mail.com", password="password")
+        cls.questions = {}
+        for name, tags in (('both', 'python django'), ('flask', 'python django flask'), ('python', 'python'),
+                           ('django', 'django'), ('other', 'rust')):
+            question = Question.objects.create(header="Sorting in %s" % name, content="", user=cls.user)
+            add_tags(tags.split(), question)
+            cls.questions[name] = question
+
+    def setUp(self):
+        cache.clear()
+
+    def ids(self, query, by_tag=False):
+        return {question.id for question in fetch_questions(query, '-pub_date', by_tag=by_tag)}
+
+    def expected(self, *names):
+        return {self.questions[name].id for name in names}
+
+    def test_parse_query(self):
+        """Verify that required, excluded tags and key words are split"""
+        query = parse_query("tag:Python tag:django -tag:flask sorting")
+        self.assertEqual((query.tags, query.excluded, query.words), (['python', 'django'], ['flask'], ['sorting']))
+
+    def test_intersection_and_exclusion(self):
+        """Verify that tag queries intersect required tags and drop excluded ones"""
+        self.assertEqual(self.ids("tag:python tag:django"), self.expected('both', 'flask'))
+        self.assertEqual(self.ids("tag:python tag:django -tag:flask"), self.expected('both'))
+        self.assertEqual(self.ids("-tag:python -tag:django"), self.expected('other'))
+        self.assertEqual(self.ids("tag:python tag:unknown"), set())
+        self.assertEqual(self.ids("tag:python -tag:unknown"), self.expected('both', 'flask', 'python'))
+        self.assertEqual(self.ids("django python", by_tag=True), self.expected('both', 'flask'))
+        self.assertEqual(self.ids("tag:django flask"), self.expected('flask'))
+
+    def test_matches_join_based_query(self):
+        """Verify that posting lists give the same results as joins, also after tags change"""
+        for tags, excluded in ((['python'], []), (['python', 'django'], ['flask']), ([], ['rust'])):
+            self.assertEqual(set(filter_questions(Question.objects.all(), tags, excluded)),
+                             set(join_questions(Question.objects.all(), tags, excluded)))
+
+        with mock.patch('stack.tagindex.MAX_INLINE_IDS', 0):
+            for tags, excluded in ((['python'], []), (['python', 'django'], ['flask']), ([], ['rust', 'flask'])):
+                queryset = filter_questions(Question.objects.all(), tags, excluded)
+                sql, params = queryset.query.sql_with_params()
+                self.assertIn('EXISTS(SELECT', sql)
+                self.assertNotIn('IN (SELECT', sql)
+                self.assertEqual(len(params), 3 * len(set(tags) | set(excluded)))
+                self.assertEqual(set(queryset), set(join_questions(Question.objects.all(), tags, excluded)))
+
+        self.questions['python'].tag.add(Tag.objects.get(tag='django'))
+        self.assertEqual(self.ids("tag:python tag:django -tag:flask"), self.expected('both', 'python'))
+        self.questions['both'].delete()
+        self.assertEqual(self.ids("tag:python tag:django -tag:flask"), self.expected('python'))
+
+    def test_posting_lists_cached(self):
+        """Verify that repeated tag query reads posting lists from cache"""
+        self.ids("tag:python tag:django -tag:flask")
+        with CaptureQueriesContext(connection) as queries:
+            self.ids("tag:python tag:django -tag:flask")
+        self.assertFalse([query for query in queries if 'FROM "stack_question_tag"' in query['sql']])
+
+    def test_tags_filtered_before_search_limit(self):
+        """Verify that key word results are limited after tag filters, not before them"""
+        for max_inline_ids in (MAX_INLINE_IDS, 0):
+            with mock.patch('stack.search.RESULT_LIMIT', 1), mock.patch('stack.tagindex.MAX_INLINE_IDS',
+                                                                         max_inline_ids):
+                self.assertEqual(self.ids("tag:rust sorting"), self.expected('other'))
+                self.assertEqual(self.ids("tag:python -tag:django sorting"), self.expected('python'))
+                self.assertEqual(len(self.ids("-tag:rust sorting")), 1)
+
+    def test_large_tags_not_loaded(self):
+        """Verify that posting lists of tags having more than MAX_INLINE_IDS questions are neither loaded nor cached"""
+        with mock.patch('stack.tagindex.MAX_INLINE_IDS', 1):
+            self.assertEqual(self.ids("tag:python -tag:rust"), self.expected('both', 'flask', 'python'))
+            self.assertEqual(self.ids("tag:flask tag:django"), self.expected('flask'))
+            self.assertEqual(self.ids("-tag:flask -tag:rust"), self.expected('both', 'python', 'django'))
+        cached = {tag.tag for tag in Tag.objects.all() if cache.get(POSTINGS_KEY % tag.id) is not None}
+        self.assertEqual(cached, {'flask', 'rust'})
+
+    def test_intersect(self):
+        """Verify that both hashing and binary search intersections keep sorted order"""
+        larger = list(range(0, 1000, 2))
+        self.assertEqual(intersect([4, 5, 6, 998], larger), [4, 6, 998])
+        self.assertEqual(intersect(list(range(0, 1000, 3)), larger), list(range(0, 1000, 6)))
+
+
+def make_image(width, height, image_format='PNG'):
+    buffer = BytesIO()
+    Image.new('RGB', (width, height), (200, 30, 30)).save(buffer, image_format)
+    return buffer.getvalue()
+
+
+class CountingUpload(SimpleUploadedFile):
+    """Upload remembering how many bytes were read from it"""
+    bytes_read = 0
+
+    def read(self, *args):
+        data = super().read(*args)
+        self.bytes_read += len(data)
+        return data
+
+
+class AvatarTestSet(TestCase):
+
+    def setUp(self):
+        media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media)
+        override = override_settings(MEDIA_ROOT=media)
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def sign_up(self, content, name='me.png'):
+        form = CustomUserCreationForm(
+            {'username': "avatar_user", 'email': "avatar@mail.com", 'password1': "Secret-pass-1",
+             'password2': "Secret-pass-1"},
+            {'image': SimpleUploadedFile(name, content, 'image/png')})
+        return form
+
+    def test_thumbnails_at_upload(self):
+        """Verify that avatar is stored under hash of its content with thumbnails used by rows and admin"""
+        content = make_image(300, 200)
+        form = self.sign_up(content)
+        self.assertTrue(form.is_valid(), form.errors)
+        user = form.save()
+
+        digest = hashlib.sha256(content).hexdigest()
+        self.assertEqual(user.image.name, 'avatars/%s/%s/original.png' % (digest[:2], digest))
+        for size in (32, 150):
+            with default_storage.open('avatars/%s/%s/%d.png' % (digest[:2], digest, size)) as thumbnail:
+                self.assertEqual(Image.open(thumbnail).size, (size, size))
+
+        question = Question.objects.create(header="Avatar", content="", user=user)
+        self.assertEqual(question.get_author_image(), '/photos/avatars/%s/%s/32.png' % (digest[:2], digest))
+        self.assertIn('/150.png', CustomUserAdmin(User, admin.site).image_tag(user))
+
+        response = self.client.get(question.get_author_image())
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('max-age=31536000', response['Cache-Control'])
+        self.assertIn('immutable', response['Cache-Control'])
+        response.close()
+
+    def test_streaming_validation(self):
+        """Verify that uploads are rejected by size, format and dimensions reading only their header"""
+        upload = CountingUpload('big.png', make_image(1200, 10), 'image/png')
+        with self.assertRaisesRegex(ValidationError, 'pixels or smaller'):
+            validate_avatar(upload)
+        self.assertLess(upload.bytes_read, 2048)
+
+        with self.assertRaisesRegex(ValidationError, 'JPEG, GIF or PNG'):
+            validate_avatar(SimpleUploadedFile('fake.png', b'not an image' * 100, 'image/png'))
+        with self.assertRaisesRegex(ValidationError, 'JPEG, GIF or PNG'):
+            validate_avatar(SimpleUploadedFile('me.bmp', make_image(10, 10, 'BMP'), 'image/png'))
+        with self.settings(AVATAR_MAX_BYTES=100):
+            self.assertFalse(self.sign_up(make_image(100, 100)).is_valid())
+
+    def test_rebuild_legacy_avatars(self):
+        """Verify that avatars stored before thumbnails are moved to content based names"""
+        user = User.objects.create_user(username="legacy", email="legacy@mail.com", password="password")
+        legacy = default_storage.save('photos/None/me.png', ContentFile(make_image(64, 64)))
+        User.objects.filter(pk=user.pk).update(image=legacy)
+        self.assertEqual(User.objects.get(pk=user.pk).get_avatar_url(), '/photos/photos/None/me.png')
+
+        call_command('rebuild_avatars', stdout=StringIO())
+        url = User.objects.get(pk=user.pk).get_avatar_url()
+        self.assertTrue(url.startswith('/photos/avatars/') and url.endswith('/32.png'))
+        self.assertTrue(default_storage.exists(url[len('/photos/'):]))